@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import time
+
+from db import ARCHIVE_CANDIDATES_SQL, ARCHIVED_TABLES
+
+logger = logging.getLogger(__name__)
+
+
+class OrderArchiver:
+    """Moves closed orders out of the live database into the archive.
+
+    Orders that were paid or cancelled more than max_age seconds ago (by
+    the time they were placed) are copied to the archive attached as
+    "archive", together with their history in order_events, and then
+    deleted from the live tables, batch_size orders at a time, each
+    step its own short write so the bot's own writes queue between them.
+    SQLite commits a transaction over two WAL databases one file at a
+    time, so the copy is committed before the delete: a crash in between
+    leaves an order in both, which readers skip and the next run cleans
+    up. The space freed in orders.db is handed back to the file system
+    by incremental vacuum, vacuum_pages at a time. Analytics keep their
+    history: rollups are never decremented when an order is archived.
+    """
+
+    def __init__(self, repo, max_age: float, batch_size: int = 500, interval: float = 3600,
+                 vacuum_pages: int = 2000):
+        self.repo = repo
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.interval = interval
+        self.vacuum_pages = vacuum_pages
+        self._task = None
+        self.archived = 0
+        self.pages_freed = 0
+        self.last_run_seconds = 0.0
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _loop(self):
+        try:
+            if await self.repo.write("archive_auto_vacuum", _enable_incremental_vacuum):
+                logger.info("Switched orders.db to incremental vacuum")
+        except Exception as e:
+            logger.error("Could not switch orders.db to incremental vacuum: %s", e)
+        while True:
+            try:
+                await self.run()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Order archiving failed: %s", e)
+            await asyncio.sleep(self.interval)
+
+    async def run(self) -> int:
+        # One pass: -> the number of orders archived
+        started = time.perf_counter()
+        before = int(time.time() - self.max_age)
+        moved = 0
+        while True:
+            order_ids = await self.repo.write("archive_copy", _copy, before, self.batch_size)
+            if not order_ids:
+                break
+            purged = await self.repo.write("archive_purge", _purge, order_ids, before)
+            if not purged:
+                break  # nothing could be moved; leave it to the next run rather than spin
+            moved += purged
+        while True:
+            freed = await self.repo.write("archive_vacuum", _vacuum, self.vacuum_pages)
+            self.pages_freed += freed
+            if freed < self.vacuum_pages:
+                break
+        self.archived += moved
+        self.last_run_seconds = time.perf_counter() - started
+        if moved:
+            logger.info("Archived %s orders in %.2fs", moved, self.last_run_seconds)
+        return moved
+
+    def metrics(self) -> dict:
+        return {
+            "archived": self.archived,
+            "pages_freed": self.pages_freed,
+            "last_run_ms": round(self.last_run_seconds * 1000, 1),
+        }
+
+
+# Queries (executed on repository threads)
+def _enable_incremental_vacuum(conn) -> bool:
+    # A database created before archiving has no auto-vacuum pointer map; one full VACUUM adds it
+    if conn.execute("PRAGMA main.auto_vacuum").fetchone()[0] == 2:
+        return False
+    conn.execute("PRAGMA main.auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM main")
+    return True
+
+
+def _copy(conn, before: int, limit: int) -> list:
+    # Copies one batch to the archive; rows already there from an interrupted run are kept as they are
+    order_ids = [row[0] for row in conn.execute(ARCHIVE_CANDIDATES_SQL, (before, limit))]
+    if not order_ids:
+        return order_ids
+    marks = ", ".join("?" * len(order_ids))
+    for table, key in ARCHIVED_TABLES.items():
+        columns = ", ".join(row[0] for row in conn.execute("SELECT name FROM pragma_table_info(?, 'main')", (table,)))
+        conn.execute(
+            f"INSERT OR IGNORE INTO archive.{table} ({columns}) SELECT {columns} FROM main.{table} WHERE {key} IN ({marks})",
+            order_ids,
+        )
+    return order_ids
+
+
+def _purge(conn, order_ids: list, before: int) -> int:
+    # Only orders the archive really holds are deleted; the full-text index follows by trigger
+    archived = f"SELECT id FROM archive.orders WHERE id IN ({', '.join('?' * len(order_ids))})"
+    deleted = {
+        table: conn.execute(f"DELETE FROM main.{table} WHERE {key} IN ({archived})", order_ids).rowcount
+        for table, key in ARCHIVED_TABLES.items()
+    }
+    conn.execute("UPDATE archive_state SET archived_before = MAX(archived_before, ?) WHERE id = 1", (before,))
+    return deleted["orders"]
+
+
+def _vacuum(conn, pages: int) -> int:
+    # -> pages given back to the file system
+    free = conn.execute("PRAGMA main.freelist_count").fetchone()[0]
+    if not free:
+        return 0
+    # executescript steps the pragma to completion; execute() frees a single page
+    conn.executescript(f"PRAGMA main.incremental_vacuum({int(pages)})")
+    return free - conn.execute("PRAGMA main.freelist_count").fetchone()[0]
@@ -0,0 +1,110 @@
+"""Micro-benchmark: callback routing cost, filter chain vs prefix table.
+
+Feeds the same mix of callback queries through two dispatchers with no-op
+handlers: one registered the old way (a chain of F.data.startswith filters
+in bot.py order), one with CallbackRouter. No network is involved.
+
+    python bench_callbacks.py [--updates 20000]
+"""
+import argparse
+import asyncio
+import time
+
+from aiogram import Bot, Dispatcher, F
+from aiogram.types import Update
+
+from callbacks import (
+    AdminAction, AdminCallback, CallbackRouter, ComplexityCallback, OrderAction, OrderCallback, PageCallback,
+    PageView, PaymentAction, PaymentCallback, PlatformCallback, ServiceCallback,
+)
+
+# Old payloads in the order bot.py used to register their filters
+LEGACY_FILTERS = [
+    F.data == "accept_terms", F.data == "reject_terms", F.data == "check_subscription", F.data == "back_to_menu",
+    F.data.startswith("complexity_"), F.data.startswith("service_"), F.data.startswith("target_platform_"),
+    F.data.startswith("promo_"), F.data.startswith("pay_"), F.data.startswith("payment_done_"),
+    F.data.startswith("admin_pay_confirm_"), F.data.startswith("admin_pay_reject_"), F.data == "cancel_order",
+    F.data.startswith("my_orders"), F.data.startswith("admin_page_"), F.data.startswith("admin_chat_"),
+    F.data == "start_chat_with_admin",
+]
+
+# (old payload, new payload) pairs, roughly in the proportion users press them
+MIX = [
+    ("accept_terms", "accept_terms"),
+    ("service_design", ServiceCallback(service="design").pack()),
+    ("target_platform_Google Ads", PlatformCallback(code="gads").pack()),
+    ("promo_no", "promo_no"),
+    ("pay_1042", OrderCallback(action=OrderAction.PAY, order_id=1042).pack()),
+    ("payment_done_1042", OrderCallback(action=OrderAction.PAID, order_id=1042).pack()),
+    ("my_orders", "my_orders"),
+    ("my_orders_next_1718000000_1042", PageCallback(
+        view=PageView.MY_ORDERS, backward=False, timestamp=1718000000, order_id=1042).pack()),
+    ("admin_pay_confirm_1042", PaymentCallback(action=PaymentAction.CONFIRM, order_id=1042).pack()),
+    ("admin_chat_5001", AdminCallback(action=AdminAction.CHAT, target_id=5001).pack()),
+    ("start_chat_with_admin", "start_chat_with_admin"),
+    ("back_to_menu", "back_to_menu"),
+]
+
+
+async def noop(*args, **kwargs):
+    pass
+
+
+def filter_chain_dispatcher() -> Dispatcher:
+    dp = Dispatcher()
+    for rule in LEGACY_FILTERS:
+        dp.callback_query.register(noop, rule)
+    return dp
+
+
+def prefix_table_dispatcher() -> Dispatcher:
+    dp = Dispatcher()
+    router = CallbackRouter()
+    for key in ("accept_terms", "reject_terms", "check_subscription", "back_to_menu", "promo_yes", "promo_no",
+                "cancel_order", "my_orders", "start_chat_with_admin"):
+        router.on(key)(noop)
+    for factory in (ServiceCallback, ComplexityCallback, PlatformCallback, PageCallback):
+        router.on(factory)(noop)
+    for action in OrderAction:
+        router.on(OrderCallback, action=action)(noop)
+    for action in PaymentAction:
+        router.on(PaymentCallback, action=action)(noop)
+    router.on(AdminCallback, action=AdminAction.CHAT)(noop)
+    dp.callback_query.register(router.dispatch)
+    return dp
+
+
+def make_updates(payloads, count: int):
+    updates = []
+    for i in range(count):
+        data = payloads[i % len(payloads)]
+        user = {"id": 5001, "is_bot": False, "first_name": "Bench"}
+        updates.append(Update.model_validate({"update_id": i, "callback_query": {
+            "id": str(i), "from": user, "chat_instance": "1", "data": data,
+        }}))
+    return updates
+
+
+async def run(dp: Dispatcher, bot: Bot, updates) -> float:
+    for update in updates[:200]:  # warm up caches
+        await dp.feed_update(bot, update)
+    started = time.perf_counter()
+    for update in updates:
+        await dp.feed_update(bot, update)
+    return time.perf_counter() - started
+
+
+async def main(count: int):
+    bot = Bot(token="123:bench")
+    old = await run(filter_chain_dispatcher(), bot, make_updates([old for old, _ in MIX], count))
+    new = await run(prefix_table_dispatcher(), bot, make_updates([new for _, new in MIX], count))
+    legacy = await run(prefix_table_dispatcher(), bot, make_updates([old for old, _ in MIX], count))
+    await bot.session.close()
+    for name, elapsed in (("filter chain", old), ("prefix table", new), ("prefix table, old payloads", legacy)):
+        print(f"{name:28} {elapsed / count * 1e6:8.1f} us/update")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=20_000)
+    asyncio.run(main(parser.parse_args().updates))
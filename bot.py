@@ -1,17 +1,48 @@
 import asyncio
 import logging
 import sqlite3
+import calendar
 import time
 import os
-from aiogram import Bot, Dispatcher, F
+import zlib
+from collections import Counter
+from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
-from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.exceptions import TelegramForbiddenError
+from aiogram.filters import Command, CommandObject
+from aiogram.types import Message, CallbackQuery, ChatMemberUpdated, FSInputFile
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
 from dotenv import load_dotenv
+from archive import OrderArchiver
+from broadcast import Broadcaster
+from callbacks import (
+    AdminAction, AdminCallback, CallbackRouter, ComplexityCallback, OrderAction, OrderCallback, PageCallback,
+    PageView, PaymentAction, PaymentCallback, PlatformCallback, SearchCallback, ServiceCallback,
+)
+from db import (
+    OrderRepository, PromoUnavailable, ROLLUP_TERMS, ROLLUP_UTC_OFFSET, TIMER_ORDER_EXPIRY, TIMER_PAYMENT_REMINDER,
+    TIMER_RECEIPT_REVIEW, UNPAID_STATUSES, WORK_ORDER, WORK_RECEIPT, rollup_day,
+)
+from export import FORMATS, MAX_UPLOAD_BYTES, OrderExporter
+from flood import FloodControlMiddleware
+from fsm_storage import SQLiteStorage
+from idempotency import IdempotencyMiddleware
+from logs import CorrelationMiddleware, logging_metrics, setup_logging
+from notify import AdminNotifier
+from metrics import ApiMetricsMiddleware, HandlerMetricsMiddleware, MetricsServer, db_observer, default_registry
+from promo import PromoIndex
+from relay import ChatRelay
+from sender import SendScheduler, RateLimitMiddleware
+from subscription import MembershipCache, MEMBER_STATUSES
+from timers import TimerScheduler
+from workqueue import PresenceMiddleware, WorkQueue
+from ui import (
+    render, main_menu_kb, promo_choice_kb, complexity_kb, back_to_menu_kb, subscription_kb,
+    payment_confirmation_kb, terms_confirmation_kb, payment_done_kb,
+    user_chat_kb, target_platform_kb, find_kb, payment_reminder_kb, admin_payment_kb, my_orders_kb, admin_orders_kb, digest_without, TARGET_PLATFORMS,
+)
 
 # Load environment variables
 load_dotenv()
@@ -19,42 +50,62 @@ API_TOKEN = os.getenv("API_TOKEN")
 if not API_TOKEN or not isinstance(API_TOKEN, str):
     raise ValueError("API_TOKEN is not set or invalid in .env file. Please set a valid bot token (e.g., API_TOKEN=your_bot_token in .env).")
 
-ADMIN_ID = int(os.getenv("ADMIN_ID", 6448909987))
+ADMIN_ID = int(os.getenv("ADMIN_ID", 6448909987))  # the owner: gets broadcast reports, and the work nobody else can take
+# Everyone who reviews orders, e.g. "6448909987,123456789"; the owner is always one of them
+ADMIN_IDS = frozenset([ADMIN_ID, *(int(s) for s in os.getenv("ADMIN_IDS", "").split(",") if s.strip())])
+WORK_LEASE = float(os.getenv("WORK_LEASE", 900))  # an admin silent this long loses their orders and receipts to another
 PAYMENT_PROVIDER_TOKEN = os.getenv("PAYMENT_PROVIDER_TOKEN", "your_payment_token")  # Click yoki Payme tokeni
 REQUIRED_CHANNEL = "@semagency_channel"
 REQUIRED_CHANNEL_LINK = "https://t.me/semagency_channel"
-PROMO_CODES = {"Samandar06": 0.10, "Semagensy": 0.05}
 COMPLEXITY_PRICES = {"minimalistik": 100_000, "orta": 150_000, "yuqori": 200_000}
-DB_PATH = "orders.db"
-
-# Logging setup
-logging.basicConfig(level=logging.INFO)
+DB_PATH = os.getenv("DB_PATH", "orders.db")
+# Paid and cancelled orders placed this many days ago move to the archive database; 0 keeps them all live
+ARCHIVE_AFTER = float(os.getenv("ARCHIVE_AFTER", 180))
+ARCHIVE_PATH = os.getenv("ARCHIVE_PATH", os.path.splitext(DB_PATH)[0] + "-archive.db")
+FSM_SESSION_TTL = float(os.getenv("FSM_SESSION_TTL", 7 * 86400))  # idle sessions are dropped after this
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", 30))  # Telegram allows ~30 messages/s per bot
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", 1))  # and ~1 message/s per chat
+MY_ORDERS_PAGE_SIZE = 10
+FIND_PAGE_SIZE = 5
+ADMIN_PAGE_SIZE = 5
+STATS_DAYS = 7
+MEMBERSHIP_TTL = float(os.getenv("MEMBERSHIP_TTL", 600))  # seconds a positive check is trusted
+MEMBERSHIP_NEGATIVE_TTL = float(os.getenv("MEMBERSHIP_NEGATIVE_TTL", 30))
+PROMO_REFRESH_INTERVAL = float(os.getenv("PROMO_REFRESH_INTERVAL", 30))  # picks up codes added by other processes
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# Webhook workers each serve their own metrics on METRICS_PORT + worker index; 0 disables the endpoint
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", 0))
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", 1))  # set by webhook.py; the send limits are split between workers
+# New orders and receipts arriving within this many seconds reach the admin as one digest; 0 sends each at once
+ADMIN_DIGEST_WINDOW = float(os.getenv("ADMIN_DIGEST_WINDOW", 5))
+ADMIN_IMMEDIATE_TOTAL = int(os.getenv("ADMIN_IMMEDIATE_TOTAL", 200_000))  # orders worth this much skip the digest
+# Seconds after an order is placed at which an unpaid customer is reminded, e.g. "3600,86400"; empty disables
+PAYMENT_REMINDERS = [float(s) for s in os.getenv("PAYMENT_REMINDERS", "3600,86400").split(",") if s.strip()]
+ORDER_EXPIRY_AFTER = float(os.getenv("ORDER_EXPIRY_AFTER", 3 * 86400))  # unpaid orders are cancelled after this; 0 never
+RECEIPT_NUDGE_AFTER = float(os.getenv("RECEIPT_NUDGE_AFTER", 3600))  # the admin is reminded of unreviewed receipts this often
+RECEIPT_NUDGES = 3
+# Per-user flood control: messages and presses per second, and how many may be saved up
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", 1))
+FLOOD_BURST = float(os.getenv("FLOOD_BURST", 8))
+FLOOD_MAX_IN_FLIGHT = int(os.getenv("FLOOD_MAX_IN_FLIGHT", 2))  # updates of one user handled at once
+# Load is shed, favouring users who have been quiet, past this event-loop lag or send-queue depth
+SHED_LOOP_LAG = float(os.getenv("SHED_LOOP_LAG", 0.25))
+SHED_SEND_QUEUE = int(os.getenv("SHED_SEND_QUEUE", 500))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # or "text"
+# Past this many records per second from one logging call, info lines are sampled 1 in LOG_SAMPLE_EVERY
+LOG_SAMPLE_BURST = int(os.getenv("LOG_SAMPLE_BURST", 20))
+LOG_SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", 100))
+
+# Logging setup: records are queued to a writer thread, tagged with the update they belong to
+setup_logging(LOG_LEVEL, LOG_FORMAT, static={"worker": WORKER_INDEX} if "WORKER_INDEX" in os.environ else None,
+              sample_burst=LOG_SAMPLE_BURST, sample_every=LOG_SAMPLE_EVERY)
 logger = logging.getLogger(__name__)
 
-# Database initialization
-def init_db():
-    with sqlite3.connect(DB_PATH) as conn:
-        c = conn.cursor()
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                service TEXT,
-                details TEXT,
-                colors TEXT,
-                complexity TEXT,
-                promo_code TEXT,
-                promo_discount REAL,
-                referral_discount REAL,
-                total_price INTEGER,
-                timestamp INTEGER,
-                status TEXT DEFAULT 'pending',
-                payment_status TEXT DEFAULT 'pending'
-            )
-        """)
-        conn.commit()
-
-init_db()
+# Shared order repository (long-lived connections, queries off the event loop)
+# The archive stays readable after archiving is turned off
+repo = OrderRepository(DB_PATH, archive_path=ARCHIVE_PATH if ARCHIVE_AFTER or os.path.exists(ARCHIVE_PATH) else None)
 
 # State definitions
 class OrderStates(StatesGroup):
@@ -70,169 +121,169 @@ class OrderStates(StatesGroup):
     waiting_target_platform = State()
     waiting_target_details = State()
 
-# Keyboard definitions
-def main_menu_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🎨 Grafik Dizayn", callback_data="service_design")],
-        [InlineKeyboardButton(text="✍️ Telegram bot yaratish", callback_data="service_content")],
-        [InlineKeyboardButton(text="💻 Web Dasturlash", callback_data="service_web")],
-        [InlineKeyboardButton(text="✍️ Ijtimoiy tarmoqlarni avtomatlashtirish", callback_data="service_content")],
-        [InlineKeyboardButton(text="🎯 Target Xizmat", callback_data="service_target")],  # Yangi xizmat
-        [InlineKeyboardButton(text="📋 Mening Buyurtmalarim", callback_data="my_orders")]
-    ])
-
-def promo_choice_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Ha", callback_data="promo_yes"),
-         InlineKeyboardButton(text="❌ Yo‘q", callback_data="promo_no")]
-    ])
-
-def complexity_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Minimalistik", callback_data="complexity_minimalistik")],
-        [InlineKeyboardButton(text="O'rta", callback_data="complexity_orta")],
-        [InlineKeyboardButton(text="Yuqori", callback_data="complexity_yuqori")]
-    ])
-
-def back_to_menu_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⬅️ Bosh menyuga", callback_data="back_to_menu")]
-    ])
-
-def subscription_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Obuna bo‘lish", url=REQUIRED_CHANNEL_LINK)],
-        [InlineKeyboardButton(text="✅ Tekshirish", callback_data="check_subscription")]
-    ])
-
-def payment_confirmation_kb(order_id: int):
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="💳 To‘lov qilish", callback_data=f"pay_{order_id}")],
-        [InlineKeyboardButton(text="❌ Bekor qilish", callback_data="cancel_order")]
-    ])
-
-def admin_order_management_kb(order_id: int):
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Tasdiqlash", callback_data=f"admin_approve_{order_id}")],
-        [InlineKeyboardButton(text="❌ Rad etish", callback_data=f"admin_reject_{order_id}")]
-    ])
-
-def terms_confirmation_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Tasdiqlayman", callback_data="accept_terms")],
-        [InlineKeyboardButton(text="❌ Rad etaman", callback_data="reject_terms")]
-    ])
-
-def payment_done_kb(order_id: int):
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ To‘lov qildim", callback_data=f"payment_done_{order_id}")],
-        [InlineKeyboardButton(text="⬅️ Bosh menyuga", callback_data="back_to_menu")]
-    ])
-
-def contact_user_kb(user_id: int):
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✉️ Xabar yuborish", callback_data=f"contact_user_{user_id}")]
-    ])
-
-def user_chat_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✉️ Admin bilan chat", callback_data="start_chat_with_admin")]
-    ])
-
-def admin_chat_kb(user_id: int):
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✉️ Chatni boshlash", callback_data=f"admin_chat_{user_id}")]
-    ])
-
-def admin_payment_kb(order_id: int):
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ To‘lovni tasdiqlash", callback_data=f"admin_pay_confirm_{order_id}")],
-        [InlineKeyboardButton(text="❌ To‘lovni rad etish", callback_data=f"admin_pay_reject_{order_id}")]
-    ])
-
 # Bot and Dispatcher setup
 bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN))
-dp = Dispatcher(storage=MemoryStorage())
+sender = SendScheduler(global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE, admin_chat_ids=ADMIN_IDS,
+                       processes=WORKER_COUNT)
+bot.session.middleware(RateLimitMiddleware(sender))
+# Instrumentation: handler, Bot API and query latency, scraped from /metrics
+metrics = default_registry()
+bot.session.middleware(ApiMetricsMiddleware(metrics))
+repo.add_observer(db_observer(metrics))
+metrics_server = MetricsServer(metrics, METRICS_HOST, METRICS_PORT + WORKER_INDEX)
+broadcaster = Broadcaster(bot, repo)
+scheduler = TimerScheduler(repo)
+archiver = OrderArchiver(repo, ARCHIVE_AFTER * 86400)
+relay = ChatRelay(bot, repo, ADMIN_ID)
+work = WorkQueue(repo, ADMIN_ID, lease_seconds=WORK_LEASE)
+notifier = AdminNotifier(bot, ADMIN_ID, window=ADMIN_DIGEST_WINDOW, immediate_total=ADMIN_IMMEDIATE_TOTAL)
+storage = SQLiteStorage(repo, ttl=FSM_SESSION_TTL)
+promos = PromoIndex(repo, refresh_interval=PROMO_REFRESH_INTERVAL)
+exporter = OrderExporter(DB_PATH, repo.archive_path)
+dp = Dispatcher(storage=storage)
+dp.update.outer_middleware(CorrelationMiddleware())
+# Floods, double taps and redelivered updates are dropped before any handler runs
+flood = FloodControlMiddleware(
+    sender.queue_length, exempt=ADMIN_IDS, rate=FLOOD_RATE, burst=FLOOD_BURST, max_in_flight=FLOOD_MAX_IN_FLIGHT,
+    max_loop_lag=SHED_LOOP_LAG, max_send_queue=SHED_SEND_QUEUE,
+)
+dp.update.outer_middleware(flood)
+idempotency = IdempotencyMiddleware()
+dp.update.outer_middleware(idempotency)
+dp.update.outer_middleware(PresenceMiddleware(work))
+# All buttons are routed by payload prefix through this single handler
+callbacks = CallbackRouter()
+dp.callback_query.register(callbacks.dispatch)
+for observer in (dp.message, dp.callback_query, dp.chat_member):
+    observer.middleware(HandlerMetricsMiddleware(metrics))
+metrics.gauge("bot_send_queue_length", "Outbound sends waiting for a rate-limit token", ("lane",),
+              lambda: {(name,): lane["queued"] for name, lane in sender.metrics()["lanes"].items()})
+metrics.gauge("bot_db_queue_depth", "Queries waiting for or running on a repository thread", ("kind",),
+              lambda: {(kind,): depth for kind, depth in repo.metrics()["queue_depth"].items()})
+metrics.gauge("bot_membership_cache", "Subscription cache size and hit counters", ("field",),
+              lambda: {(field,): value for field, value in membership.metrics().items()})
+metrics.gauge("bot_fsm_sessions", "FSM sessions held in memory", ("field",),
+              lambda: {(field,): value for field, value in storage.metrics().items()})
+metrics.gauge("bot_admin_digest", "Admin notices waiting for their digest, digests sent and failed, notices lost",
+              ("field",),
+              lambda: {(field,): value for field, value in notifier.metrics().items()})
+metrics.gauge("bot_timers", "Timers loaded for the current horizon, running, fired and failed", ("field",),
+              lambda: {(field,): value for field, value in scheduler.metrics().items()})
+metrics.gauge("bot_idempotency", "Repeated updates and button presses dropped, and keys tracked", ("field",),
+              lambda: {(field,): value for field, value in idempotency.metrics().items()})
+metrics.gauge("bot_flood_control", "Users tracked, load shedding, event-loop lag and updates dropped", ("field",),
+              lambda: {(field,): value for field, value in flood.metrics().items()})
+metrics.counter("bot_stray_messages_total", "Messages no handler or chat relay wanted", ())
+metrics.gauge("bot_work_queue", "Admins on the roster, work items reassigned and claims refused", ("field",),
+              lambda: {(field,): value for field, value in work.metrics().items()})
+metrics.gauge("bot_logging", "Log records waiting for the writer, dropped on a full queue and sampled out", ("field",),
+              lambda: {(field,): value for field, value in logging_metrics().items()})
+metrics.gauge("bot_archive", "Orders moved to the archive, pages vacuumed and the last run's duration", ("field",),
+              lambda: {(field,): value for field, value in archiver.metrics().items()})
+
+@dp.startup()
+async def on_startup():
+    await repo.open()
+    await work.sync(ADMIN_IDS)
+    await promos.refresh()
+    promos.start()
+    storage.start()
+    broadcaster.start(notify_chat_id=ADMIN_ID)
+    scheduler.start()
+    work.start()
+    flood.start()
+    if ARCHIVE_AFTER:
+        archiver.start()
+    if METRICS_PORT:
+        await metrics_server.start()
+
+@dp.shutdown()
+async def on_shutdown():
+    await metrics_server.close()
+    await flood.close()
+    await archiver.close()
+    await broadcaster.close()
+    await scheduler.close()
+    await work.close()
+    await notifier.close()
+    await sender.close()
+    await storage.close()
+    await promos.close()
+    await repo.close()
 
 # Subscription check
+async def fetch_subscription(user_id: int) -> bool:
+    chat_member = await bot.get_chat_member(REQUIRED_CHANNEL, user_id)
+    return chat_member.status in MEMBER_STATUSES
+
+membership = MembershipCache(fetch_subscription, ttl=MEMBERSHIP_TTL, negative_ttl=MEMBERSHIP_NEGATIVE_TTL)
+
 async def check_subscription(user_id: int) -> bool:
     try:
-        chat_member = await bot.get_chat_member(REQUIRED_CHANNEL, user_id)
-        return chat_member.status in ["member", "administrator", "creator"]
+        return await membership.is_member(user_id)
     except Exception as e:
-        logger.error(f"Subscription check failed: {e}")
+        logger.error("Subscription check failed: %s", e)
         return False
 
+def is_required_channel(chat) -> bool:
+    if REQUIRED_CHANNEL.startswith("@"):
+        return (chat.username or "").lower() == REQUIRED_CHANNEL[1:].lower()
+    return str(chat.id) == REQUIRED_CHANNEL
+
+# Membership changes on the channel (delivered only while the bot is a channel admin)
+@dp.chat_member()
+async def channel_member_updated(update: ChatMemberUpdated):
+    if not is_required_channel(update.chat):
+        return
+    user_id = update.new_chat_member.user.id
+    membership.set(user_id, update.new_chat_member.status in MEMBER_STATUSES)
+    logger.info("Membership of user %s changed to %s", user_id, update.new_chat_member.status)
+
 # Handlers
 @dp.message(Command("start"))
 async def cmd_start(message: Message, state: FSMContext):
-    logger.info(f"User {message.from_user.id} sent /start command")
+    logger.info("User %s sent /start command", message.from_user.id)
     if not await check_subscription(message.from_user.id):
         await message.answer(
-            f"Iltimos, avval [kanalga obuna bo‘ling]({REQUIRED_CHANNEL_LINK})!",
-            reply_markup=subscription_kb(),
+            render("subscribe_first", link=REQUIRED_CHANNEL_LINK),
+            reply_markup=subscription_kb(REQUIRED_CHANNEL_LINK),
             parse_mode=ParseMode.MARKDOWN
         )
         return
     await state.clear()
-    terms = (
-        "📋 *FOYDALANISH SHARTLARI*\n\n"
-        "Hurmatli mijoz! Buyurtma berishdan avval quyidagi shartlar bilan tanishib chiqing:\n\n"
-        "🔹 *To‘lov tartibi:*\n"
-        "Buyurtma tasdiqlangach, 25% oldindan to‘lov amalga oshiriladi.\n"
-        "Qolgan 75% ish yakunlangandan so‘ng, yakuniy versiyani taqdim etishdan oldin to‘lanadi.\n\n"
-        "🔹 *Dizaynni o‘zgartirish:*\n"
-        "3 martagacha bepul tahrir (kattaroq o‘zgarishlar emas, faqat kichik tuzatishlar).\n"
-        "3 martadan keyingi har bir o‘zgartirish uchun qo‘shimcha to‘lov olinadi (summasi ish murakkabligiga qarab belgilanadi).\n\n"
-        "🔹 *Muddatlar:*\n"
-        "Har bir buyurtmaning bajarilish muddati uning murakkabligi va mavjud navbatga qarab belgilanadi.\n"
-        "Muddati haqida alohida xabar beriladi.\n\n"
-        "🔹 *Buyurtmadan voz kechish:*\n"
-        "Agar buyurtma bekor qilinsa:\n"
-        "- Ish boshlanmagan bo‘lsa, to‘liq pul qaytariladi.\n"
-        "- Ish boshlangan bo‘lsa, oldindan to‘lov qaytarilmaydi.\n\n"
-        "🔹 *Promokodlar:*\n"
-        "Aksiya yoki promokodlardan faqat bir marta foydalanish mumkin.\n"
-        "Har bir promokodda alohida amal qilish muddati mavjud.\n\n"
-        "🔹 *Materiallar va ma’lumotlar:*\n"
-        "Mijoz topshirgan rasm, matn, logotip kabi materiallar sifatli bo‘lishi lozim.\n"
-        "Noto‘g‘ri yoki sifatsiz ma’lumot sababli kechikishlar uchun mas’uliyat olinmaydi.\n\n"
-        "🔹 *Bog‘lanish:*\n"
-        "Har qanday savollar, aniqlik kiritish yoki holatni kuzatib borish uchun biz bilan bog‘lanishingiz mumkin.\n"
-    )
-    await message.answer(terms, parse_mode=ParseMode.MARKDOWN, reply_markup=terms_confirmation_kb())
+    await message.answer(render("terms"), parse_mode=ParseMode.MARKDOWN, reply_markup=terms_confirmation_kb())
 
-@dp.callback_query(F.data == "accept_terms")
+@callbacks.on("accept_terms")
 async def accept_terms(callback: CallbackQuery, state: FSMContext):
-    logger.info(f"User {callback.from_user.id} accepted the terms")
+    logger.info("User %s accepted the terms", callback.from_user.id)
     await state.update_data(terms_accepted=True)  # <-- Foydalanuvchi qabul qilganini sessionga yozamiz
     await state.set_state(OrderStates.main_menu)
-    await callback.message.edit_text("Xush kelibsiz! Xizmat turini tanlang:", reply_markup=main_menu_kb())
+    await callback.message.edit_text(render("welcome"), reply_markup=main_menu_kb())
 
-@dp.callback_query(F.data == "reject_terms")
+@callbacks.on("reject_terms")
 async def reject_terms(callback: CallbackQuery, state: FSMContext):
-    logger.info(f"User {callback.from_user.id} rejected the terms")
+    logger.info("User %s rejected the terms", callback.from_user.id)
     await callback.message.edit_text("Foydalanish shartlarini rad etdingiz. Xizmatlardan foydalanish uchun shartlarni tasdiqlashingiz kerak.")
 
-@dp.callback_query(F.data == "check_subscription")
+@callbacks.on("check_subscription")
 async def check_subscription_callback(callback: CallbackQuery, state: FSMContext):
-    logger.info(f"User {callback.from_user.id} clicked check_subscription")
+    logger.info("User %s clicked check_subscription", callback.from_user.id)
     if await check_subscription(callback.from_user.id):
         await state.clear()
         await state.set_state(OrderStates.main_menu)
-        await callback.message.edit_text("Xush kelibsiz! Xizmat turini tanlang:", reply_markup=main_menu_kb())
+        await callback.message.edit_text(render("welcome"), reply_markup=main_menu_kb())
     else:
         await callback.message.edit_text(
-            f"Iltimos, avval {REQUIRED_CHANNEL_LINK} kanaliga obuna bo‘ling!",
-            reply_markup=subscription_kb()
+            render("subscribe_again", link=REQUIRED_CHANNEL_LINK),
+            reply_markup=subscription_kb(REQUIRED_CHANNEL_LINK)
         )
 
-@dp.callback_query(F.data == "back_to_menu")
+@callbacks.on("back_to_menu")
 async def back_to_menu(callback: CallbackQuery, state: FSMContext):
-    logger.info(f"User {callback.from_user.id} clicked back_to_menu")
+    logger.info("User %s clicked back_to_menu", callback.from_user.id)
     await state.clear()
     await state.set_state(OrderStates.main_menu)
-    await callback.message.edit_text("Xush kelibsiz! Xizmat turini tanlang:", reply_markup=main_menu_kb())
+    await callback.message.edit_text(render("welcome"), reply_markup=main_menu_kb())
     # The line below that adds "Admin bilan chat" button on every back_to_menu might be excessive.
     # Consider if it should only appear on the initial main menu or under a specific "contact" option.
     # For now, keeping original behavior from the provided snippet.
@@ -240,9 +291,9 @@ async def back_to_menu(callback: CallbackQuery, state: FSMContext):
 
 
 # Handler for "Design" service: After complexity is chosen
-@dp.callback_query(F.data.startswith("complexity_"), OrderStates.waiting_complexity)
-async def design_complexity_selected(callback: CallbackQuery, state: FSMContext):
-    complexity = callback.data.replace("complexity_", "")
+@callbacks.on(ComplexityCallback, state=OrderStates.waiting_complexity)
+async def design_complexity_selected(callback: CallbackQuery, callback_data: ComplexityCallback, state: FSMContext):
+    complexity = callback_data.level
     base_price = COMPLEXITY_PRICES.get(complexity, 100_000) # Default if somehow invalid
     await state.update_data(complexity=complexity, base_price=base_price)
     await state.set_state(OrderStates.waiting_colors)
@@ -262,10 +313,10 @@ async def design_colors_entered(message: Message, state: FSMContext):
     await state.set_state(OrderStates.waiting_details)
     await message.answer("Dizayn uchun qo'shimcha tafsilotlarni yozing:", reply_markup=back_to_menu_kb())
 
-@dp.callback_query(F.data.startswith("service_"))
-async def service_chosen(callback: CallbackQuery, state: FSMContext):
-    logger.info(f"User {callback.from_user.id} chose service: {callback.data}")
-    service = callback.data.replace("service_", "")
+@callbacks.on(ServiceCallback)
+async def service_chosen(callback: CallbackQuery, callback_data: ServiceCallback, state: FSMContext):
+    service = callback_data.service
+    logger.info("User %s chose service: %s", callback.from_user.id, service)
     await state.update_data(service=service)
     if service == "design":
         await state.set_state(OrderStates.waiting_complexity)
@@ -284,18 +335,10 @@ async def service_chosen(callback: CallbackQuery, state: FSMContext):
         await state.set_state(OrderStates.waiting_details)
         await callback.message.edit_text("Buyurtma tafsilotlarini yozing:", reply_markup=back_to_menu_kb())
 
-def target_platform_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Google Ads", callback_data="target_platform_Google Ads")],
-        [InlineKeyboardButton(text="Instagram post", callback_data="target_platform_Instagram post")],
-        [InlineKeyboardButton(text="Facebook Ads", callback_data="target_platform_Facebook Ads")],
-        [InlineKeyboardButton(text="Telegram", callback_data="target_platform_Telegram")],
-        [InlineKeyboardButton(text="Boshqa", callback_data="target_platform_other")]
-    ])
-
-@dp.callback_query(lambda c: c.data.startswith("target_platform_"))
-async def target_platform_callback(callback: CallbackQuery, state: FSMContext):
-    platform = callback.data.replace("target_platform_", "")
+@callbacks.on(PlatformCallback)
+async def target_platform_callback(callback: CallbackQuery, callback_data: PlatformCallback, state: FSMContext):
+    # Old buttons carried the platform name itself rather than a code
+    platform = TARGET_PLATFORMS.get(callback_data.code, callback_data.code)
     if platform == "other":
         await callback.message.edit_text(
             "Platforma yoki auditoriyani yozing (masalan, 'Facebook Ads', 'Telegram', va h.k.):",
@@ -346,7 +389,8 @@ async def general_details_entered(message: Message, state: FSMContext):
     await state.set_state(OrderStates.waiting_promo_choice)
     await message.answer("Promokodingiz bormi?", reply_markup=promo_choice_kb())
 
-@dp.callback_query(F.data.startswith("promo_"))
+@callbacks.on("promo_yes")
+@callbacks.on("promo_no")
 async def promo_choice(callback: CallbackQuery, state: FSMContext):
     if callback.data == "promo_yes":
         await state.set_state(OrderStates.waiting_promo_code)
@@ -354,13 +398,13 @@ async def promo_choice(callback: CallbackQuery, state: FSMContext):
     elif callback.data == "promo_no":
         await state.update_data(promo_code=None, promo_discount=0)
         # Promokodsiz to'g'ridan-to'g'ri to'lov bosqichiga o'tkaziladi
-        await proceed_to_payment(callback.message, state)
+        await proceed_to_payment(callback.message, state, callback.from_user.id)
     else:
         await callback.answer("Noma'lum amal.", show_alert=True)
 
 @dp.message(OrderStates.waiting_promo_code)
 async def promo_code_entered(message: Message, state: FSMContext):
-    logger.info(f"User {message.from_user.id} entered promo code: {message.text}, current state: {await state.get_state()}")
+    logger.info("User %s entered promo code: %s", message.from_user.id, message.text)
     code = message.text.strip()
     if not code:
         await message.answer("Promokod bo‘sh masligi kerak! Iltimos, qayta kiriting:", reply_markup=back_to_menu_kb())
@@ -368,18 +412,18 @@ async def promo_code_entered(message: Message, state: FSMContext):
     if code.startswith('/'):
         await message.answer("Iltimos, promokod sifatida buyruq kiritmang. Promokodni qayta kiriting yoki bosh menyuga qayting:", reply_markup=back_to_menu_kb())
         return
-    discount = PROMO_CODES.get(code.capitalize(), 0)  # Ensure case-insensitive check
-    if not discount:
+    promo = promos.get(code)  # case-insensitive, served from memory
+    if promo is None:
         await message.answer("Noto‘g‘ri promokod! Iltimos, qayta kiriting yoki bekor qiling:", reply_markup=back_to_menu_kb())
         return
-    await state.update_data(promo_code=code, promo_discount=discount)
-    logger.info(f"Valid promo code {code} entered by user {message.from_user.id}, proceeding to payment")
-    await proceed_to_payment(message, state)
+    await state.update_data(promo_code=promo.code, promo_discount=promo.discount)
+    logger.info("Valid promo code %s entered by user %s, proceeding to payment", promo.code, message.from_user.id)
+    await proceed_to_payment(message, state, message.from_user.id)
 
 # 2. To'lovdan faqat 25% oldindan olinadi, buyurtma cheki va admin xabari ham shunga mos bo'ladi
-async def proceed_to_payment(message: Message, state: FSMContext):
+async def proceed_to_payment(message: Message, state: FSMContext, user_id: int):
+    # user_id is passed in: when called from a button, message is the bot's own message
     data = await state.get_data()
-    user_id = message.from_user.id
     service = data.get("service", "")
     details = data.get("details", "")
     colors = data.get("colors", "")
@@ -400,81 +444,87 @@ async def proceed_to_payment(message: Message, state: FSMContext):
     else:
         service_line = service
 
+    timers = unpaid_order_timers(timestamp)
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            c = conn.cursor()
-            c.execute("""
-                INSERT INTO orders (user_id, service, details, colors, complexity, promo_code, promo_discount, referral_discount, total_price, timestamp, status, payment_status)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending', 'pending')
-            """, (user_id, service_line, details, colors, complexity, promo_code, promo_discount, referral_discount, total_price, timestamp))
-            order_id = c.lastrowid
-            conn.commit()
+        order_id = await repo.create_order(
+            user_id, service_line, details, colors, complexity, promo_code, promo_discount, referral_discount, total_price, timestamp,
+            timers=timers,
+        )
+    except PromoUnavailable as e:
+        logger.info("User %s could not redeem promo code %s: %s", user_id, e.code, e.reason)
+        await state.update_data(promo_code=None, promo_discount=0)
+        await state.set_state(OrderStates.waiting_promo_code)
+        await message.answer(render(f"promo_{e.reason}"), reply_markup=back_to_menu_kb())
+        return
     except Exception as e:
-        logger.error(f"Database error: {e}")
+        logger.error("Database error: %s", e)
         await message.answer("Xatolik yuz berdi, iltimos qayta urinib ko‘ring.")
         return
 
     complexity_str = complexity.capitalize() if complexity else "—"
     colors_str = colors if colors else "—"
 
-    text = (
-        f"\U0001F9FE *Buyurtma Cheki*\n\n"
-        f"🆔 Buyurtma ID: {order_id}\n"
-        f"👤 ID: {user_id}\n"
-        f"🔧 Xizmat: {service_line}\n"
-        f"🎨 Ranglar: {colors_str}\n"
-        f"📋 Talablar: {details}\n"
-        f"📈 Murakkablik: {complexity_str}\n"
-        f"🎟️ Promokod: {promo_code or 'yo‘q'}\n"
-        f"💸 Chegirma: {int(total_discount*100)}%\n"
-        f"💰 Umumiy narx: {total_price} so‘m\n"
-        f"💳 Oldindan to‘lov (25%): {upfront_price} so‘m\n\n"
-        f"✅ Buyurtmani tasdiqlang va 25% oldindan to‘lovni amalga oshiring.\n"
-        f"Qolgan 75% ish tugagach to‘lanadi."
+    text = render(
+        "receipt",
+        order_id=order_id,
+        user_id=user_id,
+        service=service_line,
+        colors=colors_str,
+        details=details,
+        complexity=complexity_str,
+        promo_code=promo_code or render("no_promo"),
+        discount_percent=int(total_discount * 100),
+        total_price=total_price,
+        upfront_price=upfront_price,
     )
     await state.update_data(order_id=order_id, total_price=total_price, upfront_price=upfront_price)
     await state.set_state(OrderStates.waiting_payment_confirmation)
     await message.answer(text, reply_markup=payment_confirmation_kb(order_id))
-    await bot.send_message(
-        ADMIN_ID,
-        text + "\n\nAdmin tasdiqlashi kutilmoqda:",
-        reply_markup=admin_order_management_kb(order_id)
-    )
-
-@dp.callback_query(F.data.startswith("pay_"))
-async def process_payment(callback: CallbackQuery, state: FSMContext):
-    order_id = int(callback.data.split("_")[1])
+    for _, due_at in timers:
+        scheduler.armed(due_at)
+    entry = render("admin_digest_entry", order_id=order_id, user_id=user_id, service=service_line,
+                   total_price=total_price, details=short(details, 100))
+    notice = {"user_id": user_id, "text": text, "entry": entry, "total_price": total_price}
+    admin_id = await assign_work(order_id, WORK_ORDER, notice)
+    if admin_id is not None:
+        await notifier.order(order_id, user_id, text, entry, total_price, chat_id=admin_id)
+
+@callbacks.on(OrderCallback, action=OrderAction.PAY)
+async def process_payment(callback: CallbackQuery, callback_data: OrderCallback, state: FSMContext):
+    order_id = callback_data.order_id
     data = await state.get_data()
     total_price = data.get("total_price", 0)
+    if data.get("order_id") != order_id:
+        # Pressed on a reminder or an older message: the session holds another order, if any
+        order = await repo.order_brief(order_id)
+        total_price = order[3] if order else 0
 
     card_number = "9860 3501 4351 9071"  # Replace with your actual card number
     payment_url = f"https://click.uz/pay?order_id={order_id}&amount={total_price}"  # Example Click payment URL
 
     try:
-        text = (
-            f"💳 To‘lov uchun karta raqami: `{card_number}`\n\n"
-            f"Yoki quyidagi havola orqali to‘lovni amalga oshiring:\n"
-            f"[To‘lov qilish]({payment_url})\n\n"
-            f"💰 To‘lov miqdori: {total_price} so‘m\n\n"
-            f"To‘lovni amalga oshirgach, pastdagi \"To‘lov qildim\" tugmasini bosing va to‘lov chekini yuboring."
-        )
+        result = await repo.start_payment(order_id, actor=callback.from_user.id)
+        if result is not None and not result[1]:
+            # Pressed again: the details are shown while the payment is open; paid, reviewed or cancelled orders are closed
+            order = await repo.order_brief(order_id)
+            result = result[0], order[1:3] == ("pending", "processing")
+        if result is None or not result[1]:
+            await callback.message.edit_text(render("order_closed"), reply_markup=back_to_menu_kb())
+            return
+        text = render("payment_instructions", card_number=card_number, payment_url=payment_url, total_price=total_price)
         await callback.message.edit_text(
             text,
             reply_markup=payment_done_kb(order_id),
             parse_mode=ParseMode.MARKDOWN
         )
-        with sqlite3.connect(DB_PATH) as conn:
-            c = conn.cursor()
-            c.execute("UPDATE orders SET payment_status = 'processing' WHERE id = ?", (order_id,))
-            conn.commit()
     except Exception as e:
-        logger.error(f"Payment error: {e}")
+        logger.error("Payment error: %s", e)
         await callback.message.edit_text("To‘lov jarayonida xatolik yuz berdi. Iltimos, qayta urinib ko‘ring.", reply_markup=back_to_menu_kb())
     # Do not clear state yet; wait for payment confirmation
 
-@dp.callback_query(F.data.startswith("payment_done_"))
-async def payment_done(callback: CallbackQuery, state: FSMContext):
-    order_id = int(callback.data.split("_")[2])
+@callbacks.on(OrderCallback, action=OrderAction.PAID)
+async def payment_done(callback: CallbackQuery, callback_data: OrderCallback, state: FSMContext):
+    order_id = callback_data.order_id
     await state.update_data(waiting_receipt_order_id=order_id)
     await callback.message.edit_text(
         "Iltimos, to‘lov chekini rasm yoki fayl ko‘rinishida shu yerga yuboring.",
@@ -489,159 +539,607 @@ async def receive_receipt_handler(message: Message, state: FSMContext):
     if not (message.photo or message.document):
         await message.answer("Iltimos, to‘lov chekini rasm yoki fayl sifatida yuboring.")
         return
-    caption = f"🧾 To‘lov cheki\nBuyurtma ID: {order_id}\nFoydalanuvchi: {message.from_user.id}"
-    if message.photo:
-        await bot.send_photo(
-            ADMIN_ID, message.photo[-1].file_id, caption=caption, reply_markup=admin_payment_kb(order_id)
-        )
-    elif message.document:
-        await bot.send_document(
-            ADMIN_ID, message.document.file_id, caption=caption, reply_markup=admin_payment_kb(order_id)
-        )
+    caption = render("receipt_caption", order_id=order_id, user_id=message.from_user.id)
+    file_id = message.photo[-1].file_id if message.photo else message.document.file_id
+    notice = {"file_id": file_id, "is_photo": bool(message.photo), "caption": caption, "total_price": data.get("total_price", 0)}
+    try:
+        result = await repo.submit_receipt(order_id, review_timers(time.time()), actor=message.from_user.id) if order_id else None
+        # Not applied may still be a second receipt for an order under review, which is queued again;
+        # the queue refuses it once the order is paid, cancelled or expired
+        admin_id = await assign_work(order_id, WORK_RECEIPT, notice) if result is not None else None
+    except Exception as e:
+        logger.error("Receipt status error for order %s, sending it to the owner: %s", order_id, e)
+        admin_id = ADMIN_ID
+    if admin_id is None:
+        # Nobody reviews receipts of closed orders: the owner gets a copy to sort out by hand
+        logger.info("Receipt from user %s for closed order %s", message.from_user.id, order_id)
+        send = bot.send_photo if message.photo else bot.send_document
+        try:
+            await send(ADMIN_ID, file_id,
+                       caption=render("receipt_closed_caption", order_id=order_id or "—", user_id=message.from_user.id))
+        except Exception as e:
+            logger.error("Could not pass the receipt for closed order %s to the owner: %s", order_id, e)
+        await message.answer(render("receipt_order_closed"), reply_markup=user_chat_kb())
+        await state.clear()
+        return
+    await notifier.receipt(order_id, file_id, bool(message.photo), caption, notice["total_price"], chat_id=admin_id)
     await message.answer("To‘lov cheki qabul qilindi. Tez orada buyurtmangiz ko‘rib chiqiladi.", reply_markup=back_to_menu_kb())
     await state.clear()
 
-@dp.callback_query(F.data.startswith("admin_pay_confirm_"))
-async def admin_pay_confirm(callback: CallbackQuery):
-    if callback.from_user.id != ADMIN_ID:
-        await callback.message.answer("Sizda admin huquqlari yo‘q!")
-        return
-    order_id = int(callback.data.split("_")[-1])
+# Admin work queue: notices go to the least-loaded admin, who keeps them while active
+async def assign_work(order_id: int, kind: str, notice: dict):
+    # -> the admin to notify; None when the order moved on before its notice went out
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            c = conn.cursor()
-            c.execute("UPDATE orders SET payment_status = 'paid', status = 'in_progress' WHERE id = ?", (order_id,))
-            conn.commit()
-            c.execute("SELECT user_id FROM orders WHERE id = ?", (order_id,))
-            user_id = c.fetchone()[0]
+        return await work.enqueue(order_id, kind, notice)
     except Exception as e:
-        logger.error(f"Admin payment confirm error: {e}")
-        await callback.message.edit_text("To‘lovni tasdiqlashda xatolik yuz berdi.")
-        return
-    await callback.message.edit_text("To‘lov tasdiqlandi va buyurtma bajarilish bosqichiga o'tdi.")
-    await bot.send_message(
-        user_id,
-        "✅ To‘lovingiz tasdiqlandi!\n\n"
-        "Buyurtmangiz tayyorlash jarayoniga yuborildi.\n"
-        "⏳ *Taxminiy kutish vaqti*: 1-3 ish kuni (aniq muddat buyurtma murakkabligiga qarab belgilanadi).\n"
-        "Jarayon haqida savollaringiz bo‘lsa, admin bilan bog‘lanishingiz mumkin.",
-        parse_mode=ParseMode.MARKDOWN
-    )
+        logger.error("Could not queue %s of order %s, sending it to the owner: %s", kind, order_id, e)
+        return ADMIN_ID
 
-@dp.callback_query(F.data.startswith("admin_pay_reject_"))
-async def admin_pay_reject(callback: CallbackQuery):
-    if callback.from_user.id != ADMIN_ID:
-        await callback.message.answer("Sizda admin huquqlari yo‘q!")
-        return
-    order_id = int(callback.data.split("_")[-1])
+async def claim_work(callback: CallbackQuery, order_id: int, kind: str) -> bool:
+    # False when another admin is already on this order notice or receipt; they are named in a popup
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            c = conn.cursor()
-            c.execute("UPDATE orders SET payment_status = 'rejected' WHERE id = ?", (order_id,))
-            conn.commit()
-            c.execute("SELECT user_id FROM orders WHERE id = ?", (order_id,))
-            user_id = c.fetchone()[0]
+        holder = await work.claim(order_id, kind, callback.from_user.id)
     except Exception as e:
-        logger.error(f"Admin payment reject error: {e}")
-        await callback.message.edit_text("To‘lovni rad etishda xatolik yuz berdi.")
-        return
-    await callback.message.edit_text("To‘lov rad etildi.")
-    await bot.send_message(
-        user_id,
-        "❌ To‘lovingiz rad etildi. Iltimos, to‘lovni qayta yuboring yoki admin bilan bog‘laning."
+        logger.error("Work claim failed for order %s: %s", order_id, e)
+        return True  # the status change is compare-and-set, so settling twice is still impossible
+    if holder is None:
+        return True
+    await callback.answer(render("work_taken", order_id=order_id, admin_id=holder), show_alert=True)
+    return False
+
+@work.on(WORK_ORDER)
+async def reassign_order(order_id: int, admin_id: int, notice: dict, previous: int):
+    await bot.send_message(admin_id, render("work_reassigned", order_id=order_id, admin_id=previous))
+    await notifier.order(order_id, notice["user_id"], notice["text"], notice["entry"], notice["total_price"],
+                         chat_id=admin_id)
+
+@work.on(WORK_RECEIPT)
+async def reassign_receipt(order_id: int, admin_id: int, notice: dict, previous: int):
+    await bot.send_message(admin_id, render("work_reassigned", order_id=order_id, admin_id=previous))
+    await notifier.receipt(order_id, notice["file_id"], notice["is_photo"], notice["caption"], notice["total_price"],
+                           chat_id=admin_id)
+
+@notifier.on_undelivered
+async def release_undelivered(kind: str, order_id: int):
+    await work.release(order_id, WORK_ORDER if kind == "orders" else WORK_RECEIPT)
+
+async def settle_admin_message(callback: CallbackQuery, order_id: int, result: str):
+    # A digest carries buttons for other orders too: drop only this order's row and report in a popup
+    remaining = digest_without(callback.message.reply_markup, order_id)
+    if remaining is not None:
+        await callback.message.edit_reply_markup(reply_markup=remaining if remaining.inline_keyboard else None)
+        await callback.answer(result)
+    elif callback.message.text is None:  # a receipt photo or document sent on its own
+        await callback.message.edit_caption(caption=result)
+    else:
+        await callback.message.edit_text(result)
+
+async def admin_settle(callback: CallbackQuery, order_id: int, kind: str, change, done: str, failed: str):
+    # Runs an admin's compare-and-set status change on the order's work item of this kind;
+    # -> the customer to tell once it applied, else None
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.message.answer(render("not_admin"))
+        return None
+    if not await claim_work(callback, order_id, kind):
+        return None
+    try:
+        result = await change()
+        if result is None:
+            raise LookupError(f"Order {order_id} not found")
+    except Exception as e:
+        logger.error("Admin change of order %s failed: %s", order_id, e)
+        await settle_admin_message(callback, order_id, failed)
+        return None
+    user_id, applied = result
+    if not applied:
+        await settle_admin_message(callback, order_id, render("order_already_settled", order_id=order_id))
+        return None
+    await settle_admin_message(callback, order_id, done)
+    return user_id
+
+@callbacks.on(PaymentCallback, action=PaymentAction.CONFIRM)
+async def admin_pay_confirm(callback: CallbackQuery, callback_data: PaymentCallback):
+    order_id = callback_data.order_id
+    user_id = await admin_settle(
+        callback, order_id, WORK_RECEIPT, lambda: repo.confirm_payment(order_id, actor=callback.from_user.id),
+        "To‘lov tasdiqlandi va buyurtma bajarilish bosqichiga o'tdi.", "To‘lovni tasdiqlashda xatolik yuz berdi.",
     )
+    if user_id is not None:
+        await bot.send_message(
+            user_id,
+            render("payment_confirmed"),
+            parse_mode=ParseMode.MARKDOWN
+        )
+
+@callbacks.on(PaymentCallback, action=PaymentAction.REJECT)
+async def admin_pay_reject(callback: CallbackQuery, callback_data: PaymentCallback):
+    order_id = callback_data.order_id
+    # The customer gets another full period to pay before the order expires
+    user_id = await admin_settle(
+        callback, order_id, WORK_RECEIPT,
+        lambda: repo.reject_payment(order_id, expiry_timers(time.time()), actor=callback.from_user.id),
+        "To‘lov rad etildi.", "To‘lovni rad etishda xatolik yuz berdi.",
+    )
+    if user_id is not None:
+        await bot.send_message(
+            user_id,
+            render("payment_rejected")
+        )
 
-@dp.callback_query(F.data == "cancel_order")
+# Order notices and /admin pages: approving accepts the order, which still waits for its payment; rejecting cancels it
+@callbacks.on(AdminCallback, action=AdminAction.APPROVE)
+async def admin_approve_order(callback: CallbackQuery, callback_data: AdminCallback):
+    order_id = callback_data.target_id
+    user_id = await admin_settle(
+        callback, order_id, WORK_ORDER, lambda: repo.approve_order(order_id, actor=callback.from_user.id),
+        "Buyurtma tasdiqlandi, mijoz to‘lovi kutilmoqda.", "Buyurtmani tasdiqlashda xatolik yuz berdi.",
+    )
+    if user_id is not None:
+        await bot.send_message(
+            user_id, render("order_approved", order_id=order_id), reply_markup=payment_reminder_kb(order_id)
+        )
+
+@callbacks.on(AdminCallback, action=AdminAction.REJECT)
+async def admin_reject_order(callback: CallbackQuery, callback_data: AdminCallback):
+    order_id = callback_data.target_id
+    user_id = await admin_settle(
+        callback, order_id, WORK_ORDER, lambda: repo.cancel_order(order_id, actor=callback.from_user.id),
+        "Buyurtma rad etildi va bekor qilindi.", "Buyurtmani rad etishda xatolik yuz berdi.",
+    )
+    if user_id is not None:
+        await bot.send_message(user_id, render("order_rejected", order_id=order_id), reply_markup=user_chat_kb())
+
+@callbacks.on("cancel_order")
 async def cancel_order(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     order_id = data.get("order_id")
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            c = conn.cursor()
-            c.execute("UPDATE orders SET status = 'cancelled' WHERE id = ?", (order_id,))
-            conn.commit()
+        result = await repo.cancel_order(order_id, actor=callback.from_user.id) if order_id else None
     except Exception as e:
-        logger.error(f"Cancel order error: {e}")
+        logger.error("Cancel order error: %s", e)
         await callback.message.edit_text("Buyurtmani bekor qilishda xatolik yuz berdi.")
         return
+    if result is None or not result[1]:
+        await callback.message.edit_text(render("order_closed"), reply_markup=back_to_menu_kb())
+        return
     await callback.message.edit_text("Buyurtma bekor qilindi.", reply_markup=back_to_menu_kb())
     await state.clear()
 
-@dp.callback_query(F.data == "my_orders")
-async def show_my_orders(callback: CallbackQuery, state: FSMContext):
+# Timers: payment reminders, expiry of unpaid orders and admin nudges for unreviewed receipts
+def expiry_timers(now: float) -> list:
+    return [(TIMER_ORDER_EXPIRY, now + ORDER_EXPIRY_AFTER)] if ORDER_EXPIRY_AFTER else []
+
+def unpaid_order_timers(placed_at: float) -> list:
+    reminders = [(TIMER_PAYMENT_REMINDER, placed_at + PAYMENT_REMINDERS[0])] if PAYMENT_REMINDERS else []
+    return reminders + expiry_timers(placed_at)
+
+def review_timers(now: float) -> list:
+    return [(TIMER_RECEIPT_REVIEW, now + RECEIPT_NUDGE_AFTER)] if RECEIPT_NUDGE_AFTER else []
+
+@scheduler.on(TIMER_PAYMENT_REMINDER)
+async def payment_reminder(order_id: int, attempt: int):
+    order = await repo.order_brief(order_id)
+    if order is None or order[1] != "pending" or order[2] not in UNPAID_STATUSES:
+        return None
+    try:
+        await bot.send_message(
+            order[0], render("payment_reminder", order_id=order_id, total_price=order[3]),
+            reply_markup=payment_reminder_kb(order_id)
+        )
+    except TelegramForbiddenError:
+        return None  # blocked the bot; expiry still cleans the order up
+    if attempt + 1 < len(PAYMENT_REMINDERS):
+        return PAYMENT_REMINDERS[attempt + 1] - PAYMENT_REMINDERS[attempt]
+    return None
+
+@scheduler.on(TIMER_ORDER_EXPIRY)
+async def order_expiry(order_id: int, attempt: int):
+    user_id = await repo.expire_order(order_id)
+    if user_id is None:
+        return None
+    logger.info("Order %s expired unpaid", order_id)
+    try:
+        await bot.send_message(user_id, render("order_expired", order_id=order_id), reply_markup=back_to_menu_kb())
+    except TelegramForbiddenError:
+        pass
+    return None
+
+@scheduler.on(TIMER_RECEIPT_REVIEW)
+async def receipt_review_nudge(order_id: int, attempt: int):
+    order = await repo.order_brief(order_id)
+    if order is None or order[1] != "pending" or order[2] not in ("review", "processing"):
+        return None
+    admin_id = await work.assignee(order_id, WORK_RECEIPT) or ADMIN_ID
+    await bot.send_message(
+        admin_id, render("receipt_nudge", order_id=order_id, total_price=order[3]),
+        reply_markup=admin_payment_kb(order_id)
+    )
+    return RECEIPT_NUDGE_AFTER if attempt + 1 < RECEIPT_NUDGES else None
+
+def short(text: str, limit: int = 60) -> str:
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+def my_orders_text(orders) -> str:
+    text = render("my_orders_title") + "".join(
+        render("my_orders_entry", order_id=order[0], service=short(order[1] or "—"),
+               total_price=order[2], status=(order[3] or "").capitalize())
+        for order in orders
+    )
+    return text.strip()
+
+def admin_orders_text(orders) -> str:
+    text = render("admin_orders_title") + "".join(
+        render("admin_orders_entry", order_id=order[0], user_id=order[1], service=short(order[2] or "—"),
+               total_price=order[3], status=(order[4] or "").capitalize())
+        for order in orders
+    )
+    return text.strip()
+
+async def send_my_orders_page(callback: CallbackQuery, cursor=None, backward: bool = False):
     user_id = callback.from_user.id
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            c = conn.cursor()
-            c.execute("SELECT id, service, total_price, status FROM orders WHERE user_id = ? ORDER BY timestamp DESC", (user_id,))
-            orders = c.fetchall()
+        orders, has_prev, has_next = await repo.user_orders_page(user_id, cursor, backward, MY_ORDERS_PAGE_SIZE)
+        if not orders and cursor:
+            # The page we pointed at is gone; start over from the newest orders
+            orders, has_prev, has_next = await repo.user_orders_page(user_id, limit=MY_ORDERS_PAGE_SIZE)
     except sqlite3.Error as e:
-        logger.error(f"Error fetching orders for user {user_id}: {e}")
-        await callback.message.edit_text("Buyurtmalarni ko‘rishda xatolik yuz berdi. Iltimos, keyinroq qayta urinib ko‘ring.")
+        logger.error("Error fetching orders for user %s: %s", user_id, e)
+        await callback.message.edit_text(render("db_error"))
         return
 
     if not orders:
-        await callback.message.edit_text("Sizda hali buyurtmalar yo‘q.", reply_markup=back_to_menu_kb())
+        await callback.message.edit_text(render("no_orders"), reply_markup=back_to_menu_kb())
         return
+    await callback.message.edit_text(my_orders_text(orders), reply_markup=my_orders_kb(orders, has_prev, has_next))
 
-    text = "📋 *Sizning Buyurtmalaringiz*\n\n"
-    for order in orders:
-        text += (
-            f"🆔 Buyurtma ID: {order[0]}\n"
-            f"🔧 Xizmat: {order[1]}\n"
-            f"💰 Narx: {order[2]} so‘m\n"
-            f"📈 Holat: {order[3].capitalize()}\n\n"
-        )
-    await callback.message.edit_text(text.strip(), reply_markup=back_to_menu_kb())
+@callbacks.on("my_orders")
+async def show_my_orders(callback: CallbackQuery):
+    await send_my_orders_page(callback)
+
+@callbacks.on(PageCallback)
+async def show_page(callback: CallbackQuery, callback_data: PageCallback):
+    cursor = (callback_data.timestamp, callback_data.order_id)
+    if callback_data.view == PageView.MY_ORDERS:
+        await send_my_orders_page(callback, cursor, callback_data.backward)
+    else:
+        await admin_panel_page(callback, cursor, callback_data.backward)
 
 @dp.message(Command("admin"))
 async def admin_panel(message: Message):
-    if message.from_user.id != ADMIN_ID:
-        await message.answer("Sizda admin huquqlari yo‘q!")
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer(render("not_admin"))
         return
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            c = conn.cursor()
-            c.execute("SELECT id, user_id, service, total_price, status FROM orders WHERE status = 'pending' ORDER BY timestamp ASC")
-            orders = c.fetchall()
+        orders, has_prev, has_next = await repo.pending_orders_page(limit=ADMIN_PAGE_SIZE)
     except sqlite3.Error as e:
-        logger.error(f"Admin panel error: {e}")
-        await message.answer("Buyurtmalarni ko‘rishda xatolik yuz berdi. Iltimos, keyinroq qayta urinib ko‘ring.")
+        logger.error("Admin panel error: %s", e)
+        await message.answer(render("db_error"))
         return
 
     if not orders:
-        await message.answer("Hozirda tasdiqlanmagan buyurtmalar yo‘q.")
+        await message.answer(render("no_pending_orders"))
         return
+    await message.answer(admin_orders_text(orders), reply_markup=admin_orders_kb(orders, has_prev, has_next))
 
-    for order in orders:
-        text = (
-            f"🆔 Buyurtma ID: {order[0]}\n"
-            f"👤 Foydalanuvchi ID: {order[1]}\n"
-            f"🔧 Xizmat: {order[2]}\n"
-            f"💰 Narx: {order[3]} so‘m\n"
-            f"📈 Holat: {order[4].capitalize()}\n"
-        )
-        await message.answer(
-            text.strip(),
-            reply_markup=admin_order_management_kb(order[0])
-        )
-        await message.answer(
-            f"Foydalanuvchi bilan chat: {order[1]}",
-            reply_markup=admin_chat_kb(order[1])
-        )
+async def admin_panel_page(callback: CallbackQuery, cursor, backward: bool):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.message.answer(render("not_admin"))
+        return
+    try:
+        orders, has_prev, has_next = await repo.pending_orders_page(cursor, backward, ADMIN_PAGE_SIZE)
+        if not orders and cursor:
+            orders, has_prev, has_next = await repo.pending_orders_page(limit=ADMIN_PAGE_SIZE)
+    except sqlite3.Error as e:
+        logger.error("Admin panel error: %s", e)
+        await callback.message.edit_text(render("db_error"))
+        return
+
+    if not orders:
+        await callback.message.edit_text(render("no_pending_orders"))
+        return
+    await callback.message.edit_text(admin_orders_text(orders), reply_markup=admin_orders_kb(orders, has_prev, has_next))
+
+@dp.message(Command("broadcast"))
+async def broadcast_command(message: Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer(render("not_admin"))
+        return
+    if not command.args:
+        rows = await broadcaster.status()
+        lines = ["Foydalanish: /broadcast <matn>", "To‘xtatish: /broadcast_stop <id>"]
+        for row in rows:
+            lines.append(f"#{row[0]} {row[1]}: yuborildi {row[2]}, xato {row[3]}, bloklagan {row[4]}")
+        await message.answer("\n".join(lines), parse_mode=None)
+        return
+    broadcast_id = await broadcaster.launch(command.args, notify_chat_id=message.chat.id)
+    logger.info("Admin %s started broadcast %s", message.from_user.id, broadcast_id)
+    await message.answer(f"📣 Xabarnoma #{broadcast_id} boshlandi. Holatini /broadcast orqali kuzating.")
+
+@dp.message(Command("broadcast_stop"))
+async def broadcast_stop_command(message: Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer(render("not_admin"))
+        return
+    if not command.args or not command.args.strip().isdigit():
+        await message.answer("Foydalanish: /broadcast_stop <id>")
+        return
+    if await broadcaster.cancel(int(command.args)):
+        await message.answer("Xabarnoma to‘xtatildi.")
+    else:
+        await message.answer("Bunday faol xabarnoma topilmadi.")
+
+@dp.message(Command("promo"))
+async def promo_command(message: Message, command: CommandObject):
+    # /promo | /promo add <kod> <foiz> [kun] [limit] | /promo off <kod>
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer(render("not_admin"))
+        return
+    args = (command.args or "").split()
+    if args[:1] == ["add"] and 3 <= len(args) <= 5 and all(a.isdigit() for a in args[2:]) and 0 < int(args[2]) <= 100:
+        code, percent = args[1], int(args[2])
+        expires_at = int(time.time()) + int(args[3]) * 86400 if len(args) > 3 and int(args[3]) else None
+        max_uses = int(args[4]) if len(args) > 4 else None
+        await promos.add(code, percent / 100, expires_at, max_uses)
+        logger.info("Admin %s saved promo code %s (%s%%)", message.from_user.id, code, percent)
+        await message.answer(f"Promokod {code} saqlandi: {percent}%.", parse_mode=None)
+    elif args[:1] == ["off"] and len(args) == 2:
+        if await promos.disable(args[1]):
+            await message.answer(f"Promokod {args[1]} o‘chirildi.", parse_mode=None)
+        else:
+            await message.answer("Bunday faol promokod topilmadi.")
+    elif not args:
+        lines = ["Foydalanish: /promo add <kod> <foiz> [kun] [limit], /promo off <kod>"]
+        for promo in await promos.listing():
+            expires = time.strftime("%Y-%m-%d", time.localtime(promo.expires_at)) if promo.expires_at else "—"
+            limit = promo.max_uses if promo.max_uses is not None else "∞"
+            status = "faol" if promo.active else "o‘chirilgan"
+            lines.append(f"{promo.code}: {int(promo.discount * 100)}%, {promo.uses}/{limit}, muddat {expires}, {status}")
+        await message.answer("\n".join(lines), parse_mode=None)
+    else:
+        await message.answer("Foydalanish: /promo add <kod> <foiz> [kun] [limit], /promo off <kod>", parse_mode=None)
+
+def money(amount: int) -> str:
+    return f"{amount:,} so‘m".replace(",", " ")
+
+def duration(seconds) -> str:
+    if seconds is None:
+        return "—"
+    if seconds < 60:
+        return f"{seconds:.0f} son"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f} daq"
+    if seconds < 86400:
+        return f"{seconds / 3600:.1f} soat"
+    return f"{seconds / 86400:.1f} kun"
+
+# States whose waiting times /stats reports, from the order_events log
+STATE_LABELS = {
+    ("pending", "pending"): "To‘lov boshlanishi",
+    ("pending", "processing"): "Chek yuborilishi",
+    ("pending", "review"): "Chek ko‘rib chiqilishi",
+}
+
+def time_in_state_line(label: str, summary: dict) -> str:
+    return (
+        f"{label}: p50 {duration(summary['p50'])}, p90 {duration(summary['p90'])}, p99 {duration(summary['p99'])} "
+        f"({summary['count']} ta); kutmoqda {summary['waiting']}, eng uzoq {duration(summary['longest_waiting'])}"
+    )
 
-@dp.callback_query(F.data.startswith("admin_chat_"))
-async def admin_start_chat(callback: CallbackQuery, state: FSMContext):
-    if callback.from_user.id != ADMIN_ID:
-        await callback.message.answer("Sizda admin huquqlari yo‘q!")
+def funnel_line(label: str, totals: Counter) -> str:
+    conversion = f"{totals['paid'] * 100 // totals['orders']}%" if totals["orders"] else "—"
+    return (
+        f"{label}: {totals['orders']} → {totals['paid']} → {totals['in_progress']} ({conversion}), "
+        f"bekor {totals['cancelled']}; tushum {money(totals['revenue'])}, oldindan {money(totals['upfront'])}"
+    )
+
+@dp.message(Command("stats"))
+async def stats_command(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer(render("not_admin"))
+        return
+    today = rollup_day(time.time())
+    try:
+        rows = await repo.order_rollups(today - STATS_DAYS + 1)
+        waits = await repo.time_in_state(STATE_LABELS, time.time() - STATS_DAYS * 86400)
+    except sqlite3.Error as e:
+        logger.error("Stats error: %s", e)
+        await message.answer(render("db_error"))
+        return
+    # Rollup rows are per day and service, so this loop is bounded by STATS_DAYS x services
+    by_day, by_service = {}, {}
+    for day, service, *values in rows:
+        figures = dict(zip(ROLLUP_TERMS, values))
+        by_day.setdefault(day, Counter()).update(figures)
+        by_service.setdefault(service or "—", Counter()).update(figures)
+    week = sum(by_day.values(), Counter())
+    lines = [
+        "📊 Statistika (buyurtma → to‘langan → bajarilmoqda)",
+        funnel_line("Bugun", by_day.get(today, Counter())),
+        funnel_line(f"{STATS_DAYS} kun", week),
+        "\nKunlar bo‘yicha:",
+    ]
+    for day in sorted(by_day, reverse=True):
+        lines.append(funnel_line(time.strftime("%d.%m", time.gmtime(day * 86400)), by_day[day]))
+    lines.append(f"\nXizmatlar bo‘yicha ({STATS_DAYS} kun):")
+    for service, totals in sorted(by_service.items(), key=lambda item: -item[1]["revenue"]):
+        lines.append(funnel_line(service, totals))
+    lines.append(f"\nHolatda kutish ({STATS_DAYS} kun):")
+    for state, label in STATE_LABELS.items():
+        lines.append(time_in_state_line(label, waits[state]))
+    await message.answer("\n".join(lines), parse_mode=None)
+
+EXPORT_USAGE = "Foydalanish: /export [csv|jsonl] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [status=pending|in_progress|cancelled]"
+
+def parse_export_args(args: str):
+    # -> (fmt, since, until, status); dates are Tashkent calendar days, "to" is inclusive
+    fmt, since, until, status = "csv", None, None, None
+    for arg in (args or "").split():
+        key, _, value = arg.partition("=")
+        if not value and key in FORMATS:
+            fmt = key
+        elif key in ("from", "to"):
+            day_start = calendar.timegm(time.strptime(value, "%Y-%m-%d")) - ROLLUP_UTC_OFFSET
+            if key == "from":
+                since = day_start
+            else:
+                until = day_start + 86400
+        elif key == "status" and value:
+            status = value
+        else:
+            raise ValueError(f"Unknown export argument {arg!r}")
+    return fmt, since, until, status
+
+@dp.message(Command("export"))
+async def export_command(message: Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer(render("not_admin"))
+        return
+    try:
+        fmt, since, until, status = parse_export_args(command.args)
+    except ValueError:
+        await message.answer(EXPORT_USAGE, parse_mode=None)
+        return
+    if exporter.busy:
+        await message.answer("Eksport allaqachon bajarilmoqda, iltimos kuting.")
+        return
+    await message.answer("⏳ Eksport tayyorlanmoqda...")
+    try:
+        path, count = await exporter.export(fmt, since, until, status)
+    except sqlite3.Error as e:
+        logger.error("Export error: %s", e)
+        await message.answer(render("db_error"))
+        return
+    try:
+        if os.path.getsize(path) > MAX_UPLOAD_BYTES:
+            await message.answer("Fayl Telegram uchun juda katta (50 MB dan ortiq). Sana oralig‘ini qisqartiring.")
+            return
+        filename = f"orders-{time.strftime('%Y%m%d-%H%M')}.{fmt}.gz"
+        await bot.send_document(message.chat.id, FSInputFile(path, filename=filename), caption=f"📦 {count} ta buyurtma")
+    finally:
+        os.unlink(path)
+
+# Full-text order search; the admin's session remembers recent queries so page buttons can find them again
+async def find_page(query: str, digest: str, page: int):
+    rows, has_next = await repo.search_orders(query, page, FIND_PAGE_SIZE)
+    if not rows:
+        return render("find_empty", query=query), None
+    first = page * FIND_PAGE_SIZE + 1
+    text = render("find_title", query=query, first=first, last=first + len(rows) - 1) + "".join(
+        render("find_entry", order_id=row[0], user_id=row[1], service=short(row[2] or "—"), total_price=row[3],
+               status=(row[4] or "").capitalize(), snippet=row[5] or "")
+        for row in rows
+    )
+    return text.strip(), find_kb(digest, page, page > 0, has_next)
+
+@dp.message(Command("find"))
+async def find_command(message: Message, command: CommandObject, state: FSMContext):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer(render("not_admin"))
+        return
+    query = (command.args or "").strip()
+    if not query:
+        await message.answer(render("find_usage"), parse_mode=None)
         return
-    user_id = int(callback.data.split("_")[2])
+    digest = f"{zlib.crc32(query.encode()):08x}"
+    queries = (await state.get_data()).get("find_queries", {})
+    queries = {key: value for key, value in list(queries.items())[-9:]}
+    queries[digest] = query
+    await state.update_data(find_queries=queries)
+    try:
+        text, keyboard = await find_page(query, digest, 0)
+    except sqlite3.Error as e:
+        logger.error("Search error for %r: %s", query, e)
+        await message.answer(render("db_error"))
+        return
+    # Snippets are customer text: sent without Markdown parsing
+    await message.answer(text, reply_markup=keyboard, parse_mode=None)
+
+@callbacks.on(SearchCallback)
+async def find_page_callback(callback: CallbackQuery, callback_data: SearchCallback, state: FSMContext):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.message.answer(render("not_admin"))
+        return
+    query = (await state.get_data()).get("find_queries", {}).get(callback_data.digest)
+    if query is None:
+        await callback.answer(render("find_expired"), show_alert=True)
+        return
+    try:
+        text, keyboard = await find_page(query, callback_data.digest, callback_data.page)
+    except sqlite3.Error as e:
+        logger.error("Search error for %r: %s", query, e)
+        await callback.message.edit_text(render("db_error"))
+        return
+    await callback.message.edit_text(text, reply_markup=keyboard, parse_mode=None)
+
+@dp.message(Command("online"))
+@dp.message(Command("offline"))
+async def presence_command(message: Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer(render("not_admin"))
+        return
+    online = command.command == "online"
+    try:
+        await work.set_online(message.from_user.id, online)
+    except sqlite3.Error as e:
+        logger.error("Presence change failed for admin %s: %s", message.from_user.id, e)
+        await message.answer(render("db_error"))
+        return
+    await message.answer(render("admin_online" if online else "admin_offline"))
+
+@dp.message(Command("queue"))
+async def queue_command(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer(render("not_admin"))
+        return
+    try:
+        roster = await work.roster()
+    except sqlite3.Error as e:
+        logger.error("Work roster error: %s", e)
+        await message.answer(render("db_error"))
+        return
+    text = render("work_roster_title") + "".join(
+        render("work_roster_entry", presence="🟢" if online else "⚪️", admin_id=admin_id, load=load,
+               last_seen=time.strftime("%d.%m %H:%M", time.localtime(last_seen)) if last_seen else "—")
+        for admin_id, online, last_seen, load in roster
+    )
+    await message.answer(text.strip(), parse_mode=None)
+
+@dp.message(Command("perf"))
+async def perf_stats(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer(render("not_admin"))
+        return
+    db_metrics = repo.metrics()
+    send_metrics = sender.metrics()
+    lines = [f"DB navbat: {db_metrics['queue_depth']}, guruhli commit: {db_metrics['group_commits']}"]
+    for name, stats in sorted(db_metrics["queries"].items()):
+        lines.append(f"{name}: {stats['count']} ta, o‘rtacha {stats['avg_exec_ms']} ms, max {stats['max_exec_ms']} ms")
+    lines.append(f"\nYuborish navbati: {send_metrics['queue_length']}, retry_after: {send_metrics['retry_after']}")
+    for name, stats in send_metrics["lanes"].items():
+        lines.append(f"{name}: {stats['count']} ta, kutish {stats['avg_wait_ms']} ms, yuborish {stats['avg_exec_ms']} ms")
+    lines.append(f"\nObuna keshi: {membership.metrics()}")
+    await message.answer("\n".join(lines), parse_mode=None)
+
+@callbacks.on(AdminCallback, action=AdminAction.CHAT)
+async def admin_start_chat(callback: CallbackQuery, callback_data: AdminCallback, state: FSMContext):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.message.answer(render("not_admin"))
+        return
+    user_id = callback_data.target_id
     await state.update_data(chat_user_id=user_id, chat_mode="admin")
-    await callback.message.answer(f"Foydalanuvchi {user_id} bilan chat boshlandi. Xabar yozing yoki /stopchat buyrug‘i bilan yakunlang.")
+    await callback.message.answer(
+        f"Foydalanuvchi {user_id} bilan chat boshlandi. Xabar yozing yoki /stopchat buyrug‘i bilan yakunlang. "
+        "Boshqa mijozlarga ularning xabariga javob (reply) qilib yozishingiz mumkin."
+    )
 
-@dp.callback_query(F.data == "start_chat_with_admin")
+@callbacks.on("start_chat_with_admin")
 async def user_start_chat(callback: CallbackQuery, state: FSMContext):
-    await state.update_data(chat_user_id=callback.from_user.id, chat_mode="user")
+    try:
+        admin_id = await work.contact_for(callback.from_user.id)
+    except Exception as e:
+        logger.error("Could not find the admin of user %s: %s", callback.from_user.id, e)
+        admin_id = ADMIN_ID
+    await state.update_data(chat_user_id=callback.from_user.id, chat_mode="user", chat_admin_id=admin_id)
     await callback.message.answer("Admin bilan chat boshlandi. Xabar yozing yoki /stopchat buyrug‘i bilan yakunlang.")
 
 @dp.message(Command("stopchat"))
@@ -649,36 +1147,45 @@ async def stop_chat(message: Message, state: FSMContext):
     await state.clear()
     await message.answer("Chat yakunlandi.")
 
-# Universal chat handler
+# Universal chat handler: relays conversations between customers and the admin, media included
 @dp.message()
 async def universal_message_handler(message: Message, state: FSMContext):
     data = await state.get_data()
     chat_mode = data.get("chat_mode")
     chat_user_id = data.get("chat_user_id")
-
-    # Admindan foydalanuvchiga chat
-    if chat_mode == "admin" and message.from_user.id == ADMIN_ID and chat_user_id:
-        try:
-            await bot.send_message(chat_user_id, f"Admin: {message.text}")
-            await message.answer("Xabaringiz foydalanuvchiga yuborildi.")
-        except Exception as e:
-            await message.answer(f"Xabar yuborilmadi: {e}")
-        return
+    try:
+        peer = await relay.peer(message)  # set when replying to a relayed message
+    except Exception as e:
+        logger.error("Relay lookup failed: %s", e)
+        peer = None
+
+    # Admindan foydalanuvchiga chat: a reply goes to the customer who wrote the message, anything else to the open chat
+    if message.from_user.id in ADMIN_IDS:
+        user_id = peer[0] if peer else chat_user_id if chat_mode == "admin" else None
+        if user_id:
+            try:
+                await relay.to_user(message, user_id, peer)
+            except Exception as e:
+                await message.answer(f"Xabar yuborilmadi: {e}")
+            return
 
     # Foydalanuvchidan adminga chat
-    if chat_mode == "user" and message.from_user.id == chat_user_id:
+    elif (chat_mode == "user" and message.from_user.id == chat_user_id) or (peer and peer[0] in ADMIN_IDS):
+        # A reply goes to the admin who wrote the message, anything else to the customer's admin
+        admin_id = peer[0] if peer and peer[0] in ADMIN_IDS else data.get("chat_admin_id")
         try:
-            await bot.send_message(ADMIN_ID, f"Foydalanuvchi ({chat_user_id}): {message.text}")
+            await relay.to_admin(message, peer, admin_id)
             await message.answer("Xabaringiz admin ga yuborildi.")
         except Exception as e:
             await message.answer(f"Xabar yuborilmadi: {e}")
         return
 
-    # Fallback for messages not caught by other handlers (commands, specific states)
-    current_state = await state.get_state()
-    logger.warning(f"Unexpected message from user {message.from_user.id} in state {current_state}: {message.text}")
+    # Fallback for messages not caught by other handlers (commands, specific states); counted, not logged at
+    # warning level, since a stray message is the customer's mistake, not the bot's
+    metrics.inc("bot_stray_messages_total", ())
+    logger.debug("Unexpected message from user %s: %s", message.from_user.id, message.text)
     await message.answer("Iltimos, jarayonni davom ettiring yoki /start buyrug‘i bilan qayta boshlang.")
 
 if __name__ == "__main__":
     logger.info("Bot started polling")
-    asyncio.run(dp.start_polling(bot))
\ No newline at end of file
+    asyncio.run(dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types()))
\ No newline at end of file
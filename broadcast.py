@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+from db import BROADCAST_RECIPIENTS_SQL
+from sender import BULK, send_priority
+
+logger = logging.getLogger(__name__)
+
+# Errors after which a user will never receive a message from us again
+UNREACHABLE_MARKERS = ("chat not found", "user is deactivated", "bot was blocked", "user not found")
+
+
+class Broadcaster:
+    """Sends one text to every customer who has ever ordered.
+
+    Recipients are streamed from orders in user_id order, one batch at a
+    time, and the cursor is checkpointed after every batch, so a restart
+    resumes where it stopped. A lease on the broadcast row keeps two
+    processes (webhook workers) from running the same broadcast. Sends go
+    through the bulk lane of the send scheduler, which keeps them at the
+    global rate limit without delaying replies to users.
+    """
+
+    def __init__(self, bot, repo, batch_size: int = 50, concurrency: int = 30, lease_seconds: float = 120):
+        self.bot = bot
+        self.repo = repo
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        self._tasks = {}
+        self._resumer = None
+
+    async def launch(self, text: str, notify_chat_id=None) -> int:
+        broadcast_id = await self.repo.write("broadcast_create", _create, text, time.time() + self.lease_seconds)
+        self._spawn(broadcast_id, text, 0, notify_chat_id)
+        return broadcast_id
+
+    async def resume(self, notify_chat_id=None):
+        # Picks up broadcasts whose previous runner stopped or died (lease expired)
+        for broadcast_id, text, cursor in await self.repo.write(
+            "broadcast_claim", _claim_abandoned, time.time(), self.lease_seconds
+        ):
+            logger.info("Resuming broadcast %s after user %s", broadcast_id, cursor)
+            self._spawn(broadcast_id, text, cursor, notify_chat_id)
+
+    def start(self, notify_chat_id=None):
+        async def resume_loop():
+            while True:
+                try:
+                    await self.resume(notify_chat_id)
+                except Exception as e:
+                    logger.error("Broadcast resume failed: %s", e)
+                await asyncio.sleep(self.lease_seconds)
+        self._resumer = asyncio.create_task(resume_loop())
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        task = self._tasks.get(broadcast_id)
+        if task:
+            task.cancel()
+        return await self.repo.write("broadcast_cancel", _cancel, broadcast_id)
+
+    async def status(self, limit: int = 5) -> list:
+        return await self.repo.read("broadcast_status", _recent, limit)
+
+    async def close(self):
+        # Stop sending and hand our broadcasts back so the next start resumes them at once
+        running = list(self._tasks)
+        tasks = list(self._tasks.values())
+        if self._resumer:
+            tasks.append(self._resumer)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if running:
+            await self.repo.write("broadcast_release", _release, running)
+
+    def _spawn(self, broadcast_id: int, text: str, cursor: int, notify_chat_id):
+        task = asyncio.create_task(self._run(broadcast_id, text, cursor, notify_chat_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _run(self, broadcast_id: int, text: str, cursor: int, notify_chat_id):
+        send_priority.set(BULK)  # the task runs in its own context copy
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def deliver(user_id: int):
+            async with semaphore:
+                return user_id, await self._send(user_id, text)
+
+        totals = {"sent": 0, "failed": 0, "unreachable": 0}
+        while True:
+            batch = await self.repo.read(
+                "broadcast_recipients", _recipients, cursor, self.batch_size, self.repo.has_archive
+            )
+            if not batch:
+                break
+            results = await asyncio.gather(*(deliver(user_id) for user_id in batch))
+            counts = {"sent": 0, "failed": 0, "unreachable": 0}
+            unreachable = []
+            for user_id, (outcome, reason) in results:
+                counts[outcome] += 1
+                if outcome == "unreachable":
+                    unreachable.append((user_id, reason, int(time.time())))
+            cursor = batch[-1]
+            still_running = await self.repo.write(
+                "broadcast_checkpoint", _checkpoint, broadcast_id, cursor, counts, unreachable,
+                time.time() + self.lease_seconds,
+            )
+            for key in totals:
+                totals[key] += counts[key]
+            if not still_running:
+                logger.info("Broadcast %s was cancelled", broadcast_id)
+                return
+        await self.repo.write("broadcast_finish", _finish, broadcast_id)
+        logger.info("Broadcast %s finished: %s", broadcast_id, totals)
+        if notify_chat_id:
+            await self.bot.send_message(
+                notify_chat_id,
+                f"📣 Xabarnoma #{broadcast_id} yakunlandi.\n"
+                f"Yuborildi: {totals['sent']}, xato: {totals['failed']}, bloklagan: {totals['unreachable']}",
+                parse_mode=None,
+            )
+
+    async def _send(self, user_id: int, text: str):
+        try:
+            await self.bot.send_message(user_id, text, parse_mode=None)
+            return "sent", None
+        except TelegramForbiddenError as e:
+            return "unreachable", e.message
+        except TelegramBadRequest as e:
+            if any(marker in e.message.lower() for marker in UNREACHABLE_MARKERS):
+                return "unreachable", e.message
+            logger.warning("Broadcast to %s failed: %s", user_id, e)
+            return "failed", None
+        except Exception as e:
+            logger.warning("Broadcast to %s failed: %s", user_id, e)
+            return "failed", None
+
+
+# Queries (executed on repository threads)
+def _create(conn, text: str, leased_until: float) -> int:
+    return conn.execute(
+        "INSERT INTO broadcasts (text, leased_until, created_at) VALUES (?, ?, ?)",
+        (text, leased_until, int(time.time())),
+    ).lastrowid
+
+
+def _claim_abandoned(conn, now: float, lease_seconds: float) -> list:
+    rows = conn.execute(
+        "SELECT id, text, cursor_user_id FROM broadcasts WHERE status = 'running' AND leased_until < ?", (now,)
+    ).fetchall()
+    claimed = []
+    for broadcast_id, text, cursor in rows:
+        updated = conn.execute(
+            "UPDATE broadcasts SET leased_until = ? WHERE id = ? AND status = 'running' AND leased_until < ?",
+            (now + lease_seconds, broadcast_id, now),
+        ).rowcount
+        if updated:
+            claimed.append((broadcast_id, text, cursor))
+    return claimed
+
+
+def _release(conn, broadcast_ids: list):
+    conn.executemany("UPDATE broadcasts SET leased_until = 0 WHERE id = ?", [(i,) for i in broadcast_ids])
+
+
+def _recipients(conn, cursor: int, limit: int, archive: bool = False) -> list:
+    recipients = [row[0] for row in conn.execute(BROADCAST_RECIPIENTS_SQL.format(orders="orders"), (cursor, limit))]
+    if archive:
+        # Customers whose orders were all archived are customers still
+        archived = conn.execute(BROADCAST_RECIPIENTS_SQL.format(orders="archive.orders"), (cursor, limit))
+        recipients = sorted(set(recipients).union(row[0] for row in archived))[:limit]
+    return recipients
+
+
+def _checkpoint(conn, broadcast_id: int, cursor: int, counts: dict, unreachable: list, leased_until: float) -> bool:
+    conn.executemany(
+        "INSERT OR REPLACE INTO unreachable_users (user_id, reason, recorded_at) VALUES (?, ?, ?)", unreachable
+    )
+    return conn.execute("""
+        UPDATE broadcasts SET cursor_user_id = ?, sent = sent + ?, failed = failed + ?,
+            unreachable = unreachable + ?, leased_until = ?
+        WHERE id = ? AND status = 'running'
+    """, (cursor, counts["sent"], counts["failed"], counts["unreachable"], leased_until, broadcast_id)).rowcount > 0
+
+
+def _finish(conn, broadcast_id: int):
+    conn.execute(
+        "UPDATE broadcasts SET status = 'done', finished_at = ? WHERE id = ? AND status = 'running'",
+        (int(time.time()), broadcast_id),
+    )
+
+
+def _cancel(conn, broadcast_id: int) -> bool:
+    return conn.execute(
+        "UPDATE broadcasts SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'running'",
+        (int(time.time()), broadcast_id),
+    ).rowcount > 0
+
+
+def _recent(conn, limit: int) -> list:
+    return conn.execute(
+        "SELECT id, status, sent, failed, unreachable, cursor_user_id, created_at FROM broadcasts ORDER BY id DESC LIMIT ?",
+        (limit,),
+    ).fetchall()
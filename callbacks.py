@@ -0,0 +1,192 @@
+"""Callback data factories and a prefix-table router.
+
+Every button payload is "<prefix>:<field>:..." built by one of the factories
+below. The prefix carries a version digit (o1, p1, ...): to change a layout,
+add a new factory with the next version and keep the old one routed until
+its buttons have aged out of users' chats. Payloads from before the factories
+existed ("pay_12", "admin_chat_5", ...) are upgraded by parse_legacy().
+
+CallbackRouter is registered as the dispatcher's only callback handler and
+finds the target with one dict lookup on the prefix, instead of aiogram
+evaluating a chain of startswith filters for every button press.
+"""
+import contextvars
+import inspect
+import logging
+from enum import Enum
+
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.filters.callback_data import CallbackData
+
+logger = logging.getLogger(__name__)
+
+# Name of the handler the router picked for the current update, for instrumentation
+routed_handler = contextvars.ContextVar("routed_handler", default=None)
+
+
+class OrderAction(str, Enum):
+    PAY = "p"
+    PAID = "d"
+
+
+class PaymentAction(str, Enum):
+    CONFIRM = "c"
+    REJECT = "r"
+
+
+class AdminAction(str, Enum):
+    APPROVE = "a"
+    REJECT = "r"
+    CHAT = "c"
+
+
+class PageView(str, Enum):
+    MY_ORDERS = "m"
+    ADMIN = "a"
+
+
+class ServiceCallback(CallbackData, prefix="s1"):
+    service: str
+
+
+class ComplexityCallback(CallbackData, prefix="c1"):
+    level: str
+
+
+class PlatformCallback(CallbackData, prefix="t1"):
+    code: str
+
+
+class OrderCallback(CallbackData, prefix="o1"):
+    action: OrderAction
+    order_id: int
+
+
+class PaymentCallback(CallbackData, prefix="p1"):
+    action: PaymentAction
+    order_id: int
+
+
+class AdminCallback(CallbackData, prefix="a1"):
+    action: AdminAction
+    target_id: int  # order id, or user id for CHAT
+
+
+class PageCallback(CallbackData, prefix="g1"):
+    # Keyset cursor: (timestamp, id) of the edge row of the current page
+    view: PageView
+    backward: bool
+    timestamp: int
+    order_id: int
+
+
+class SearchCallback(CallbackData, prefix="f1"):
+    # The query itself may not fit in 64 bytes; the admin's session maps the digest back to it
+    digest: str
+    page: int
+
+
+# Payloads written before the factories, checked only when the prefix lookup misses
+def _legacy_page(view: PageView, rest: str):
+    direction, timestamp, order_id = rest.split("_")
+    return PageCallback(view=view, backward=direction == "prev", timestamp=int(timestamp), order_id=int(order_id))
+
+
+LEGACY_PREFIXES = (
+    ("admin_pay_confirm_", lambda rest: PaymentCallback(action=PaymentAction.CONFIRM, order_id=int(rest))),
+    ("admin_pay_reject_", lambda rest: PaymentCallback(action=PaymentAction.REJECT, order_id=int(rest))),
+    ("admin_approve_", lambda rest: AdminCallback(action=AdminAction.APPROVE, target_id=int(rest))),
+    ("admin_reject_", lambda rest: AdminCallback(action=AdminAction.REJECT, target_id=int(rest))),
+    ("admin_chat_", lambda rest: AdminCallback(action=AdminAction.CHAT, target_id=int(rest))),
+    ("admin_page_", lambda rest: _legacy_page(PageView.ADMIN, rest)),
+    ("contact_user_", lambda rest: AdminCallback(action=AdminAction.CHAT, target_id=int(rest))),  # "message the user"
+    ("payment_done_", lambda rest: OrderCallback(action=OrderAction.PAID, order_id=int(rest))),
+    ("pay_", lambda rest: OrderCallback(action=OrderAction.PAY, order_id=int(rest))),
+    ("my_orders_", lambda rest: _legacy_page(PageView.MY_ORDERS, rest)),
+    ("service_", lambda rest: ServiceCallback(service=rest)),
+    ("complexity_", lambda rest: ComplexityCallback(level=rest)),
+    ("target_platform_", lambda rest: PlatformCallback(code=rest)),  # label, mapped by the handler
+)
+
+
+def parse_legacy(data: str):
+    for prefix, build in LEGACY_PREFIXES:
+        if data.startswith(prefix):
+            try:
+                return build(data[len(prefix):])
+            except ValueError:
+                return None
+    return None
+
+
+class _Handler:
+    __slots__ = ("callback", "state", "params", "takes_all")
+
+    def __init__(self, callback, state):
+        self.callback = callback
+        self.state = state.state if state is not None else None
+        parameters = inspect.signature(callback).parameters.values()
+        self.params = frozenset(p.name for p in parameters)
+        self.takes_all = any(p.kind is inspect.Parameter.VAR_KEYWORD for p in parameters)
+
+
+class CallbackRouter:
+    """Dispatches callback queries by payload prefix.
+
+    Routes are registered with on(): either an exact payload ("accept_terms")
+    or a factory, optionally narrowed to one action and one FSM state.
+    Handlers get the parsed factory as ``callback_data`` plus whichever
+    middleware values (state, bot, ...) their signature asks for, the same
+    way aiogram injects them.
+    """
+
+    def __init__(self):
+        self._routes = {}  # prefix -> (factory or None, {action or None: _Handler})
+        self.legacy_hits = 0
+
+    def on(self, key, action=None, state=None):
+        def register(callback):
+            factory = None if isinstance(key, str) else key
+            prefix = key if factory is None else factory.__prefix__
+            _, handlers = self._routes.setdefault(prefix, (factory, {}))
+            if action in handlers:
+                raise ValueError(f"Callback route {prefix!r}/{action} is already registered")
+            handlers[action] = _Handler(callback, state)
+            return callback
+        return register
+
+    def resolve(self, data: str):
+        # -> (handler, callback_data) or None; callback_data is None for exact payloads
+        prefix = data.split(":", 1)[0]
+        route = self._routes.get(prefix)
+        if route is None:
+            callback_data = parse_legacy(data)
+            if callback_data is None:
+                return None
+            self.legacy_hits += 1
+            route = self._routes.get(callback_data.__prefix__)
+            if route is None:
+                return None
+        elif route[0] is None:
+            callback_data = None
+        else:
+            try:
+                callback_data = route[0].unpack(data)
+            except (TypeError, ValueError):
+                logger.warning("Malformed callback data: %r", data)
+                return None
+        handlers = route[1]
+        handler = handlers.get(getattr(callback_data, "action", None)) or handlers.get(None)
+        return (handler, callback_data) if handler else None
+
+    async def dispatch(self, callback_query, **data):
+        resolved = self.resolve(callback_query.data or "")
+        if resolved is None or (resolved[0].state is not None and data.get("raw_state") != resolved[0].state):
+            routed_handler.set("unhandled")
+            return UNHANDLED
+        handler, callback_data = resolved
+        routed_handler.set(handler.callback.__name__)
+        data["callback_data"] = callback_data
+        if not handler.takes_all:
+            data = {name: value for name, value in data.items() if name in handler.params}
+        return await handler.callback(callback_query, **data)
@@ -0,0 +1,1124 @@
+import asyncio
+import logging
+import math
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_SECONDS = 0.5
+
+
+class PromoUnavailable(Exception):
+    # Raised inside the order transaction, so the order is rolled back with it
+    def __init__(self, code: str, reason: str):
+        super().__init__(f"Promo code {code} cannot be redeemed: {reason}")
+        self.code = code
+        self.reason = reason  # "used" (by this customer) or "exhausted" (expired, disabled or cap reached)
+
+
+class QueryStats:
+    # Running latency figures for one named query
+    __slots__ = ("count", "errors", "wait_total", "exec_total", "exec_max")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.wait_total = 0.0
+        self.exec_total = 0.0
+        self.exec_max = 0.0
+
+    def record(self, wait: float, exec_time: float, failed: bool = False):
+        self.count += 1
+        self.errors += failed
+        self.wait_total += wait
+        self.exec_total += exec_time
+        self.exec_max = max(self.exec_max, exec_time)
+
+    def as_dict(self) -> dict:
+        count = self.count or 1
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "avg_wait_ms": round(self.wait_total / count * 1000, 3),
+            "avg_exec_ms": round(self.exec_total / count * 1000, 3),
+            "max_exec_ms": round(self.exec_max * 1000, 3),
+        }
+
+
+def _settle(future: asyncio.Future, value):
+    # Runs on the event loop; the caller may have given up meanwhile
+    if not future.done():
+        future.set_result(value)
+
+
+class OrderRepository:
+    """Shared access to orders.db.
+
+    Writes are serialized on one dedicated thread, reads run on a small pool.
+    Every thread keeps its own long-lived connection and the database runs in
+    WAL mode, so readers never wait for the writer and the event loop never
+    touches the disk. Order changes go through write_batched: those that
+    arrive while the writer is busy are committed together in one
+    transaction. With an archive_path, closed orders moved out by
+    archive.OrderArchiver live in a second database attached to every
+    connection as "archive".
+    """
+
+    def __init__(self, path: str, readers: int = 2, archive_path=None):
+        self.path = path
+        self.archive_path = archive_path
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._pending = {"write": 0, "read": 0}
+        self._stats = {}
+        self._observers = []
+        self._batch = []  # (fn, args, future) waiting for the next group commit
+        self._batch_lock = threading.Lock()
+        self._group_commits = {"batches": 0, "writes": 0}
+
+    # Connection handling (runs on executor threads only)
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            if self.archive_path:
+                conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+                conn.execute("PRAGMA archive.journal_mode=WAL")
+                conn.execute("PRAGMA archive.synchronous=NORMAL")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _call(self, fn, args, write: bool):
+        started = time.perf_counter()
+        conn = self._connection()
+        try:
+            if write:
+                with conn:
+                    result = fn(conn, *args)
+            else:
+                result = fn(conn, *args)
+        except Exception as e:
+            return e, time.perf_counter() - started
+        return result, time.perf_counter() - started
+
+    def _call_batch(self, loop):
+        # One transaction for every write queued so far, each in a savepoint so a failing one rolls back alone
+        with self._batch_lock:
+            batch, self._batch = self._batch, []
+        conn = self._connection()
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, args, future in batch:
+                started = time.perf_counter()
+                conn.execute("SAVEPOINT batched")
+                try:
+                    result = fn(conn, *args)
+                    conn.execute("RELEASE batched")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO batched")
+                    conn.execute("RELEASE batched")
+                    result = e
+                results.append((future, result, time.perf_counter() - started))
+            committing = time.perf_counter()
+            conn.commit()
+            commit_time = time.perf_counter() - committing
+            results = [(future, result, exec_time + commit_time) for future, result, exec_time in results]
+        except Exception as e:
+            conn.rollback()
+            results = [(future, e, 0.0) for _, _, future in batch]
+        self._group_commits["batches"] += 1
+        self._group_commits["writes"] += len(batch)
+        for future, result, exec_time in results:
+            loop.call_soon_threadsafe(_settle, future, (result, exec_time))
+
+    def _join_batch(self, loop, fn, args):
+        future = loop.create_future()
+        with self._batch_lock:
+            self._batch.append((fn, args, future))
+            first = len(self._batch) == 1
+        if first:
+            # Later writes join this batch until the writer thread picks it up
+            loop.run_in_executor(self._writer, self._call_batch, loop)
+        return future
+
+    async def _run(self, name: str, fn, *args, write: bool = False, batched: bool = False):
+        kind = "write" if write else "read"
+        executor = self._writer if write else self._readers
+        loop = asyncio.get_running_loop()
+        self._pending[kind] += 1
+        submitted = time.perf_counter()
+        try:
+            if batched:
+                result, exec_time = await self._join_batch(loop, fn, args)
+            else:
+                result, exec_time = await loop.run_in_executor(executor, self._call, fn, args, write)
+        finally:
+            self._pending[kind] -= 1
+        wait = time.perf_counter() - submitted - exec_time
+        failed = isinstance(result, Exception)
+        self._stats.setdefault(name, QueryStats()).record(wait, exec_time, failed)
+        for observe in self._observers:
+            observe(name, wait, exec_time, failed)
+        if exec_time > SLOW_QUERY_SECONDS:
+            logger.warning("Slow query %s: %.1f ms", name, exec_time * 1000)
+        if failed:
+            raise result
+        return result
+
+    def add_observer(self, observe):
+        # observe(name, wait, exec_time, failed) is called on the event loop after every query
+        self._observers.append(observe)
+
+    def read(self, name: str, fn, *args):
+        return self._run(name, fn, *args)
+
+    def write(self, name: str, fn, *args):
+        return self._run(name, fn, *args, write=True)
+
+    def write_batched(self, name: str, fn, *args):
+        # Like write, but may share its transaction (and its commit) with other batched writes
+        return self._run(name, fn, *args, write=True, batched=True)
+
+    @property
+    def has_archive(self) -> bool:
+        return self.archive_path is not None
+
+    # Lifecycle
+    async def open(self):
+        applied = await self.write("migrate", migrate)
+        if applied:
+            logger.info("Applied schema migrations %s", applied)
+        if self.has_archive:
+            await self.write("archive_schema", ensure_archive)
+        for name, plan in (await self.read("query_plans", query_plan_problems, self.has_archive)).items():
+            logger.warning("Query %s is not index-backed: %s", name, plan)
+        logger.info("Order repository opened on %s", self.path)
+
+    async def close(self):
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+    def metrics(self) -> dict:
+        return {
+            "queue_depth": dict(self._pending),
+            "queries": {name: stats.as_dict() for name, stats in self._stats.items()},
+            "group_commits": dict(self._group_commits),
+        }
+
+    # Orders
+    # timers: (kind, due_at) pairs armed in the same transaction as the change they follow
+    async def create_order(self, user_id, service, details, colors, complexity,
+                           promo_code, promo_discount, referral_discount, total_price, timestamp, timers=()) -> int:
+        return await self.write_batched(
+            "create_order", _insert_order,
+            (user_id, service, details, colors, complexity, promo_code, promo_discount,
+             referral_discount, total_price, timestamp),
+            timers,
+        )
+
+    async def order_brief(self, order_id: int):
+        # -> (user_id, status, payment_status, total_price) or None
+        return await self.read("order_brief", _order_brief, order_id)
+
+    # Status changes are compare-and-set: each applies only from the states listed in
+    # ORDER_TRANSITIONS and returns (owner, applied), or None when the order does not exist.
+    # Repeating one (a double tap, a redelivered update) changes nothing and reports applied=False.
+    # A change that applies is recorded in order_events with its actor, the user or admin behind it.
+    async def start_payment(self, order_id: int, actor=None):
+        return await self.write_batched("start_payment", _transition, order_id, "start_payment", actor)
+
+    async def confirm_payment(self, order_id: int, actor=None):
+        return await self.write_batched("confirm_payment", _transition, order_id, "confirm_payment", actor)
+
+    async def approve_order(self, order_id: int, actor=None):
+        # The order notice is settled; the order waits for its payment like any other
+        return await self.write_batched("approve_order", _approve_order, order_id, actor)
+
+    async def reject_payment(self, order_id: int, timers=(), actor=None):
+        return await self.write_batched("reject_payment", _transition, order_id, "reject_payment", actor, timers)
+
+    async def submit_receipt(self, order_id: int, timers=(), actor=None):
+        # The receipt awaits the admin: reminders and expiry stop, review timers start
+        return await self.write_batched("submit_receipt", _transition, order_id, "submit_receipt", actor, timers)
+
+    async def expire_order(self, order_id: int):
+        # Cancels the order only if it is still unpaid; -> its owner, or None if it moved on meanwhile
+        return await self.write_batched("expire_order", _expire_order, order_id)
+
+    async def cancel_order(self, order_id: int, actor=None):
+        return await self.write_batched("cancel_order", _cancel_order, order_id, actor)
+
+    async def time_in_state(self, states, since: float) -> dict:
+        # (status, payment_status) -> how long orders that entered it since then stayed; see _time_in_state
+        return await self.read("time_in_state", _time_in_state, list(states), since, time.time())
+
+    # Pages are (rows, has_prev, has_next); cursor is the (timestamp, id) of the
+    # last row shown when paging forward, or of the first row when paging back.
+    # A customer's archived orders are merged in where the page reaches them.
+    async def user_orders_page(self, user_id: int, cursor=None, backward: bool = False, limit: int = 10):
+        return await self.read(
+            "user_orders_page", _keyset_page, USER_ORDERS, (user_id,), cursor, backward, limit, self.has_archive
+        )
+
+    async def pending_orders_page(self, cursor=None, backward: bool = False, limit: int = 5):
+        return await self.read("pending_orders_page", _keyset_page, PENDING_ORDERS, (), cursor, backward, limit)
+
+    async def search_orders(self, text: str, page: int = 0, limit: int = 5):
+        # -> (rows, has_next); rows are (id, user_id, service, total_price, status, snippet), the
+        # SEARCH_RANK_WINDOW most recent hits best match first, then older ones newest first.
+        # Archived orders come after every live one.
+        return await self.read("search_orders", _search_orders, text, page, limit, self.has_archive)
+
+    # Analytics
+    async def order_rollups(self, since_day: int) -> list:
+        # Rows of (day, service, *ROLLUP_TERMS); at most days x services rows, however long the history
+        return await self.read("order_rollups", _rollups, since_day)
+
+
+# Schema migrations. Append new steps at the end; never edit one that has shipped.
+ORDER_COLUMNS = {
+    "colors": "TEXT",
+    "complexity": "TEXT",
+    "referral_discount": "REAL",
+    "status": "TEXT DEFAULT 'pending'",
+    "payment_status": "TEXT DEFAULT 'pending'",
+}
+
+
+def _migration_base_tables(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            service TEXT,
+            details TEXT,
+            colors TEXT,
+            complexity TEXT,
+            promo_code TEXT,
+            promo_discount REAL,
+            referral_discount REAL,
+            total_price INTEGER,
+            timestamp INTEGER,
+            status TEXT DEFAULT 'pending',
+            payment_status TEXT DEFAULT 'pending'
+        )
+    """)
+    # Databases created by early versions of the bot lack some columns
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(orders)")}
+    for column, definition in ORDER_COLUMNS.items():
+        if column not in existing:
+            conn.execute(f"ALTER TABLE orders ADD COLUMN {column} {definition}")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_sessions (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fsm_sessions_updated ON fsm_sessions (updated_at)")
+
+
+def _migration_order_indexes(conn: sqlite3.Connection):
+    # Covering indexes: "my orders" and the admin pending list are answered from the index alone
+    conn.execute("CREATE INDEX idx_orders_user_ts ON orders (user_id, timestamp, id, service, total_price, status)")
+    conn.execute("CREATE INDEX idx_orders_status_ts ON orders (status, timestamp, id, user_id, service, total_price)")
+
+
+def _migration_broadcasts(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            cursor_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            unreachable INTEGER NOT NULL DEFAULT 0,
+            leased_until REAL NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL,
+            finished_at INTEGER
+        )
+    """)
+    conn.execute("CREATE INDEX idx_broadcasts_status ON broadcasts (status)")
+    # Users who blocked the bot or deleted their account; broadcasts skip them
+    conn.execute("""
+        CREATE TABLE unreachable_users (
+            user_id INTEGER PRIMARY KEY,
+            reason TEXT,
+            recorded_at INTEGER NOT NULL
+        )
+    """)
+
+
+def _migration_promo_codes(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE promo_codes (
+            code TEXT PRIMARY KEY COLLATE NOCASE,
+            discount REAL NOT NULL,
+            expires_at INTEGER,
+            max_uses INTEGER,
+            uses INTEGER NOT NULL DEFAULT 0,
+            active INTEGER NOT NULL DEFAULT 1,
+            created_at INTEGER NOT NULL
+        )
+    """)
+    # One redemption per customer and code; order_id lets a cancelled order give it back
+    conn.execute("""
+        CREATE TABLE promo_redemptions (
+            code TEXT NOT NULL COLLATE NOCASE,
+            user_id INTEGER NOT NULL,
+            order_id INTEGER NOT NULL,
+            redeemed_at INTEGER NOT NULL,
+            PRIMARY KEY (code, user_id)
+        )
+    """)
+    conn.execute("CREATE INDEX idx_promo_redemptions_order ON promo_redemptions (order_id)")
+    # Bumped whenever a code's definition changes; processes poll it to refresh their index.
+    # Redemptions only touch "uses", so they do not invalidate anyone's cache.
+    conn.execute("CREATE TABLE promo_codes_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)")
+    conn.execute("INSERT INTO promo_codes_version VALUES (1, 0)")
+    for event in ("INSERT", "DELETE", "UPDATE OF code, discount, expires_at, max_uses, active"):
+        name = event.split()[0].lower()
+        conn.execute(f"""
+            CREATE TRIGGER promo_codes_version_{name} AFTER {event} ON promo_codes
+            BEGIN UPDATE promo_codes_version SET version = version + 1 WHERE id = 1; END
+        """)
+    # Codes that used to be hardcoded in bot.py
+    conn.executemany(
+        "INSERT INTO promo_codes (code, discount, created_at) VALUES (?, ?, ?)",
+        [("Samandar06", 0.10, int(time.time())), ("Semagensy", 0.05, int(time.time()))],
+    )
+
+
+# Orders are rolled up per Tashkent (UTC+5) calendar day and base service
+# ("target (Google Ads)" counts as "target"), attributed to the day the order
+# was placed, so later status changes move that day's funnel forward.
+ROLLUP_UTC_OFFSET = 5 * 3600
+ROLLUP_DAY = f"(COALESCE({{o}}.timestamp, 0) + {ROLLUP_UTC_OFFSET}) / 86400"
+ROLLUP_SERVICE = (
+    "CASE WHEN instr({o}.service, ' (') > 0 THEN substr({o}.service, 1, instr({o}.service, ' (') - 1)"
+    " ELSE COALESCE({o}.service, '') END"
+)
+# Contribution of one order to its rollup row, by column
+ROLLUP_TERMS = {
+    "orders": "1",
+    "booked": "COALESCE({o}.total_price, 0)",
+    "paid": "({o}.payment_status IS 'paid')",
+    "revenue": "CASE WHEN {o}.payment_status IS 'paid' THEN COALESCE({o}.total_price, 0) ELSE 0 END",
+    "upfront": "CASE WHEN {o}.payment_status IS 'paid' THEN COALESCE({o}.total_price, 0) / 4 ELSE 0 END",
+    "in_progress": "({o}.status IS 'in_progress')",
+    "cancelled": "({o}.status IS 'cancelled')",
+}
+
+
+def rollup_day(timestamp: float) -> int:
+    return (int(timestamp) + ROLLUP_UTC_OFFSET) // 86400
+
+
+def _migration_order_rollups(conn: sqlite3.Connection):
+    columns = ", ".join(f"{name} INTEGER NOT NULL DEFAULT 0" for name in ROLLUP_TERMS)
+    conn.execute(f"""
+        CREATE TABLE order_rollups (
+            day INTEGER NOT NULL,
+            service TEXT NOT NULL,
+            {columns},
+            PRIMARY KEY (day, service)
+        ) WITHOUT ROWID
+    """)
+    names = ", ".join(ROLLUP_TERMS)
+    new_terms = ", ".join(term.format(o="NEW") for term in ROLLUP_TERMS.values())
+    conn.execute(f"""
+        CREATE TRIGGER order_rollups_insert AFTER INSERT ON orders
+        BEGIN
+            INSERT INTO order_rollups (day, service, {names})
+            VALUES ({ROLLUP_DAY.format(o="NEW")}, {ROLLUP_SERVICE.format(o="NEW")}, {new_terms})
+            ON CONFLICT (day, service) DO UPDATE SET
+                {", ".join(f"{name} = {name} + excluded.{name}" for name in ROLLUP_TERMS)};
+        END
+    """)
+    # A status change moves the order between funnel stages: add the new contribution, take back the old one
+    changed = [name for name in ROLLUP_TERMS if "status" in ROLLUP_TERMS[name]]
+    deltas = ", ".join(
+        f"{name} = {name} + {ROLLUP_TERMS[name].format(o='NEW')} - {ROLLUP_TERMS[name].format(o='OLD')}"
+        for name in changed
+    )
+    conn.execute(f"""
+        CREATE TRIGGER order_rollups_status AFTER UPDATE OF status, payment_status ON orders
+        WHEN OLD.status IS NOT NEW.status OR OLD.payment_status IS NOT NEW.payment_status
+        BEGIN
+            UPDATE order_rollups SET {deltas}
+            WHERE day = {ROLLUP_DAY.format(o="NEW")} AND service = {ROLLUP_SERVICE.format(o="NEW")};
+        END
+    """)
+    sums = ", ".join(f"SUM({term.format(o='orders')})" for term in ROLLUP_TERMS.values())
+    conn.execute(f"""
+        INSERT INTO order_rollups (day, service, {names})
+        SELECT {ROLLUP_DAY.format(o="orders")}, {ROLLUP_SERVICE.format(o="orders")}, {sums}
+        FROM orders GROUP BY 1, 2
+    """)
+
+
+# Per-order timers fired by timers.TimerScheduler
+TIMER_PAYMENT_REMINDER = "payment_reminder"
+TIMER_ORDER_EXPIRY = "order_expiry"
+TIMER_RECEIPT_REVIEW = "receipt_review"
+UNPAID_STATUSES = ("pending", "processing", "rejected")
+# Unpaid orders placed before timers existed get this long before they expire
+LEGACY_EXPIRY_GRACE = 86400
+
+
+def _migration_timers(conn: sqlite3.Connection):
+    # AUTOINCREMENT: ids are never reused, so a re-armed timer is never mistaken for the one it replaced
+    conn.execute("""
+        CREATE TABLE timers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            due_at REAL NOT NULL,
+            attempt INTEGER NOT NULL DEFAULT 0,
+            failures INTEGER NOT NULL DEFAULT 0,
+            leased_until REAL NOT NULL DEFAULT 0,
+            UNIQUE (order_id, kind)
+        )
+    """)
+    conn.execute("CREATE INDEX idx_timers_due ON timers (due_at)")
+    # Timers that no longer apply go with the status change: all of them once the order leaves
+    # 'pending', review nudges once the receipt is decided, reminders and expiry while it is reviewed
+    conn.execute(f"""
+        CREATE TRIGGER timers_disarm AFTER UPDATE OF status, payment_status ON orders
+        WHEN OLD.status IS NOT NEW.status OR OLD.payment_status IS NOT NEW.payment_status
+        BEGIN
+            DELETE FROM timers WHERE order_id = NEW.id AND (
+                NEW.status IS NOT 'pending'
+                OR (kind = '{TIMER_RECEIPT_REVIEW}') != (NEW.payment_status IS 'review')
+            );
+        END
+    """)
+    # Orders nobody paid for yet expire after a grace period; ones stuck in 'processing' may have a
+    # receipt in the admin chat, so those only nudge the admin
+    now = time.time()
+    conn.execute(f"""
+        INSERT INTO timers (order_id, kind, due_at)
+        SELECT id, CASE payment_status WHEN 'processing' THEN '{TIMER_RECEIPT_REVIEW}' ELSE '{TIMER_ORDER_EXPIRY}' END, ?
+        FROM orders WHERE status = 'pending' AND payment_status IN ({", ".join("?" * len(UNPAID_STATUSES))})
+    """, (now + LEGACY_EXPIRY_GRACE, *UNPAID_STATUSES))
+
+
+def _migration_relay_links(conn: sqlite3.Connection):
+    # Every message the chat relay copies points back at its source, so replying to a copy reaches the other side
+    conn.execute("""
+        CREATE TABLE relay_links (
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            peer_chat_id INTEGER NOT NULL,
+            peer_message_id INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, message_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX idx_relay_links_created ON relay_links (created_at)")
+
+
+# Full-text index over the order fields admins search by; "target (Google Ads)" indexes as target, google, ads
+FTS_COLUMNS = ("details", "colors", "service", "promo_code")
+FTS_WEIGHTS = (1.0, 2.0, 3.0, 5.0)  # a hit in a short field says more than one in free text
+
+
+def _migration_orders_fts(conn: sqlite3.Connection):
+    columns = ", ".join(FTS_COLUMNS)
+    # External content: the index stores only tokens, the text stays in orders
+    conn.execute(f"""
+        CREATE VIRTUAL TABLE orders_fts USING fts5(
+            {columns}, content='orders', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    """)
+    conn.execute(
+        "INSERT INTO orders_fts (orders_fts, rank) VALUES ('rank', ?)",
+        (f"bm25({', '.join(map(str, FTS_WEIGHTS))})",),
+    )
+    new_values = ", ".join(f"NEW.{column}" for column in FTS_COLUMNS)
+    old_values = ", ".join(f"OLD.{column}" for column in FTS_COLUMNS)
+    insert = f"INSERT INTO orders_fts (rowid, {columns}) VALUES (NEW.id, {new_values});"
+    delete = f"INSERT INTO orders_fts (orders_fts, rowid, {columns}) VALUES ('delete', OLD.id, {old_values});"
+    conn.execute(f"CREATE TRIGGER orders_fts_insert AFTER INSERT ON orders BEGIN {insert} END")
+    conn.execute(f"CREATE TRIGGER orders_fts_delete AFTER DELETE ON orders BEGIN {delete} END")
+    # Status changes, by far the most common update, leave the index alone
+    conn.execute(f"CREATE TRIGGER orders_fts_update AFTER UPDATE OF {columns} ON orders BEGIN {delete} {insert} END")
+    conn.execute("INSERT INTO orders_fts (orders_fts) VALUES ('rebuild')")
+
+
+# Admin work queue run by workqueue.WorkQueue: a new order's notice, then its receipt
+WORK_ORDER = "order"
+WORK_RECEIPT = "receipt"
+
+
+def _migration_work_queue(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE admins (
+            user_id INTEGER PRIMARY KEY,
+            online INTEGER NOT NULL DEFAULT 1,
+            last_seen REAL NOT NULL DEFAULT 0,
+            last_assigned_at REAL NOT NULL DEFAULT 0
+        )
+    """)
+    # notice: what the assignee was sent, as JSON, so a reassigned item can be sent again
+    conn.execute("""
+        CREATE TABLE work_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            assignee INTEGER NOT NULL,
+            leased_until REAL NOT NULL,
+            reassignments INTEGER NOT NULL DEFAULT 0,
+            notice TEXT,
+            created_at REAL NOT NULL,
+            UNIQUE (order_id, kind)
+        )
+    """)
+    conn.execute("CREATE INDEX idx_work_items_assignee ON work_items (assignee)")
+    conn.execute("CREATE INDEX idx_work_items_lease ON work_items (leased_until)")
+    # Done items go with the status change, as timers do: an order notice once its receipt
+    # arrives or it closes, a receipt once it is confirmed or rejected
+    conn.execute(f"""
+        CREATE TRIGGER work_items_done AFTER UPDATE OF status, payment_status ON orders
+        WHEN OLD.status IS NOT NEW.status OR OLD.payment_status IS NOT NEW.payment_status
+        BEGIN
+            DELETE FROM work_items WHERE order_id = NEW.id AND (
+                NEW.status IS NOT 'pending'
+                OR (kind = '{WORK_RECEIPT}') != (NEW.payment_status IS 'review')
+            );
+        END
+    """)
+
+
+def _migration_archive_state(conn: sqlite3.Connection):
+    # Every order archived so far was placed before archived_before; 0 while nothing is archived
+    conn.execute("""
+        CREATE TABLE archive_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            archived_before INTEGER NOT NULL
+        )
+    """)
+    conn.execute("INSERT INTO archive_state VALUES (1, 0)")
+
+
+# Orders placed before the event log get one 'imported' event with the state they had then
+EVENT_CREATED = "created"
+EVENT_IMPORTED = "imported"
+# An admin's approval of a new order: recorded, but the order stays pending and payable
+EVENT_APPROVED = "approve_order"
+
+
+def _migration_order_events(conn: sqlite3.Connection):
+    # Append-only history of every order: one row per creation and per status change.
+    # actor is the customer or admin behind the change, NULL for the bot's own (an expiry).
+    conn.execute("""
+        CREATE TABLE order_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL,
+            ts REAL NOT NULL,
+            event TEXT NOT NULL,
+            actor INTEGER,
+            status TEXT,
+            payment_status TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX idx_order_events_order_ts ON order_events (order_id, ts)")
+    conn.execute("CREATE INDEX idx_order_events_state_ts ON order_events (status, payment_status, ts)")
+    conn.execute(f"""
+        INSERT INTO order_events (order_id, ts, event, status, payment_status)
+        SELECT id, COALESCE(timestamp, 0), '{EVENT_IMPORTED}', status, payment_status FROM orders ORDER BY id
+    """)
+    # orders is the snapshot: a status change is an inserted event, which this copies onto the order.
+    # The rollup, timer and work queue triggers then follow the order as before.
+    conn.execute(f"""
+        CREATE TRIGGER order_events_apply AFTER INSERT ON order_events
+        WHEN NEW.event IS NOT '{EVENT_CREATED}'
+        BEGIN
+            UPDATE orders SET status = NEW.status, payment_status = NEW.payment_status WHERE id = NEW.order_id;
+        END
+    """)
+
+
+def _migration_relay_senders(conn: sqlite3.Connection):
+    # The customer each admin chat last saw a relay header for, shared by every process relaying into it
+    conn.execute("""
+        CREATE TABLE relay_senders (
+            chat_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL
+        )
+    """)
+
+
+MIGRATIONS = [
+    (1, "base tables", _migration_base_tables),
+    (2, "order access-path indexes", _migration_order_indexes),
+    (3, "broadcasts", _migration_broadcasts),
+    (4, "promo codes", _migration_promo_codes),
+    (5, "order rollups", _migration_order_rollups),
+    (6, "timers", _migration_timers),
+    (7, "chat relay links", _migration_relay_links),
+    (8, "order full-text search", _migration_orders_fts),
+    (9, "admin work queue", _migration_work_queue),
+    (10, "order archive state", _migration_archive_state),
+    (11, "order event log", _migration_order_events),
+    (12, "chat relay senders", _migration_relay_senders),
+]
+
+
+def migrate(conn: sqlite3.Connection) -> list:
+    # Applies pending migrations; BEGIN IMMEDIATE keeps two processes from racing
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at INTEGER
+        )
+    """)
+    conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        current = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+        applied = []
+        for version, description, apply in MIGRATIONS:
+            if version <= current:
+                continue
+            apply(conn)
+            conn.execute(
+                "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                (version, description, int(time.time())),
+            )
+            applied.append(version)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return applied
+
+
+# Statuses an order never leaves; archive.OrderArchiver moves old orders in them to the archive
+CLOSED_STATUSES = ("in_progress", "cancelled")
+# Tables whose rows move with an archived order, keyed by the column naming it
+ARCHIVED_TABLES = {"orders": "id", "order_events": "order_id"}
+
+
+def ensure_archive(conn: sqlite3.Connection):
+    # The archive follows the live schema instead of migrating on its own: orders and order_events
+    # get whatever columns the live tables have, plus the index "my orders" reads, the per-order
+    # event index and a full-text index. Archived orders never change, so that only learns about inserts.
+    for table in ARCHIVED_TABLES:
+        columns = conn.execute("SELECT name, type FROM pragma_table_info(?, 'main') WHERE name != 'id'", (table,)).fetchall()
+        definitions = ", ".join(f"{name} {type_}" for name, type_ in columns)
+        conn.execute(f"CREATE TABLE IF NOT EXISTS archive.{table} (id INTEGER PRIMARY KEY, {definitions})")
+        existing = {row[1] for row in conn.execute(f"PRAGMA archive.table_info({table})")}
+        for name, type_ in columns:
+            if name not in existing:
+                conn.execute(f"ALTER TABLE archive.{table} ADD COLUMN {name} {type_}")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS archive.idx_orders_user_ts ON orders (user_id, timestamp, id, service, total_price, status)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_order_events_order_ts ON order_events (order_id, ts)")
+    if conn.execute("SELECT 1 FROM archive.sqlite_master WHERE name = 'orders_fts'").fetchone():
+        return
+    fts_columns = ", ".join(FTS_COLUMNS)
+    conn.execute(f"""
+        CREATE VIRTUAL TABLE archive.orders_fts USING fts5(
+            {fts_columns}, content='orders', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    """)
+    conn.execute(
+        "INSERT INTO archive.orders_fts (orders_fts, rank) VALUES ('rank', ?)",
+        (f"bm25({', '.join(map(str, FTS_WEIGHTS))})",),
+    )
+    new_values = ", ".join(f"NEW.{column}" for column in FTS_COLUMNS)
+    conn.execute(f"""
+        CREATE TRIGGER archive.orders_fts_insert AFTER INSERT ON orders
+        BEGIN INSERT INTO orders_fts (rowid, {fts_columns}) VALUES (NEW.id, {new_values}); END
+    """)
+    conn.execute("INSERT INTO archive.orders_fts (orders_fts) VALUES ('rebuild')")
+
+
+# Keyset-paginated order views: one bounded index range per page
+class KeysetQuery:
+    __slots__ = ("columns", "where", "newest_first")
+
+    def __init__(self, columns: str, where: str, newest_first: bool):
+        self.columns = columns
+        self.where = where
+        self.newest_first = newest_first
+
+    def sql(self, with_cursor: bool, backward: bool, table: str = "orders") -> str:
+        descending = self.newest_first != backward
+        where = self.where
+        if with_cursor:
+            where += f" AND (timestamp, id) {'<' if descending else '>'} (?, ?)"
+        order = "DESC" if descending else "ASC"
+        return f"SELECT {self.columns} FROM {table} WHERE {where} ORDER BY timestamp {order}, id {order} LIMIT ?"
+
+
+USER_ORDERS = KeysetQuery("id, service, total_price, status, timestamp", "user_id = ?", newest_first=True)
+PENDING_ORDERS = KeysetQuery(
+    "id, user_id, service, total_price, status, timestamp", "status = 'pending'", newest_first=False
+)
+
+# Hot queries, checked against EXPLAIN QUERY PLAN at startup
+HOT_QUERIES = {
+    f"{name}{suffix}": (query.sql(with_cursor, backward), (0,) * (query.where.count("?") + 2 * with_cursor + 1))
+    for name, query in (("user_orders", USER_ORDERS), ("pending_orders", PENDING_ORDERS))
+    for suffix, with_cursor, backward in (("", False, False), ("_next", True, False), ("_prev", True, True))
+}
+
+# Distinct customers in user_id order, walked with a cursor by broadcasts
+BROADCAST_RECIPIENTS_SQL = """
+    SELECT DISTINCT user_id FROM {orders}
+    WHERE user_id > ? AND user_id NOT IN (SELECT user_id FROM main.unreachable_users)
+    ORDER BY user_id LIMIT ?
+"""
+HOT_QUERIES["broadcast_recipients"] = (BROADCAST_RECIPIENTS_SQL.format(orders="orders"), (0, 0))
+
+ROLLUP_RANGE_SQL = f"SELECT day, service, {', '.join(ROLLUP_TERMS)} FROM order_rollups WHERE day >= ? ORDER BY day"
+HOT_QUERIES["order_rollups"] = (ROLLUP_RANGE_SQL, (0,))
+
+# The next due timers not leased by another process, read by timers.TimerScheduler
+TIMERS_DUE_SQL = """
+    SELECT id, kind, order_id, due_at, attempt, failures FROM timers
+    WHERE due_at < ? AND leased_until <= ? ORDER BY due_at LIMIT ?
+"""
+HOT_QUERIES["timers_due"] = (TIMERS_DUE_SQL, (0, 0, 0))
+
+# Work items whose lease ran out, oldest first, picked up by the work queue sweep
+WORK_EXPIRED_SQL = """
+    SELECT id FROM work_items WHERE leased_until <= ? ORDER BY leased_until LIMIT ?
+"""
+HOT_QUERIES["work_expired"] = (WORK_EXPIRED_SQL, (0, 0))
+
+# Ranked by the index itself (ORDER BY rank), so only one page of rows is joined to orders.
+# Ranking every hit of a common word takes a large share of a second, so only the
+# SEARCH_RANK_WINDOW most recent hits are ranked: the cutoff query finds the oldest
+# of them by walking the index in rowid order, which costs the same at any table size.
+# Older hits follow the ranked ones newest first, read in rowid order without ranking.
+# {db} is main or archive; the unqualified orders_fts in MATCH names the table in FROM.
+SEARCH_CUTOFF_SQL = "SELECT rowid FROM {db}.orders_fts WHERE orders_fts MATCH ? ORDER BY rowid DESC LIMIT 1 OFFSET ?"
+SEARCH_ORDERS_SQL = """
+    SELECT o.id, o.user_id, o.service, o.total_price, o.status, snippet(orders_fts, -1, '«', '»', '…', 10)
+    FROM {db}.orders_fts JOIN {db}.orders o ON o.id = orders_fts.rowid
+    WHERE orders_fts MATCH ? AND orders_fts.rowid >= ? ORDER BY rank LIMIT ? OFFSET ?
+"""
+SEARCH_OLDER_SQL = """
+    SELECT o.id, o.user_id, o.service, o.total_price, o.status, snippet(orders_fts, -1, '«', '»', '…', 10)
+    FROM {db}.orders_fts JOIN {db}.orders o ON o.id = orders_fts.rowid
+    WHERE orders_fts MATCH ? AND orders_fts.rowid < ? ORDER BY orders_fts.rowid DESC LIMIT ? OFFSET ?
+"""
+SEARCH_COUNT_SQL = "SELECT COUNT(*) FROM main.orders_fts WHERE orders_fts MATCH ?"
+HOT_QUERIES["search_cutoff"] = (SEARCH_CUTOFF_SQL.format(db="main"), ("x", 0))
+HOT_QUERIES["search_orders"] = (SEARCH_ORDERS_SQL.format(db="main"), ("x", 0, 0, 0))
+HOT_QUERIES["search_older"] = (SEARCH_OLDER_SQL.format(db="main"), ("x", 0, 0, 0))
+SEARCH_MAX_TERMS = 8
+SEARCH_RANK_WINDOW = 500
+
+# Every entry into a state since a time, with when the order left it (the order's next event other than an
+# approval, NULL if it is still there): one range of the state index, then one probe of the per-order index per entry
+TIME_IN_STATE_SQL = f"""
+    SELECT e.ts, (
+        SELECT MIN(n.ts) FROM order_events n
+        WHERE n.order_id = e.order_id AND n.ts > e.ts AND n.event != '{EVENT_APPROVED}'
+    )
+    FROM order_events e
+    WHERE e.status = ? AND e.payment_status = ? AND e.ts >= ?
+        AND e.event NOT IN ('{EVENT_IMPORTED}', '{EVENT_APPROVED}')
+"""
+HOT_QUERIES["time_in_state"] = (TIME_IN_STATE_SQL, ("x", "x", 0))
+TIME_IN_STATE_PERCENTILES = (50, 90, 99)
+
+# Closed orders placed before a cutoff, the next batch for the archiver
+ARCHIVE_CANDIDATES_SQL = f"""
+    SELECT id FROM orders WHERE status IN ({", ".join(f"'{status}'" for status in CLOSED_STATUSES)}) AND timestamp < ?
+    LIMIT ?
+"""
+HOT_QUERIES["archive_candidates"] = (ARCHIVE_CANDIDATES_SQL, (0, 0))
+
+# Checked only on connections with the archive attached
+ARCHIVE_HOT_QUERIES = {
+    "archive_user_orders": (USER_ORDERS.sql(True, False, "archive.orders"), (0, 0, 0, 0)),
+    "archive_broadcast_recipients": (BROADCAST_RECIPIENTS_SQL.format(orders="archive.orders"), (0, 0)),
+    "archive_search_cutoff": (SEARCH_CUTOFF_SQL.format(db="archive"), ("x", 0)),
+    "archive_search_orders": (SEARCH_ORDERS_SQL.format(db="archive"), ("x", 0, 0, 0)),
+    "archive_search_older": (SEARCH_OLDER_SQL.format(db="archive"), ("x", 0, 0, 0)),
+}
+
+
+def fts_query(text: str):
+    # Admin input as an FTS5 query: every word must match, as a prefix; None if there are no words.
+    # Quoting each word keeps FTS5 operators and punctuation in the input from being interpreted.
+    # Single letters (the k of ko‘k) have no prefix index and would match nearly everything, so they are left out.
+    words = [word for word in re.findall(r"\w+", text.casefold()) if len(word) > 1][:SEARCH_MAX_TERMS]
+    return " ".join(f'"{word}"*' for word in words) or None
+
+
+def query_plan_problems(conn: sqlite3.Connection, archive: bool = False) -> dict:
+    # Full scans and temp b-tree sorts in hot queries, keyed by query name
+    problems = {}
+    queries = {**HOT_QUERIES, **ARCHIVE_HOT_QUERIES} if archive else HOT_QUERIES
+    for name, (sql, params) in queries.items():
+        details = [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+        # A full-text MATCH shows up as a SCAN of the virtual table but is an index lookup
+        bad = [d for d in details if (d.startswith("SCAN") and "VIRTUAL TABLE" not in d) or "TEMP B-TREE" in d]
+        if bad:
+            problems[name] = bad
+    return problems
+
+
+# Order status changes: name -> (new values, the condition the order must meet for them to apply)
+ORDER_TRANSITIONS = {
+    "start_payment": (
+        {"payment_status": "processing"},
+        "status = 'pending' AND payment_status IN ('pending', 'rejected')",
+    ),
+    "submit_receipt": (
+        {"payment_status": "review"},
+        "status = 'pending' AND payment_status IN ('pending', 'processing', 'rejected')",
+    ),
+    "confirm_payment": (
+        {"payment_status": "paid", "status": "in_progress"},
+        "status = 'pending' AND payment_status IS NOT 'paid'",
+    ),
+    "reject_payment": (
+        {"payment_status": "rejected"},
+        "status = 'pending' AND payment_status IN ('pending', 'processing', 'review')",
+    ),
+    # Leaves status and payment_status as they are; payment still has to be made and confirmed
+    EVENT_APPROVED: (
+        {},
+        "status = 'pending' AND payment_status IS NOT 'paid' AND NOT EXISTS ("
+        f"SELECT 1 FROM order_events a WHERE a.order_id = orders.id AND a.event = '{EVENT_APPROVED}')",
+    ),
+    "cancel": ({"status": "cancelled"}, "status = 'pending' AND payment_status IS NOT 'paid'"),
+    "expire": ({"status": "cancelled"}, "status = 'pending' AND payment_status IN ('pending', 'processing', 'rejected')"),
+}
+
+
+# Queries (executed on repository threads)
+def _insert_order(conn: sqlite3.Connection, values: tuple, timers=()) -> int:
+    c = conn.execute("""
+        INSERT INTO orders (user_id, service, details, colors, complexity, promo_code, promo_discount, referral_discount, total_price, timestamp, status, payment_status)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending', 'pending')
+    """, values)
+    conn.execute(
+        "INSERT INTO order_events (order_id, ts, event, actor, status, payment_status) VALUES (?, ?, ?, ?, 'pending', 'pending')",
+        (c.lastrowid, time.time(), EVENT_CREATED, values[0]),
+    )
+    if values[5]:
+        _redeem_promo(conn, values[5], values[0], c.lastrowid, values[9])
+    # A customer ordering again has evidently unblocked the bot
+    conn.execute("DELETE FROM unreachable_users WHERE user_id = ?", (values[0],))
+    _arm_timers(conn, c.lastrowid, timers)
+    return c.lastrowid
+
+
+def _arm_timers(conn: sqlite3.Connection, order_id: int, timers):
+    # Replacing gives the timer a fresh id, attempt count and lease
+    conn.executemany(
+        "INSERT OR REPLACE INTO timers (order_id, kind, due_at) VALUES (?, ?, ?)",
+        [(order_id, kind, due_at) for kind, due_at in timers],
+    )
+
+
+def _redeem_promo(conn: sqlite3.Connection, code: str, user_id: int, order_id: int, now: int):
+    # Runs in the order's transaction: the cap check and the per-customer row are atomic with the insert
+    taken = conn.execute("""
+        UPDATE promo_codes SET uses = uses + 1
+        WHERE code = ? AND active = 1 AND (expires_at IS NULL OR expires_at > ?) AND (max_uses IS NULL OR uses < max_uses)
+    """, (code, now)).rowcount
+    if not taken:
+        raise PromoUnavailable(code, "exhausted")
+    try:
+        conn.execute(
+            "INSERT INTO promo_redemptions (code, user_id, order_id, redeemed_at) VALUES (?, ?, ?, ?)",
+            (code, user_id, order_id, now),
+        )
+    except sqlite3.IntegrityError:
+        raise PromoUnavailable(code, "used") from None
+
+
+def _cancel_order(conn: sqlite3.Connection, order_id: int, actor=None):
+    result = _transition(conn, order_id, "cancel", actor)
+    if result and result[1]:
+        _release_promo(conn, order_id)
+    return result
+
+
+def _approve_order(conn: sqlite3.Connection, order_id: int, actor=None):
+    result = _transition(conn, order_id, EVENT_APPROVED, actor)
+    if result and result[1]:
+        # The status is unchanged, so the work_items_done trigger leaves the notice's item in place
+        conn.execute("DELETE FROM work_items WHERE order_id = ? AND kind = ?", (order_id, WORK_ORDER))
+    return result
+
+
+def _release_promo(conn: sqlite3.Connection, order_id: int):
+    # The customer may use the code again on a later order
+    row = conn.execute("SELECT code FROM promo_redemptions WHERE order_id = ?", (order_id,)).fetchone()
+    if row:
+        conn.execute("DELETE FROM promo_redemptions WHERE order_id = ?", (order_id,))
+        conn.execute("UPDATE promo_codes SET uses = uses - 1 WHERE code = ? AND uses > 0", (row[0],))
+
+
+def _transition(conn: sqlite3.Connection, order_id: int, name: str, actor=None, timers=()):
+    # -> (owner, applied) or None; timers are armed only when the change applied.
+    # The change is the event: it is recorded only if the order meets the condition, in the same
+    # statement that checks it, and order_events_apply then updates the order.
+    fields, expected = ORDER_TRANSITIONS[name]
+    applied = conn.execute(f"""
+        INSERT INTO order_events (order_id, ts, event, actor, status, payment_status)
+        SELECT id, ?, ?, ?, COALESCE(?, status), COALESCE(?, payment_status) FROM orders WHERE id = ? AND {expected}
+    """, (time.time(), name, actor, fields.get("status"), fields.get("payment_status"), order_id)).rowcount > 0
+    row = conn.execute("SELECT user_id FROM orders WHERE id = ?", (order_id,)).fetchone()
+    if row is None:
+        return None
+    if applied and timers:
+        _arm_timers(conn, order_id, timers)
+    return row[0], applied
+
+
+def _order_brief(conn: sqlite3.Connection, order_id: int):
+    return conn.execute(
+        "SELECT user_id, status, payment_status, total_price FROM orders WHERE id = ?", (order_id,)
+    ).fetchone()
+
+
+def _expire_order(conn: sqlite3.Connection, order_id: int):
+    # Guarded like any transition, so a payment confirmed by another process is never cancelled
+    result = _transition(conn, order_id, "expire")
+    if not (result and result[1]):
+        return None
+    _release_promo(conn, order_id)
+    return result[0]
+
+
+def _search_orders(conn: sqlite3.Connection, text: str, page: int, limit: int, archive: bool = False):
+    match = fts_query(text)
+    if match is None:
+        return [], False
+    rows = _search_in(conn, "main", match, limit + 1, page * limit)
+    if archive and len(rows) <= limit and _archived_before(conn):
+        # The live hits ran out on this page; archived ones follow them
+        if rows:
+            offset = 0
+        else:
+            offset = page * limit - conn.execute(SEARCH_COUNT_SQL, (match,)).fetchone()[0]
+        shown = {row[0] for row in rows}
+        archived = _search_in(conn, "archive", match, limit + 1 - len(rows), max(offset, 0))
+        rows += [row for row in archived if row[0] not in shown]
+    return rows[:limit], len(rows) > limit
+
+
+def _search_in(conn: sqlite3.Connection, db: str, match: str, limit: int, offset: int) -> list:
+    # One page of a database's hits: the ranked window first, then everything older
+    cutoff = conn.execute(SEARCH_CUTOFF_SQL.format(db=db), (match, SEARCH_RANK_WINDOW - 1)).fetchone()
+    if cutoff is None:
+        # No more hits than the window holds, so all of them are ranked
+        return conn.execute(SEARCH_ORDERS_SQL.format(db=db), (match, 0, limit, offset)).fetchall()
+    rows = []
+    if offset < SEARCH_RANK_WINDOW:
+        rows = conn.execute(SEARCH_ORDERS_SQL.format(db=db), (match, cutoff[0], limit, offset)).fetchall()
+    if len(rows) < limit:
+        rows += conn.execute(
+            SEARCH_OLDER_SQL.format(db=db), (match, cutoff[0], limit - len(rows), max(offset - SEARCH_RANK_WINDOW, 0))
+        ).fetchall()
+    return rows
+
+
+def _archived_before(conn: sqlite3.Connection) -> int:
+    return conn.execute("SELECT archived_before FROM archive_state WHERE id = 1").fetchone()[0]
+
+
+def _time_in_state(conn: sqlite3.Connection, states: list, since: float, now: float) -> dict:
+    # -> {(status, payment_status): {"count", "p50", "p90", "p99", "waiting", "longest_waiting"}} in seconds;
+    # percentiles cover orders that have left the state, "waiting" counts those still in it
+    summaries = {}
+    for status, payment_status in states:
+        stays, waiting = [], []
+        for entered, left in conn.execute(TIME_IN_STATE_SQL, (status, payment_status, since)):
+            if left is None:
+                waiting.append(now - entered)
+            else:
+                stays.append(left - entered)
+        stays.sort()
+        summary = {"count": len(stays)}
+        for q in TIME_IN_STATE_PERCENTILES:
+            # Nearest rank
+            summary[f"p{q}"] = stays[max(0, math.ceil(q / 100 * len(stays)) - 1)] if stays else None
+        summary["waiting"] = len(waiting)
+        summary["longest_waiting"] = max(waiting, default=None)
+        summaries[status, payment_status] = summary
+    return summaries
+
+
+def _rollups(conn: sqlite3.Connection, since_day: int) -> list:
+    return conn.execute(ROLLUP_RANGE_SQL, (since_day,)).fetchall()
+
+
+def _keyset_page(conn: sqlite3.Connection, query: KeysetQuery, params: tuple, cursor, backward: bool, limit: int,
+                 archive: bool = False):
+    args = (*params, *cursor) if cursor else params
+    rows = conn.execute(query.sql(cursor is not None, backward), (*args, limit + 1)).fetchall()
+    if archive:
+        rows = _merge_archived(conn, query, args, cursor, backward, limit, rows)
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+        return rows, more, cursor is not None
+    return rows, cursor is not None, more
+
+
+def _merge_archived(conn: sqlite3.Connection, query: KeysetQuery, args: tuple, cursor, backward: bool, limit: int,
+                    rows: list) -> list:
+    # Archived orders are all older than archived_before, so the archive is read only when the
+    # live rows run out before the page is full or the page reaches back that far.
+    # Rows start with the id and end with the timestamp.
+    archived_before = _archived_before(conn)
+    oldest = min([row[-1] or 0 for row in rows] + ([cursor[0]] if cursor else []), default=0)
+    if not archived_before or (len(rows) > limit and oldest >= archived_before):
+        return rows
+    archived = conn.execute(query.sql(cursor is not None, backward, "archive.orders"), (*args, limit + 1)).fetchall()
+    # An order is in both for a moment while it is being moved
+    live = {row[0] for row in rows}
+    merged = rows + [row for row in archived if row[0] not in live]
+    merged.sort(key=lambda row: (row[-1] or 0, row[0]), reverse=query.newest_first != backward)
+    return merged[:limit + 1]
+
+
+if __name__ == "__main__":
+    # python db.py [path [archive path]]: migrate a database and fail if a hot query needs a scan
+    import sys
+
+    with sqlite3.connect(sys.argv[1] if len(sys.argv) > 1 else ":memory:") as conn:
+        print(f"Applied migrations: {migrate(conn)}")
+        if len(sys.argv) > 2:
+            conn.execute("ATTACH DATABASE ? AS archive", (sys.argv[2],))
+            ensure_archive(conn)
+        problems = query_plan_problems(conn, len(sys.argv) > 2)
+    for name, plan in problems.items():
+        print(f"{name}: {plan}")
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import time
+
+from aiogram import BaseMiddleware
+
+from sender import TokenBucket
+from ui import render
+
+logger = logging.getLogger(__name__)
+
+
+class _UserFlow:
+    __slots__ = ("bucket", "in_flight", "warned_at", "album", "album_until")
+
+    def __init__(self, rate: float, burst: float):
+        self.bucket = TokenBucket(rate, burst)
+        self.in_flight = 0
+        self.warned_at = 0.0
+        self.album = None  # media_group_id of the album being admitted
+        self.album_until = 0.0
+
+
+class FloodControlMiddleware(BaseMiddleware):
+    """Outer update middleware that keeps one user from hogging the bot.
+
+    Every user has a token bucket (rate per second, up to burst) and at
+    most max_in_flight updates being handled at once. A message or button
+    press beyond either is dropped before any handler, FSM read or API
+    call. Dropped updates cost a token too, down to -burst, so someone who
+    keeps hammering stays locked out until they pause. A dropped press is
+    still answered so its button stops spinning, and a user whose
+    messages are dropped is told to slow down at most once per
+    warn_interval. Identical presses are already collapsed by
+    IdempotencyMiddleware. An album arrives as one update per photo, all
+    at once; once its first part is admitted, the parts sharing its
+    media_group_id within album_window follow without a token or slot of
+    their own, so the album counts as one message.
+
+    When the event loop lags by more than max_loop_lag, or more than
+    max_send_queue sends wait for a rate-limit token, load is shed: an
+    update is admitted only while its user's bucket holds shed_reserve
+    tokens. Someone tapping through an order at human speed keeps a
+    nearly full bucket and does not notice; users who have been sending
+    fast are refused until the pressure is gone. Exempt users (admins)
+    are never limited.
+    """
+
+    def __init__(self, send_queue_length, exempt=(), rate: float = 1.0, burst: float = 8.0, max_in_flight: int = 2,
+                 max_loop_lag: float = 0.25, max_send_queue: int = 500, shed_reserve=None,
+                 warn_interval: float = 30.0, probe_interval: float = 0.1, prune_interval: float = 60.0,
+                 album_window: float = 10.0):
+        self.send_queue_length = send_queue_length
+        self.exempt = frozenset(exempt)
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.max_loop_lag = max_loop_lag
+        self.max_send_queue = max_send_queue
+        self.shed_reserve = burst / 2 if shed_reserve is None else shed_reserve
+        self.warn_interval = warn_interval
+        self.probe_interval = probe_interval
+        self.prune_interval = prune_interval
+        self.album_window = album_window
+        self._users = {}  # user_id -> _UserFlow
+        self._monitor_task = None
+        self.loop_lag = 0.0
+        self.shedding = False
+        self.dropped = {"rate": 0, "busy": 0, "shed": 0}
+
+    async def __call__(self, handler, event, data):
+        source = event.message or event.callback_query
+        user = source.from_user if source is not None else None
+        if user is None or user.id in self.exempt:
+            return await handler(event, data)
+        flow = self._users.get(user.id)
+        if flow is None:
+            flow = self._users[user.id] = _UserFlow(self.rate, self.burst)
+        now = time.monotonic()
+        album = event.message.media_group_id if event.message is not None else None
+        if album is not None and album == flow.album and now < flow.album_until:
+            return await handler(event, data)
+        has_token = flow.bucket.delay(now) == 0.0
+        if self.shedding and flow.bucket.tokens < self.shed_reserve:
+            reason = "shed"
+        elif not has_token:
+            reason = "rate"
+        elif flow.in_flight >= self.max_in_flight:
+            reason = "busy"
+        else:
+            flow.bucket.take()
+            flow.in_flight += 1
+            if album is not None:
+                flow.album, flow.album_until = album, now + self.album_window
+            try:
+                return await handler(event, data)
+            finally:
+                flow.in_flight -= 1
+        self.dropped[reason] += 1
+        if flow.bucket.tokens > -self.burst:
+            flow.bucket.take()
+        await self._refuse(event, flow, now)
+        return None
+
+    async def _refuse(self, event, flow: _UserFlow, now: float):
+        try:
+            if event.callback_query is not None:
+                await event.callback_query.answer(render("flood_wait"))
+            elif not self.shedding and now - flow.warned_at >= self.warn_interval:
+                # No warnings while shedding: every send adds to the pressure
+                flow.warned_at = now
+                await event.message.answer(render("flood_wait"))
+        except Exception as e:
+            logger.debug("Could not tell a flooding user to wait: %s", e)
+
+    def start(self):
+        self._monitor_task = asyncio.create_task(self._monitor())
+
+    async def close(self):
+        if self._monitor_task is not None:
+            self._monitor_task.cancel()
+            await asyncio.gather(self._monitor_task, return_exceptions=True)
+
+    async def _monitor(self):
+        # The loop lag is how late a short sleep wakes up; a single stall decays over a few probes
+        loop = asyncio.get_running_loop()
+        next_prune = loop.time() + self.prune_interval
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.probe_interval)
+            now = loop.time()
+            self.loop_lag = max(now - started - self.probe_interval, self.loop_lag * 0.7)
+            queued = self.send_queue_length()
+            # Turned off only well below the thresholds, so it does not flap around them
+            factor = 0.5 if self.shedding else 1.0
+            shedding = self.loop_lag > self.max_loop_lag * factor or queued > self.max_send_queue * factor
+            if shedding != self.shedding:
+                self.shedding = shedding
+                if shedding:
+                    logger.warning("Shedding load: loop lag %.0f ms, %s sends queued", self.loop_lag * 1000, queued)
+                else:
+                    logger.info("Load shedding stopped")
+            if now >= next_prune:
+                next_prune = now + self.prune_interval
+                self._prune()
+
+    def _prune(self):
+        # Users who are idle and back to a full bucket carry no state worth keeping
+        now = time.monotonic()
+        for user_id in [user_id for user_id, flow in self._users.items()
+                        if not flow.in_flight and flow.bucket.full(now)]:
+            del self._users[user_id]
+
+    def metrics(self) -> dict:
+        return {
+            "users": len(self._users),
+            "shedding": int(self.shedding),
+            "loop_lag_ms": round(self.loop_lag * 1000, 1),
+            **{f"dropped_{reason}": count for reason, count in self.dropped.items()},
+        }
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Mapping
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+logger = logging.getLogger(__name__)
+
+
+class _Session:
+    __slots__ = ("state", "data", "touched")
+
+    def __init__(self, state=None, data=None, touched=0.0):
+        self.state = state
+        self.data = data if data is not None else {}
+        self.touched = touched
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM storage persisted in the orders database.
+
+    Sessions live in memory and are written behind in batches every
+    ``flush_interval`` seconds, so a burst of update_data calls costs one
+    write. Sessions idle for longer than ``ttl`` are deleted, and clean
+    sessions idle for ``memory_idle`` seconds are dropped from memory and
+    reloaded from disk on demand.
+    """
+
+    def __init__(self, repo, flush_interval: float = 0.5, ttl: float = 7 * 86400,
+                 memory_idle: float = 900, sweep_interval: float = 300):
+        self.repo = repo
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.memory_idle = memory_idle
+        self.sweep_interval = sweep_interval
+        self._sessions = {}
+        self._dirty = set()
+        self._tasks = []
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) if part is not None else "" for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny
+        ))
+
+    async def _session(self, key: StorageKey) -> _Session:
+        skey = self._key(key)
+        session = self._sessions.get(skey)
+        if session is None:
+            row = await self.repo.read("fsm_load", _load_session, skey)
+            # Another coroutine may have created the session while we were reading
+            session = self._sessions.get(skey)
+            if session is None:
+                session = _Session(row[0], json.loads(row[1]), row[2]) if row else _Session()
+                self._sessions[skey] = session
+        session.touched = time.time()
+        return session
+
+    def _mark_dirty(self, key: StorageKey):
+        self._dirty.add(self._key(key))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        session = await self._session(key)
+        session.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(key)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._session(key)).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        session = await self._session(key)
+        session.data = data.copy()
+        self._mark_dirty(key)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return (await self._session(key)).data.copy()
+
+    # Write-behind
+    async def flush(self):
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        upserts, deletes = [], []
+        for skey in keys:
+            session = self._sessions.get(skey)
+            if session is None:
+                continue
+            if session.state is None and not session.data:
+                deletes.append((skey,))
+            else:
+                upserts.append((skey, session.state, json.dumps(session.data), session.touched))
+        try:
+            await self.repo.write("fsm_flush", _save_sessions, upserts, deletes)
+        except Exception as e:
+            logger.error("FSM flush failed, will retry: %s", e)
+            self._dirty |= keys
+
+    async def sweep(self):
+        now = time.time()
+        removed = await self.repo.write("fsm_expire", _expire_sessions, now - self.ttl)
+        for skey, session in list(self._sessions.items()):
+            if skey in self._dirty:
+                continue
+            if session.touched < now - self.ttl or session.touched < now - self.memory_idle:
+                del self._sessions[skey]
+        if removed:
+            logger.info("Expired %s idle FSM sessions", removed)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error("FSM sweep failed: %s", e)
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._flush_loop()), asyncio.create_task(self._sweep_loop())]
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
+
+    def metrics(self) -> dict:
+        return {"sessions_in_memory": len(self._sessions), "dirty": len(self._dirty)}
+
+
+# Queries (executed on repository threads)
+def _load_session(conn, key: str):
+    return conn.execute("SELECT state, data, updated_at FROM fsm_sessions WHERE key = ?", (key,)).fetchone()
+
+
+def _save_sessions(conn, upserts: list, deletes: list):
+    conn.executemany("""
+        INSERT INTO fsm_sessions (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+    """, upserts)
+    conn.executemany("DELETE FROM fsm_sessions WHERE key = ?", deletes)
+
+
+def _expire_sessions(conn, cutoff: float) -> int:
+    return conn.execute("DELETE FROM fsm_sessions WHERE updated_at < ?", (cutoff,)).rowcount
@@ -0,0 +1,99 @@
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+
+logger = logging.getLogger(__name__)
+
+
+class TTLSet:
+    # Bounded set of recently seen keys; the oldest go first when it is full
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._expires = OrderedDict()  # key -> expires_at, in insertion order
+
+    def __contains__(self, key) -> bool:
+        expires_at = self._expires.get(key)
+        if expires_at is None:
+            return False
+        if expires_at > time.monotonic():
+            return True
+        del self._expires[key]
+        return False
+
+    def add(self, key, ttl=None):
+        self._expires.pop(key, None)
+        self._expires[key] = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._evict()
+
+    def discard(self, key):
+        self._expires.pop(key, None)
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._expires and (len(self._expires) > self.maxsize or next(iter(self._expires.values())) <= now):
+            self._expires.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._expires)
+
+
+class IdempotencyMiddleware(BaseMiddleware):
+    """Outer update middleware that drops repeated updates.
+
+    An update_id seen within update_ttl is a redelivery (Telegram retries
+    webhook updates a slow handler did not acknowledge in time). A button
+    press whose (user, payload) is still being handled, or was handled
+    less than press_ttl ago, is a double tap; it is acknowledged so the
+    button stops spinning, and not handled again. A press whose handler
+    raised is forgotten at once, as is its update_id, so it can be retried.
+
+    The caches live in process memory, which is enough because webhook
+    workers route every user's updates to the same worker.
+    """
+
+    def __init__(self, update_ttl: float = 600, press_ttl: float = 3, maxsize: int = 50_000):
+        self.press_ttl = press_ttl
+        self._updates = TTLSet(update_ttl, maxsize)
+        self._presses = TTLSet(press_ttl, maxsize)
+        self.duplicate_updates = 0
+        self.duplicate_presses = 0
+
+    async def __call__(self, handler, event, data):
+        if event.update_id in self._updates:
+            self.duplicate_updates += 1
+            logger.info("Dropped redelivered update %s", event.update_id)
+            return None
+        callback = event.callback_query
+        key = (callback.from_user.id, callback.data) if callback is not None and callback.data else None
+        if key is not None and key in self._presses:
+            self.duplicate_presses += 1
+            try:
+                await callback.answer()
+            except Exception as e:
+                logger.warning("Could not acknowledge repeated press %r: %s", callback.data, e)
+            return None
+        self._updates.add(event.update_id)
+        if key is not None:
+            # Held for as long as the handler runs, however long that is, then for press_ttl
+            self._presses.add(key, ttl=float("inf"))
+        try:
+            result = await handler(event, data)
+        except Exception:
+            self._updates.discard(event.update_id)
+            if key is not None:
+                self._presses.discard(key)
+            raise
+        if key is not None:
+            self._presses.add(key)
+        return result
+
+    def metrics(self) -> dict:
+        return {
+            "duplicate_updates": self.duplicate_updates,
+            "duplicate_presses": self.duplicate_presses,
+            "tracked_updates": len(self._updates),
+            "tracked_presses": len(self._presses),
+        }
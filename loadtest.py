@@ -0,0 +1,400 @@
+"""Offline load test: drives the whole order funnel through the dispatcher.
+
+Synthetic users go /start -> terms -> service -> (complexity -> colors) ->
+details -> promo -> pay -> payment_done -> receipt, and an admin confirms
+each receipt. Updates are fed straight into dp with a fake Bot session, so
+nothing touches the network; the database is a throwaway file.
+
+    python loadtest.py run --users 2000 --concurrency 500 --record run.jsonl --report new.json
+    python loadtest.py replay run.jsonl --report new.json --baseline old.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+
+# Must be set before bot.py is imported
+LOADTEST_DIR = tempfile.mkdtemp(prefix="loadtest-")
+os.environ.setdefault("API_TOKEN", "123:loadtest")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ["DB_PATH"] = os.path.join(LOADTEST_DIR, "orders.db")
+os.environ.setdefault("METRICS_PORT", "0")
+
+from aiogram import methods  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.types import Chat, ChatMemberMember, Message, MessageId, Update, User  # noqa: E402
+
+from callbacks import OrderAction, OrderCallback, PaymentAction, PaymentCallback  # noqa: E402
+from metrics import HandlerMetricsMiddleware  # noqa: E402
+from webhook import shard_key  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+USER_ID_BASE = 10_000
+MESSAGE_RESULTS = (
+    methods.SendMessage, methods.EditMessageText, methods.SendPhoto, methods.SendDocument,
+    methods.EditMessageReplyMarkup, methods.EditMessageCaption,
+)
+
+
+class FakeSession(BaseSession):
+    # Answers every Bot API call locally, optionally after a simulated round trip
+    def __init__(self, admin_id: int, latency: float = 0.0):
+        super().__init__()
+        self.admin_id = admin_id
+        self.latency = latency
+        self.calls = defaultdict(int)
+        self.last_markup = {}  # chat_id -> reply_markup of the last message sent there
+        self.receipts = asyncio.Queue()  # keyboards sent to the admin, single receipts and digests alike
+        self._message_ids = itertools.count(1)
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, methods.GetChatMember):
+            return ChatMemberMember(user=User(id=method.user_id, is_bot=False, first_name="user"))
+        if isinstance(method, methods.CopyMessage):
+            return MessageId(message_id=next(self._message_ids))
+        if isinstance(method, methods.SendMediaGroup):
+            return [self._message(method.chat_id) for _ in method.media]
+        if isinstance(method, MESSAGE_RESULTS):
+            chat_id = int(method.chat_id or 0)
+            markup = getattr(method, "reply_markup", None)
+            if markup is not None:
+                self.last_markup[chat_id] = markup
+                if chat_id == self.admin_id:
+                    self.receipts.put_nowait(markup)
+            return self._message(chat_id, getattr(method, "text", None) or getattr(method, "caption", None))
+        return True
+
+    def _message(self, chat_id, text=None) -> Message:
+        return Message(
+            message_id=next(self._message_ids), date=int(time.time()),
+            chat=Chat(id=int(chat_id), type="private"), text=text,
+        )
+
+    def button(self, chat_id: int, prefix: str):
+        # Callback data of the first button in the chat's latest keyboard that starts with prefix
+        markup = self.last_markup.get(chat_id)
+        for row in getattr(markup, "inline_keyboard", None) or ():
+            for button in row:
+                if button.callback_data and button.callback_data.startswith(prefix):
+                    return button.callback_data
+        return None
+
+
+class SampleRecorder:
+    # Sink for HandlerMetricsMiddleware and the repository observer that keeps raw samples
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def observe(self, name: str, labels: tuple, seconds: float):
+        self.samples[(name, labels[0])].append(seconds)
+
+    def inc(self, name: str, labels: tuple, amount: float = 1):
+        self.errors[(name, labels[0])] += amount
+
+    def db(self, name: str, wait: float, exec_time: float, failed: bool):
+        self.samples[("db_wait", name)].append(wait)
+        self.samples[("db_exec", name)].append(exec_time)
+        if failed:
+            self.errors[("db", name)] += 1
+
+
+# Synthetic updates
+class UpdateFactory:
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._ids = itertools.count(1_000_000)
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    def message(self, user_id: int, text=None, photo=None) -> dict:
+        message = {"message_id": next(self._ids), "date": int(time.time()),
+                   "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id)}
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if photo:
+            message["photo"] = [{"file_id": photo, "file_unique_id": photo, "width": 640, "height": 480}]
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def callback(self, user_id: int, data: str) -> dict:
+        return {"update_id": next(self._update_ids), "callback_query": {
+            "id": str(next(self._ids)), "from": self._user(user_id), "chat_instance": str(user_id), "data": data,
+            "message": {"message_id": next(self._ids), "date": int(time.time()),
+                        "chat": {"id": user_id, "type": "private"},
+                        "from": {"id": 1, "is_bot": True, "first_name": "bot"}, "text": "..."},
+        }}
+
+
+class LoadTest:
+    def __init__(self, users: int, concurrency: int, think: float, api_latency: float, record=None, seed: int = 1):
+        import bot as app  # deferred: reads the environment set above
+
+        self.app = app
+        self.users = users
+        self.concurrency = concurrency
+        self.think = think
+        self.random = random.Random(seed)
+        self.factory = UpdateFactory()
+        self.session = FakeSession(app.ADMIN_ID, api_latency)
+        # Same request middlewares (rate limiter, API timing) as the real session
+        for middleware in app.bot.session.middleware:
+            self.session.middleware(middleware)
+        app.bot.session = self.session
+        self.recorder = SampleRecorder()
+        for observer in (app.dp.message, app.dp.callback_query):
+            observer.middleware(HandlerMetricsMiddleware(self.recorder))
+        app.repo.add_observer(self.recorder.db)
+        self.latencies = []
+        self.failures = 0
+        self.fed = 0
+        self.started = None
+        self._record = open(record, "w") if record else None
+
+    async def feed(self, raw: dict):
+        if self._record:
+            self._record.write(json.dumps({"t": round(time.perf_counter() - self.started, 4), "update": raw}) + "\n")
+        update = Update.model_validate(raw, context={"bot": self.app.bot})
+        started = time.perf_counter()
+        try:
+            await self.app.dp.feed_update(self.app.bot, update)
+        except Exception as e:
+            self.failures += 1
+            logger.warning("Update %s failed: %r", raw['update_id'], e)
+        self.latencies.append(time.perf_counter() - started)
+        self.fed += 1
+
+    async def pause(self):
+        if self.think:
+            await asyncio.sleep(self.random.uniform(0, 2 * self.think))
+
+    def script(self, user_id: int):
+        # One customer's path through the funnel; yields updates or callables that build them late
+        f = self.factory
+        yield f.message(user_id, "/start")
+        yield f.callback(user_id, "accept_terms")
+        service = self.random.choices(("design", "web", "content", "target"), (4, 2, 1, 2))[0]
+        yield f.callback(user_id, f"s1:{service}")
+        if service == "design":
+            yield f.callback(user_id, f"c1:{self.random.choice(('minimalistik', 'orta', 'yuqori'))}")
+            yield f.message(user_id, "ko‘k, oq, qora — light")
+        elif service == "target":
+            yield f.callback(user_id, f"t1:{self.random.choice(('gads', 'ig', 'fb', 'tg'))}")
+        yield f.message(user_id, "Logotip va banner kerak, 3 ta variant bilan")
+        if self.random.random() < 0.3:
+            yield f.callback(user_id, "promo_yes")
+            yield f.message(user_id, self.random.choice(("Samandar06", "Semagensy")))
+        else:
+            yield f.callback(user_id, "promo_no")
+        # The order id only exists once the bot has answered, so read it off the keyboard it sent
+        yield lambda: f.callback(user_id, self.session.button(user_id, OrderCallback.__prefix__ + ":" + OrderAction.PAY.value))
+        yield lambda: f.callback(user_id, self.session.button(user_id, OrderCallback.__prefix__ + ":" + OrderAction.PAID.value))
+        yield f.message(user_id, photo=f"receipt-{user_id}")
+
+    async def customer(self, user_id: int, slots: asyncio.Semaphore):
+        async with slots:
+            for step in self.script(user_id):
+                raw = step() if callable(step) else step
+                if "callback_query" in raw and raw["callback_query"]["data"] is None:
+                    self.failures += 1
+                    logger.warning("User %s found no button to press", user_id)
+                    return
+                await self.feed(raw)
+                await self.pause()
+
+    async def admin(self, expected: int):
+        # Confirms every receipt as it arrives, without waiting for the previous confirmation
+        confirm = PaymentCallback.__prefix__ + ":" + PaymentAction.CONFIRM.value
+        pending = []
+        while len(pending) < expected:
+            markup = await self.session.receipts.get()
+            for row in markup.inline_keyboard:
+                for button in row:
+                    if button.callback_data and button.callback_data.startswith(confirm):
+                        feed = self.feed(self.factory.callback(self.app.ADMIN_ID, button.callback_data))
+                        pending.append(asyncio.create_task(feed))
+        await asyncio.gather(*pending)
+
+    async def run(self):
+        slots = asyncio.Semaphore(self.concurrency)
+        customers = [self.customer(USER_ID_BASE + i, slots) for i in range(self.users)]
+        admin = asyncio.create_task(self.admin(self.users))
+        await asyncio.gather(*customers)
+        try:
+            await asyncio.wait_for(admin, timeout=30)
+        except asyncio.TimeoutError:
+            logger.warning("Admin did not see every receipt")
+
+    async def replay(self, path: str, speed: float):
+        # Sources (users, admin) run concurrently and each keeps its own order. An update also
+        # waits until every update recorded before it has started, so the admin never confirms
+        # an order ahead of the user creating it.
+        streams = defaultdict(list)
+        with open(path) as f:
+            for seq, line in enumerate(f):
+                entry = json.loads(line)
+                streams[shard_key(entry["update"])].append((seq, entry))
+        started = [asyncio.Event() for _ in range(sum(map(len, streams.values())))]
+
+        async def play(entries):
+            for seq, entry in entries:
+                if seq:
+                    await started[seq - 1].wait()
+                if speed:
+                    delay = entry["t"] / speed - (time.perf_counter() - self.started)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                started[seq].set()
+                await self.feed(entry["update"])
+
+        await asyncio.gather(*(play(entries) for entries in streams.values()))
+
+    async def execute(self, replay_path=None, speed: float = 0.0) -> dict:
+        app = self.app
+        await app.dp.emit_startup(bot=app.bot, dispatcher=app.dp, bots=[app.bot])
+        self.started = time.perf_counter()
+        try:
+            if replay_path:
+                await self.replay(replay_path, speed)
+            else:
+                await self.run()
+            elapsed = time.perf_counter() - self.started
+            orders = await app.repo.read("loadtest_orders", _order_counts)
+        finally:
+            await app.dp.emit_shutdown(bot=app.bot, dispatcher=app.dp, bots=[app.bot])
+            if self._record:
+                self._record.close()
+        return self.report(elapsed, orders)
+
+    def report(self, elapsed: float, orders: dict) -> dict:
+        handlers, queries = {}, {}
+        for (kind, name), samples in sorted(self.recorder.samples.items()):
+            if kind == "bot_handler_seconds":
+                handlers[name] = summarize(samples)
+            elif kind in ("db_wait", "db_exec"):
+                queries.setdefault(name, {})[kind[3:]] = summarize(samples)
+        return {
+            "updates": self.fed,
+            "failures": self.failures,
+            "elapsed_s": round(elapsed, 3),
+            "updates_per_s": round(self.fed / elapsed, 1) if elapsed else 0,
+            "update_latency": summarize(self.latencies),
+            "handlers": handlers,
+            "handler_errors": {name: count for (_, name), count in self.recorder.errors.items()},
+            "db": queries,
+            "api_calls": dict(self.session.calls),
+            "orders": orders,
+        }
+
+
+def summarize(samples) -> dict:
+    ordered = sorted(samples)
+    if not ordered:
+        return {"count": 0}
+
+    def pct(p):
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 3)
+
+    return {"count": len(ordered), "p50_ms": pct(0.50), "p99_ms": pct(0.99), "max_ms": round(ordered[-1] * 1000, 3)}
+
+
+def _order_counts(conn) -> dict:
+    return dict(conn.execute("SELECT status || '/' || payment_status, COUNT(*) FROM orders GROUP BY 1"))
+
+
+def print_report(report: dict, baseline=None):
+    def delta(path, value):
+        # "+12%" against the same figure in the baseline report
+        old = baseline
+        for key in path:
+            old = old.get(key, {}) if isinstance(old, dict) else {}
+        if not isinstance(old, (int, float)) or not old:
+            return ""
+        return f" ({(value - old) / old * 100:+.0f}%)"
+
+    latency = report["update_latency"]
+    print(f"{report['updates']} updates in {report['elapsed_s']}s: "
+          f"{report['updates_per_s']} updates/s{delta(('updates_per_s',), report['updates_per_s'])}, "
+          f"{report['failures']} failed")
+    print(f"update latency p50 {latency.get('p50_ms')} ms{delta(('update_latency', 'p50_ms'), latency.get('p50_ms', 0))}, "
+          f"p99 {latency.get('p99_ms')} ms{delta(('update_latency', 'p99_ms'), latency.get('p99_ms', 0))}")
+    print("\nhandler                          count     p50 ms     p99 ms")
+    for name, stats in sorted(report["handlers"].items(), key=lambda item: -item[1]["p99_ms"]):
+        print(f"{name:30} {stats['count']:7} {stats['p50_ms']:10} {stats['p99_ms']:10}"
+              f"{delta(('handlers', name, 'p99_ms'), stats['p99_ms'])}")
+    print("\nquery                      count  wait p50  wait p99  exec p50  exec p99")
+    for name, stats in sorted(report["db"].items(), key=lambda item: -item[1]["wait"]["p99_ms"]):
+        wait, exec_ = stats["wait"], stats["exec"]
+        print(f"{name:24} {wait['count']:7} {wait['p50_ms']:9} {wait['p99_ms']:9} {exec_['p50_ms']:9} {exec_['p99_ms']:9}")
+    if report["handler_errors"]:
+        print(f"\nerrors: {report['handler_errors']}")
+    print(f"\norders: {report['orders']}")
+    print(f"api calls: {report['api_calls']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    run_cmd = sub.add_parser("run", help="simulate users through the order funnel")
+    run_cmd.add_argument("--users", type=int, default=1000)
+    run_cmd.add_argument("--concurrency", type=int, default=200, help="users in the funnel at the same time")
+    run_cmd.add_argument("--think", type=float, default=0.0, help="mean pause between a user's steps, seconds")
+    run_cmd.add_argument("--record", help="write the generated update stream to this JSONL file")
+    run_cmd.add_argument("--seed", type=int, default=1)
+    replay_cmd = sub.add_parser("replay", help="feed a recorded update stream")
+    replay_cmd.add_argument("path")
+    replay_cmd.add_argument("--speed", type=float, default=0.0, help="1 = recorded pace, 0 = as fast as possible")
+    for cmd in (run_cmd, replay_cmd):
+        cmd.add_argument("--api-latency", type=float, default=0.0, help="simulated Bot API round trip, seconds")
+        cmd.add_argument("--telegram-limits", action="store_true", help="keep the real per-chat send limits")
+        cmd.add_argument("--report", help="save the report as JSON")
+        cmd.add_argument("--baseline", help="JSON report of an earlier run to compare against")
+    args = parser.parse_args()
+
+    if not args.telegram_limits:
+        os.environ.setdefault("SEND_GLOBAL_RATE", "1000000")
+        os.environ.setdefault("SEND_CHAT_RATE", "1000000")
+    # Scripted customers act back to back, far faster than flood control lets a person
+    os.environ.setdefault("FLOOD_BURST", "1000")
+    if args.command == "run":
+        test = LoadTest(args.users, args.concurrency, args.think, args.api_latency, args.record, args.seed)
+    else:
+        test = LoadTest(0, 1, 0.0, args.api_latency)
+    # bot.py configures INFO logging on import; per-update logs would dominate the run
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.command == "run":
+        report = asyncio.run(test.execute())
+    else:
+        report = asyncio.run(test.execute(replay_path=args.path, speed=args.speed))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    print(f"database: {os.environ['DB_PATH']}")
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+from aiogram import BaseMiddleware
+
+# Correlation fields of the update being handled, stamped on every record logged meanwhile.
+# Tasks started while handling an update inherit them, as asyncio copies the context.
+log_context = contextvars.ContextVar("log_context", default=None)
+
+# Attributes every LogRecord has; anything else on a record is an extra field
+_RECORD_FIELDS = frozenset(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+_pipeline = None
+
+
+class CorrelationMiddleware(BaseMiddleware):
+    """Outer update middleware that tags the update's log records with its update_id and user_id."""
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        token = log_context.set({"update_id": event.update_id, "user_id": user.id if user else None})
+        try:
+            return await handler(event, data)
+        finally:
+            log_context.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    # Runs in the code that logs, before the record is queued, so it sees that task's context
+    def __init__(self, static=None):
+        super().__init__()
+        self.static = dict(static or {})
+
+    def filter(self, record) -> bool:
+        for key, value in self.static.items():
+            setattr(record, key, value)
+        for key, value in (log_context.get() or {}).items():
+            setattr(record, key, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Thins out repetitive info and debug lines.
+
+    Each call site, told apart by logger and message template, may log
+    burst records per interval; past that only every keep_every-th gets
+    through, marked with sampled=keep_every. Warnings and errors always
+    pass. Under load the per-update lines ("User ... chose service")
+    then cost a counter bump instead of a formatted, written record.
+    """
+
+    def __init__(self, burst: int = 20, interval: float = 1.0, keep_every: int = 100, max_sites: int = 1000):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.keep_every = keep_every
+        self.max_sites = max_sites
+        self._windows = {}  # (logger, template) -> [window start, records in window]
+        self._lock = threading.Lock()  # repository threads log too
+        self.dropped = 0
+
+    def filter(self, record) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                if window is None and len(self._windows) >= self.max_sites:
+                    self._windows.clear()  # templates built with f-strings would grow this without bound
+                window = self._windows[key] = [now, 0]
+            window[1] += 1
+            count = window[1]
+            if count <= self.burst:
+                return True
+            if (count - self.burst) % self.keep_every == 0:
+                record.sampled = self.keep_every
+                return True
+            self.dropped += 1
+            return False
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line: time, level, logger, message, then the correlation and other extra fields
+    def format(self, record) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    # Never blocks the caller: when the listener falls behind, records are dropped and counted
+    def __init__(self, records: queue.Queue):
+        super().__init__(records)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # The message is rendered here, while its arguments are still what they were when logged;
+        # formatting the record itself is left to the listener thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _Pipeline:
+    __slots__ = ("handler", "listener", "sampler")
+
+    def __init__(self, handler: DroppingQueueHandler, listener: QueueListener, sampler: SamplingFilter):
+        self.handler = handler
+        self.listener = listener
+        self.sampler = sampler
+
+
+def setup_logging(level=logging.INFO, fmt: str = "json", static=None, queue_size: int = 10_000,
+                  sample_burst: int = 20, sample_every: int = 100):
+    """Routes all logging through a bounded queue to a listener thread writing to stderr.
+
+    Code on the event loop only filters, samples and enqueues a record;
+    formatting and the write happen on the listener thread. fmt is
+    "json" or "text"; static fields (e.g. a worker index) go on every
+    record. Calling it again replaces the previous pipeline.
+    """
+    global _pipeline
+    stop_logging()
+    records = queue.Queue(queue_size)
+    stream = logging.StreamHandler()
+    if fmt == "json":
+        stream.setFormatter(JsonFormatter())
+    else:
+        stream.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+    sampler = SamplingFilter(burst=sample_burst, keep_every=sample_every)
+    handler = DroppingQueueHandler(records)
+    handler.addFilter(sampler)
+    handler.addFilter(ContextFilter(static))
+    listener = QueueListener(records, stream)
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    listener.start()
+    _pipeline = _Pipeline(handler, listener, sampler)
+
+
+def stop_logging():
+    # Writes out what is queued; later records are written directly. Registered at exit.
+    global _pipeline
+    if _pipeline is None:
+        return
+    logging.getLogger().handlers[:] = list(_pipeline.listener.handlers)
+    try:
+        _pipeline.listener.stop()
+    except queue.Full:
+        pass  # no room for the stop marker; the listener is a daemon thread and ends with the process
+    _pipeline = None
+
+
+atexit.register(stop_logging)
+
+
+def logging_metrics() -> dict:
+    if _pipeline is None:
+        return {}
+    return {
+        "queued": _pipeline.handler.queue.qsize(),
+        "dropped_full": _pipeline.handler.dropped,
+        "sampled_out": _pipeline.sampler.dropped,
+    }
@@ -0,0 +1,191 @@
+import logging
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
+
+from callbacks import routed_handler
+
+logger = logging.getLogger(__name__)
+
+# Seconds; covers a cache hit up to a Telegram call stuck behind flood control
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values) -> str:
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}" if pairs else ""
+
+
+class MetricsRegistry:
+    """Histograms, counters and callback gauges in Prometheus text format.
+
+    Everything is updated on the event loop (repository hooks are called
+    there too), so no locking is needed. Gauges are read from the owning
+    component when the endpoint is scraped.
+    """
+
+    def __init__(self):
+        self._meta = {}  # name -> (kind, help, label names)
+        self._series = {}  # name -> {label values: Histogram | number}
+        self._gauges = []  # (name, help, label names, fn -> {label values: number})
+
+    def histogram(self, name: str, help_text: str, labels: tuple):
+        self._meta[name] = ("histogram", help_text, labels)
+        self._series[name] = {}
+
+    def counter(self, name: str, help_text: str, labels: tuple):
+        self._meta[name] = ("counter", help_text, labels)
+        self._series[name] = {}
+
+    def gauge(self, name: str, help_text: str, labels: tuple, fn):
+        self._gauges.append((name, help_text, labels, fn))
+
+    def observe(self, name: str, values: tuple, seconds: float):
+        series = self._series[name]
+        histogram = series.get(values)
+        if histogram is None:
+            histogram = series[values] = Histogram()
+        histogram.observe(seconds)
+
+    def inc(self, name: str, values: tuple, amount: float = 1):
+        series = self._series[name]
+        series[values] = series.get(values, 0) + amount
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help_text, names) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for values, value in self._series[name].items():
+                if kind == "counter":
+                    lines.append(f"{name}{_labels(names, values)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(value.buckets, value.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(names + ('le',), values + (bound,))} {cumulative}")
+                lines.append(f"{name}_bucket{_labels(names + ('le',), values + ('+Inf',))} {value.count}")
+                lines.append(f"{name}_sum{_labels(names, values)} {value.sum}")
+                lines.append(f"{name}_count{_labels(names, values)} {value.count}")
+        for name, help_text, names, fn in self._gauges:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            try:
+                for values, value in fn().items():
+                    lines.append(f"{name}{_labels(names, values)} {value}")
+            except Exception as e:
+                logger.warning("Gauge %s failed: %s", name, e)
+        return "\n".join(lines) + "\n"
+
+
+def default_registry() -> MetricsRegistry:
+    registry = MetricsRegistry()
+    registry.histogram("bot_handler_seconds", "Handler latency", ("handler", "state"))
+    registry.counter("bot_handler_errors_total", "Handlers that raised", ("handler", "state"))
+    registry.histogram("bot_api_seconds", "Telegram Bot API call latency, excluding send-queue wait", ("method",))
+    registry.counter("bot_api_errors_total", "Failed Telegram Bot API calls", ("method", "error"))
+    registry.histogram("bot_db_seconds", "Database query execution time", ("query",))
+    registry.histogram("bot_db_wait_seconds", "Time a query waited for a repository thread", ("query",))
+    registry.counter("bot_db_errors_total", "Failed database queries", ("query",))
+    return registry
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # Inner middleware: runs only once a handler has matched, so data["handler"] is the winner
+    def __init__(self, registry: MetricsRegistry):
+        self.registry = registry
+
+    async def __call__(self, handler, event, data):
+        # Not reset afterwards, so nested instances (e.g. a load test's recorder) all see the routed name
+        routed_handler.set(None)
+        started = time.perf_counter()
+        failed = False
+        try:
+            return await handler(event, data)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            # Callback queries all enter through the router; it reports which handler it picked
+            name = routed_handler.get() or data["handler"].callback.__name__
+            labels = (name, data.get("raw_state") or "none")
+            self.registry.observe("bot_handler_seconds", labels, time.perf_counter() - started)
+            if failed:
+                self.registry.inc("bot_handler_errors_total", labels)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    # Register after RateLimitMiddleware so the send-queue wait is not counted as API time
+    def __init__(self, registry: MetricsRegistry):
+        self.registry = registry
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            self.registry.inc("bot_api_errors_total", (name, type(e).__name__))
+            raise
+        finally:
+            self.registry.observe("bot_api_seconds", (name,), time.perf_counter() - started)
+
+
+def db_observer(registry: MetricsRegistry):
+    # For OrderRepository.add_observer
+    def observe(name: str, wait: float, exec_time: float, failed: bool):
+        registry.observe("bot_db_seconds", (name,), exec_time)
+        registry.observe("bot_db_wait_seconds", (name,), wait)
+        if failed:
+            registry.inc("bot_db_errors_total", (name,))
+    return observe
+
+
+class MetricsServer:
+    # GET /metrics on a local port for Prometheus to scrape
+    def __init__(self, registry: MetricsRegistry, host: str = "127.0.0.1", port: int = 9100):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        async def handle(request: web.Request):
+            return web.Response(
+                text=self.registry.render(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+            )
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info("Metrics on http://%s:%s/metrics", self.host, self.port)
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
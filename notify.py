@@ -0,0 +1,186 @@
+import asyncio
+import logging
+
+from aiogram.types import InputMediaDocument, InputMediaPhoto
+
+from ui import admin_digest_kb, admin_order_management_kb, admin_payment_kb, admin_receipts_kb, render
+
+logger = logging.getLogger(__name__)
+
+# Telegram accepts 2-10 items per media group
+MEDIA_GROUP_LIMIT = 10
+
+
+class AdminNotifier:
+    """Coalesces new-order notices and payment receipts for the admin chat.
+
+    The first notice of a kind opens a window; everything of that kind
+    arriving within it goes out together when it closes, or as soon as
+    max_batch is reached: orders as one digest with a row of buttons per
+    order, receipts as a media group followed by one message with the
+    confirm/reject buttons. A lone notice is sent the usual way. Orders
+    worth immediate_total or more, and everything when window is 0, skip
+    the window. Each admin chat is batched on its own; chat_id is the
+    default. Callers never wait for a batched send; notices still pending
+    at shutdown are flushed by close(). When a batch or an immediate
+    notice fails, each notice is sent again on its own as plain text,
+    which also gets past Markdown broken by a shortened entry; a notice
+    that fails even then is reported to the handler registered with
+    on_undelivered(). Neither kind of send raises into the caller.
+    """
+
+    def __init__(self, bot, chat_id: int, window: float = 5.0, immediate_total=None,
+                 max_batch: int = MEDIA_GROUP_LIMIT):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.window = window
+        self.immediate_total = immediate_total
+        self.max_batch = max(1, min(max_batch, MEDIA_GROUP_LIMIT))
+        self._pending = {}  # (kind, chat_id) -> notices
+        self._timers = {}
+        self._sending = set()
+        self._undelivered = None
+        self.batches_sent = 0
+        self.batches_failed = 0
+        self.undelivered = 0
+
+    def on_undelivered(self, handler):
+        # handler(kind, order_id), kind "orders" or "receipts", hears of every notice that was never sent
+        self._undelivered = handler
+        return handler
+
+    def immediate(self, total_price: int) -> bool:
+        return not self.window or (self.immediate_total is not None and total_price >= self.immediate_total)
+
+    async def order(self, order_id: int, user_id: int, text: str, entry: str, total_price: int, chat_id=None):
+        # text: the full receipt sent on its own; entry: the order's paragraph in a digest
+        chat_id = chat_id or self.chat_id
+        if self.immediate(total_price):
+            await self._send_now("orders", chat_id, (order_id, user_id, text, entry))
+        else:
+            self._add(("orders", chat_id), (order_id, user_id, text, entry))
+
+    async def receipt(self, order_id: int, file_id: str, is_photo: bool, caption: str, total_price: int, chat_id=None):
+        chat_id = chat_id or self.chat_id
+        if self.immediate(total_price):
+            await self._send_now("receipts", chat_id, (order_id, file_id, is_photo, caption))
+        else:
+            self._add(("receipts", chat_id), (order_id, file_id, is_photo, caption))
+
+    async def _send_now(self, kind: str, chat_id: int, item: tuple):
+        # Never raises into the customer's flow: a failed notice takes the same way as a failed digest's
+        try:
+            if kind == "orders":
+                await self._send_order(chat_id, item[0], item[2])
+            else:
+                await self._send_receipt(chat_id, *item)
+        except Exception as e:
+            logger.error("Admin %s notice of order %s for %s failed, sending it plain: %s", kind, item[0], chat_id, e)
+            await self._send_each_plain(kind, chat_id, [item])
+
+    def _add(self, key: tuple, item: tuple):
+        batch = self._pending.setdefault(key, [])
+        batch.append(item)
+        if len(batch) >= self.max_batch:
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = asyncio.get_running_loop().call_later(self.window, self._flush, key)
+
+    def _flush(self, key: tuple):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(key, None)
+        if not batch:
+            return
+        task = asyncio.create_task(self._send_batch(*key, batch))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _send_batch(self, kind: str, chat_id: int, batch: list):
+        try:
+            if kind == "orders":
+                await self._send_digest(chat_id, batch)
+            else:
+                await self._send_receipts(chat_id, batch)
+            self.batches_sent += 1
+            return
+        except Exception as e:
+            self.batches_failed += 1
+            logger.error("Admin %s digest of %s for %s failed, sending each alone: %s", kind, len(batch), chat_id, e)
+        # Part of the batch may have gone out before the failure; a repeated notice beats a lost one
+        await self._send_each_plain(kind, chat_id, batch)
+
+    async def _send_each_plain(self, kind: str, chat_id: int, items: list):
+        for item in items:
+            try:
+                await self._send_plain(kind, chat_id, item)
+            except Exception as e:
+                self.undelivered += 1
+                logger.error("Admin %s notice of order %s for %s failed: %s", kind, item[0], chat_id, e)
+                if self._undelivered is not None:
+                    try:
+                        await self._undelivered(kind, item[0])
+                    except Exception as e:
+                        logger.error("Could not report undelivered notice of order %s: %s", item[0], e)
+
+    async def _send_plain(self, kind: str, chat_id: int, item: tuple):
+        if kind == "orders":
+            order_id, _, text, _ = item
+            await self.bot.send_message(
+                chat_id, text + render("admin_awaiting_approval"), parse_mode=None,
+                reply_markup=admin_order_management_kb(order_id),
+            )
+        else:
+            order_id, file_id, is_photo, caption = item
+            send = self.bot.send_photo if is_photo else self.bot.send_document
+            await send(chat_id, file_id, caption=caption, parse_mode=None, reply_markup=admin_payment_kb(order_id))
+
+    async def _send_order(self, chat_id: int, order_id: int, text: str):
+        await self.bot.send_message(
+            chat_id, text + render("admin_awaiting_approval"), reply_markup=admin_order_management_kb(order_id)
+        )
+
+    async def _send_digest(self, chat_id: int, batch: list):
+        if len(batch) == 1:
+            order_id, _, text, _ = batch[0]
+            await self._send_order(chat_id, order_id, text)
+            return
+        text = render("admin_digest_title", count=len(batch)) + "".join(entry for _, _, _, entry in batch)
+        await self.bot.send_message(
+            chat_id, text.strip(),
+            reply_markup=admin_digest_kb([(order_id, user_id) for order_id, user_id, _, _ in batch]),
+        )
+
+    async def _send_receipt(self, chat_id: int, order_id: int, file_id: str, is_photo: bool, caption: str):
+        send = self.bot.send_photo if is_photo else self.bot.send_document
+        await send(chat_id, file_id, caption=caption, reply_markup=admin_payment_kb(order_id))
+
+    async def _send_receipts(self, chat_id: int, batch: list):
+        # Photos and documents cannot share a media group
+        for is_photo in (True, False):
+            group = [item for item in batch if item[2] is is_photo]
+            if len(group) == 1:
+                await self._send_receipt(chat_id, *group[0])
+            elif group:
+                media_type = InputMediaPhoto if is_photo else InputMediaDocument
+                await self.bot.send_media_group(
+                    chat_id, [media_type(media=file_id, caption=caption) for _, file_id, _, caption in group]
+                )
+                order_ids = [order_id for order_id, _, _, _ in group]
+                await self.bot.send_message(
+                    chat_id, render("admin_receipts_title", count=len(group)),
+                    reply_markup=admin_receipts_kb(order_ids),
+                )
+
+    async def close(self):
+        for key in list(self._pending):
+            self._flush(key)
+        await asyncio.gather(*self._sending, return_exceptions=True)
+
+    def metrics(self) -> dict:
+        pending = {"orders": 0, "receipts": 0}
+        for (kind, _), batch in self._pending.items():
+            pending[kind] += len(batch)
+        return {**pending, "batches_sent": self.batches_sent, "batches_failed": self.batches_failed,
+                "undelivered": self.undelivered}
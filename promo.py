@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import time
+from typing import NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class Promo(NamedTuple):
+    code: str
+    discount: float
+    expires_at: Optional[int]
+    max_uses: Optional[int]
+    uses: int
+    active: bool
+
+
+class PromoIndex:
+    """In-memory copy of promo_codes for lookups on the hot path.
+
+    The index is reloaded whenever promo_codes_version changes: at once after
+    a change made through this process, and within refresh_interval for a
+    change made by another process (webhook workers). It only answers "does
+    this code exist and is it live"; usage caps and single use per customer
+    are enforced atomically when the order is inserted.
+    """
+
+    def __init__(self, repo, refresh_interval: float = 30):
+        self.repo = repo
+        self.refresh_interval = refresh_interval
+        self._codes = {}  # casefolded code -> Promo
+        self._version = None
+        self._refresher = None
+        self.reloads = 0
+
+    def get(self, code: str) -> Optional[Promo]:
+        # None for unknown, disabled or expired codes; never touches the database
+        promo = self._codes.get(code.strip().casefold())
+        if promo is None or not promo.active:
+            return None
+        if promo.expires_at is not None and promo.expires_at <= time.time():
+            return None
+        return promo
+
+    async def refresh(self, force: bool = False):
+        version = await self.repo.read("promo_version", _version)
+        if version == self._version and not force:
+            return
+        rows = await self.repo.read("promo_load", _load)
+        self._codes = {row[0].casefold(): Promo(*row[:5], bool(row[5])) for row in rows}
+        self._version = version
+        self.reloads += 1
+        logger.info("Loaded %s promo codes (version %s)", len(self._codes), version)
+
+    def start(self):
+        async def refresh_loop():
+            while True:
+                await asyncio.sleep(self.refresh_interval)
+                try:
+                    await self.refresh()
+                except Exception as e:
+                    logger.error("Promo code refresh failed: %s", e)
+        self._refresher = asyncio.create_task(refresh_loop())
+
+    async def close(self):
+        if self._refresher:
+            self._refresher.cancel()
+            await asyncio.gather(self._refresher, return_exceptions=True)
+
+    # Admin changes
+    async def add(self, code: str, discount: float, expires_at: Optional[int] = None, max_uses: Optional[int] = None):
+        await self.repo.write("promo_add", _upsert, code, discount, expires_at, max_uses)
+        await self.refresh()
+
+    async def disable(self, code: str) -> bool:
+        changed = await self.repo.write("promo_disable", _disable, code)
+        await self.refresh()
+        return changed
+
+    async def listing(self) -> list:
+        # Fresh usage counts for the admin; the index itself does not track them
+        return [Promo(*row[:5], bool(row[5])) for row in await self.repo.read("promo_load", _load)]
+
+
+# Queries (executed on repository threads)
+def _version(conn) -> int:
+    return conn.execute("SELECT version FROM promo_codes_version WHERE id = 1").fetchone()[0]
+
+
+def _load(conn) -> list:
+    return conn.execute(
+        "SELECT code, discount, expires_at, max_uses, uses, active FROM promo_codes ORDER BY created_at"
+    ).fetchall()
+
+
+def _upsert(conn, code: str, discount: float, expires_at, max_uses):
+    conn.execute("""
+        INSERT INTO promo_codes (code, discount, expires_at, max_uses, created_at) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (code) DO UPDATE SET
+            discount = excluded.discount, expires_at = excluded.expires_at, max_uses = excluded.max_uses, active = 1
+    """, (code, discount, expires_at, max_uses, int(time.time())))
+
+
+def _disable(conn, code: str) -> bool:
+    return conn.execute("UPDATE promo_codes SET active = 0 WHERE code = ? AND active = 1", (code,)).rowcount > 0
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import time
+
+from aiogram.types import ReplyParameters
+
+from ui import render
+
+logger = logging.getLogger(__name__)
+
+
+class ChatRelay:
+    """Passes messages between customers and the admin chat.
+
+    Messages are sent on with copy_message: Telegram copies them server-side,
+    so photos, files and voice notes go through without being downloaded
+    or re-uploaded. Every copy is recorded in relay_links against the
+    message it was copied from. The admin answers a customer by replying
+    to any of their messages, so any number of conversations can run at
+    once, and each copy arrives as a reply to the message it answers.
+    Customers reach admin_chat_id unless the caller names another admin.
+    Links older than ttl are pruned as new ones are written. Copies carry
+    no sender, so a header names the customer whenever an admin chat
+    switches to another one; who that chat heard from last is kept in
+    relay_senders, since webhook workers relay into the same admin chats.
+    Within a process a header and its copy go out together; two workers
+    relaying into one chat in the same instant can still interleave.
+    """
+
+    def __init__(self, bot, repo, admin_chat_id: int, ttl: float = 30 * 86400, prune_interval: float = 3600):
+        self.bot = bot
+        self.repo = repo
+        self.admin_chat_id = admin_chat_id
+        self.ttl = ttl
+        self.prune_interval = prune_interval
+        self._chat_locks = {}  # admin chat -> lock keeping this process's header and copy together
+        self._next_prune = 0.0
+
+    async def peer(self, message):
+        # -> (chat_id, message_id) of the source of the message replied to, or None
+        reply = message.reply_to_message
+        if reply is None:
+            return None
+        return await self.repo.read("relay_peer", _peer, message.chat.id, reply.message_id)
+
+    async def to_admin(self, message, peer=None, admin_id=None):
+        user = message.from_user
+        chat_id = admin_id or self.admin_chat_id
+        links = []
+        async with self._chat_locks.setdefault(chat_id, asyncio.Lock()):
+            if await self.repo.write("relay_sender", _switch_sender, chat_id, user.id):
+                try:
+                    header = await self.bot.send_message(
+                        chat_id, render("relay_header", full_name=user.full_name, user_id=user.id), parse_mode=None
+                    )
+                except Exception:
+                    # The chat never saw the header; the next message tries again
+                    await self.repo.write("relay_sender_forget", _forget_sender, chat_id, user.id)
+                    raise
+                links.append((chat_id, header.message_id, message.chat.id, message.message_id))
+            copy = await self._copy(chat_id, message, peer)
+        links.append((chat_id, copy.message_id, message.chat.id, message.message_id))
+        await self._record(links)
+
+    async def to_user(self, message, user_id: int, peer=None):
+        # peer: where the admin's reply points, if it came through the index
+        copy = await self._copy(user_id, message, peer)
+        await self._record([(user_id, copy.message_id, message.chat.id, message.message_id)])
+
+    async def _copy(self, chat_id: int, message, peer):
+        reply = None
+        if peer is not None and peer[0] == chat_id:
+            reply = ReplyParameters(message_id=peer[1], allow_sending_without_reply=True)
+        return await self.bot.copy_message(chat_id, message.chat.id, message.message_id, reply_parameters=reply)
+
+    async def _record(self, links: list):
+        now = time.time()
+        prune_before = None
+        if now >= self._next_prune:
+            prune_before = now - self.ttl
+            self._next_prune = now + self.prune_interval
+        await self.repo.write("relay_link", _link, [(*link, int(now)) for link in links], prune_before)
+
+
+# Queries (executed on repository threads)
+def _peer(conn, chat_id: int, message_id: int):
+    return conn.execute(
+        "SELECT peer_chat_id, peer_message_id FROM relay_links WHERE chat_id = ? AND message_id = ?",
+        (chat_id, message_id),
+    ).fetchone()
+
+
+def _link(conn, rows: list, prune_before=None):
+    conn.executemany(
+        "INSERT OR REPLACE INTO relay_links (chat_id, message_id, peer_chat_id, peer_message_id, created_at)"
+        " VALUES (?, ?, ?, ?, ?)",
+        rows,
+    )
+    if prune_before is not None:
+        conn.execute("DELETE FROM relay_links WHERE created_at < ?", (prune_before,))
+
+
+def _switch_sender(conn, chat_id: int, user_id: int) -> bool:
+    # -> True when the chat last heard from someone else, so the copy needs a header
+    return conn.execute("""
+        INSERT INTO relay_senders (chat_id, user_id) VALUES (?, ?)
+        ON CONFLICT (chat_id) DO UPDATE SET user_id = excluded.user_id WHERE user_id IS NOT excluded.user_id
+    """, (chat_id, user_id)).rowcount > 0
+
+
+def _forget_sender(conn, chat_id: int, user_id: int):
+    conn.execute("DELETE FROM relay_senders WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
@@ -0,0 +1,217 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+
+from aiogram import methods
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from db import QueryStats
+
+logger = logging.getLogger(__name__)
+
+# Priority lanes, lower goes first
+USER = 0
+ADMIN = 1
+BULK = 2
+LANE_NAMES = {USER: "user", ADMIN: "admin", BULK: "bulk"}
+
+# Lets a caller (e.g. a broadcast) pick the lane for every send it makes
+send_priority = contextvars.ContextVar("send_priority", default=None)
+
+# Methods that count against Telegram's per-chat and global message limits
+RATE_LIMITED = (
+    methods.SendMessage, methods.SendPhoto, methods.SendDocument, methods.SendMediaGroup,
+    methods.SendVoice, methods.SendVideo, methods.SendAudio, methods.CopyMessage,
+    methods.ForwardMessage, methods.EditMessageText, methods.EditMessageReplyMarkup,
+    methods.EditMessageCaption,
+)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        # Seconds until one token is available
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class SendScheduler:
+    """Single queue for outbound messages.
+
+    A send is released when both the global bucket and its chat's bucket have
+    a token; among waiting sends the lowest lane wins, FIFO within a lane.
+    A RetryAfter from Telegram parks the chat (or everything, for sends with
+    no chat) for the requested time and the send is retried.
+
+    Telegram's limits are per bot, so when several processes send as the
+    same bot (webhook workers) each keeps 1/processes of the global rate.
+    A customer chat is served by the worker its updates are sharded to
+    and keeps the full chat rate; admin chats hear from every worker, so
+    their rate and burst are split as well.
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3,
+                 admin_chat_ids=(), max_retries: int = 3, processes: int = 1):
+        self.processes = max(1, processes)
+        self.global_rate = global_rate / self.processes
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.admin_chat_ids = set(admin_chat_ids)
+        self.max_retries = max_retries
+        self._global = TokenBucket(self.global_rate, max(1.0, self.global_rate))
+        self._chats = {}
+        self._blocked_until = {}
+        self._global_blocked_until = 0.0
+        self._heap = []  # (lane, seq, chat_id, future)
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._pump_task = None
+        self.retry_after_count = 0
+        self._stats = {lane: QueryStats() for lane in LANE_NAMES}
+
+    def lane_for(self, chat_id) -> int:
+        override = send_priority.get()
+        if override is not None:
+            return override
+        return ADMIN if chat_id in self.admin_chat_ids else USER
+
+    def _chat_delay(self, chat_id, now: float) -> float:
+        blocked = self._blocked_until.get(chat_id, 0.0) - now
+        if chat_id is None:
+            return max(blocked, 0.0)
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if chat_id in self.admin_chat_ids:
+                bucket = TokenBucket(self.chat_rate / self.processes, max(1.0, self.chat_burst / self.processes))
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+        return max(blocked, bucket.delay(now))
+
+    async def _wait(self, timeout: float):
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _pump(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            now = time.monotonic()
+            delay = max(self._global.delay(now), self._global_blocked_until - now)
+            if delay > 0:
+                await self._wait(delay)
+                continue
+            skipped = []
+            next_ready = None
+            while self._heap:
+                entry = heapq.heappop(self._heap)
+                if entry[3].done():  # caller gave up
+                    continue
+                wait = self._chat_delay(entry[2], now)
+                if wait <= 0:
+                    self._global.take()
+                    if entry[2] is not None:
+                        self._chats[entry[2]].take()
+                    entry[3].set_result(None)
+                    next_ready = 0.0
+                    break
+                skipped.append(entry)
+                next_ready = wait if next_ready is None else min(next_ready, wait)
+            for entry in skipped:
+                heapq.heappush(self._heap, entry)
+            if next_ready:
+                await self._wait(next_ready)
+            self._prune(now)
+
+    def _prune(self, now: float):
+        # Forget chats whose bucket has refilled; keeps memory flat under broadcasts
+        if len(self._chats) > 10_000:
+            for chat_id in [c for c, b in self._chats.items() if b.full(now)]:
+                del self._chats[chat_id]
+            for chat_id in [c for c, until in self._blocked_until.items() if until <= now]:
+                del self._blocked_until[chat_id]
+
+    async def _acquire(self, chat_id, lane: int):
+        if self._pump_task is None or self._pump_task.done():
+            self._wakeup = asyncio.Event()
+            self._pump_task = asyncio.create_task(self._pump())
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (lane, next(self._seq), chat_id, future))
+        self._wakeup.set()
+        await future
+
+    async def submit(self, call, chat_id=None, lane: int = USER):
+        enqueued = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(chat_id, lane)
+            started = time.perf_counter()
+            try:
+                result = await call()
+            except TelegramRetryAfter as e:
+                self.retry_after_count += 1
+                until = time.monotonic() + e.retry_after
+                if chat_id is None:
+                    self._global_blocked_until = max(self._global_blocked_until, until)
+                else:
+                    self._blocked_until[chat_id] = max(self._blocked_until.get(chat_id, 0.0), until)
+                logger.warning("Flood control for chat %s: retry after %ss (attempt %s)", chat_id, e.retry_after, attempt + 1)
+                if attempt == self.max_retries:
+                    self._stats[lane].record(started - enqueued, time.perf_counter() - started, True)
+                    raise
+                continue
+            except Exception:
+                self._stats[lane].record(started - enqueued, time.perf_counter() - started, True)
+                raise
+            self._stats[lane].record(started - enqueued, time.perf_counter() - started)
+            return result
+
+    async def close(self):
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            await asyncio.gather(self._pump_task, return_exceptions=True)
+
+    def queue_length(self) -> int:
+        return len(self._heap)
+
+    def metrics(self) -> dict:
+        lanes = {}
+        for lane, name in LANE_NAMES.items():
+            lanes[name] = {"queued": sum(1 for entry in self._heap if entry[0] == lane), **self._stats[lane].as_dict()}
+        return {"queue_length": len(self._heap), "retry_after": self.retry_after_count, "lanes": lanes}
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    # Routes every rate-limited Bot API call through the scheduler
+    def __init__(self, scheduler: SendScheduler):
+        self.scheduler = scheduler
+
+    async def __call__(self, make_request, bot, method):
+        if not isinstance(method, RATE_LIMITED):
+            return await make_request(bot, method)
+        chat_id = getattr(method, "chat_id", None)
+        return await self.scheduler.submit(
+            lambda: make_request(bot, method), chat_id, self.scheduler.lane_for(chat_id)
+        )
@@ -0,0 +1,80 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+MEMBER_STATUSES = ("member", "administrator", "creator")
+
+
+class MembershipCache:
+    """Bounded LRU + TTL cache in front of get_chat_member.
+
+    Negative answers expire sooner so a user who has just subscribed is not
+    kept waiting, and concurrent checks for the same user share one request.
+    """
+
+    def __init__(self, fetch, maxsize: int = 10_000, ttl: float = 600, negative_ttl: float = 30):
+        self._fetch = fetch  # async (user_id) -> bool
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()  # user_id -> (is_member, expires_at)
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def is_member(self, user_id: int) -> bool:
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            if entry[1] > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            del self._entries[user_id]
+        task = self._inflight.get(user_id)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._load(user_id))
+            self._inflight[user_id] = task
+        else:
+            self.coalesced += 1
+        # shield: one cancelled waiter must not cancel the shared request
+        return await asyncio.shield(task)
+
+    async def _load(self, user_id: int) -> bool:
+        task = asyncio.current_task()
+        try:
+            is_member = await self._fetch(user_id)
+        finally:
+            current = self._inflight.get(user_id)
+            if current is task:
+                del self._inflight[user_id]
+        # An update that arrived while we were waiting is fresher than our answer
+        if current is task:
+            self._store(user_id, is_member)
+        return is_member
+
+    def _store(self, user_id: int, is_member: bool):
+        ttl = self.ttl if is_member else self.negative_ttl
+        self._entries[user_id] = (is_member, time.monotonic() + ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def set(self, user_id: int, is_member: bool):
+        # Authoritative status from a chat_member update
+        self._inflight.pop(user_id, None)
+        self._store(user_id, is_member)
+
+    def invalidate(self, user_id: int):
+        self._inflight.pop(user_id, None)
+        self._entries.pop(user_id, None)
+
+    def metrics(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,180 @@
+import asyncio
+import heapq
+import logging
+import time
+
+from db import TIMERS_DUE_SQL
+
+logger = logging.getLogger(__name__)
+
+
+class TimerScheduler:
+    """Fires the per-order timers stored in the timers table.
+
+    Only timers due within the next `horizon` seconds are held in memory, in
+    a heap ordered by due time. The heap is refilled with one index range
+    query when the horizon runs out, or earlier when armed() reports a
+    timer that falls inside it; nothing else reads the table. A timer is
+    leased before its handler runs and deleted or rescheduled afterwards,
+    so timers survive restarts, a crash re-fires the timers it interrupted,
+    and two processes never fire the same timer.
+
+    Handlers are registered per kind with on() and called as
+    handler(order_id, attempt). They return the delay until the next
+    firing, or None when the timer is done. A handler that raises is
+    retried after retry_delay, at most max_failures times.
+    """
+
+    def __init__(self, repo, horizon: float = 60.0, batch_size: int = 200, lease_seconds: float = 120.0,
+                 retry_delay: float = 60.0, max_failures: int = 5, concurrency: int = 10):
+        self.repo = repo
+        self.horizon = horizon
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.retry_delay = retry_delay
+        self.max_failures = max_failures
+        self.concurrency = concurrency
+        self._handlers = {}
+        self._heap = []  # (due_at, id, kind, order_id, attempt, failures)
+        self._loaded_until = 0.0
+        self._in_flight = set()
+        self._wakeup = None
+        self._task = None
+        self.fired = 0
+        self.failed = 0
+
+    def on(self, kind: str):
+        def register(handler):
+            if kind in self._handlers:
+                raise ValueError(f"Timer kind {kind!r} already has a handler")
+            self._handlers[kind] = handler
+            return handler
+        return register
+
+    def armed(self, due_at: float):
+        # Called after a query armed a timer; the loaded window is re-read if the timer belongs in it
+        if due_at < self._loaded_until:
+            self._loaded_until = 0.0
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        # Hand interrupted timers back so the next start fires them without waiting out the lease
+        if self._in_flight:
+            await self.repo.write("timers_release", _release, list(self._in_flight))
+            self._in_flight.clear()
+
+    async def _loop(self):
+        while True:
+            try:
+                now = time.time()
+                if now >= self._loaded_until:
+                    await self._load(now)
+                if self._heap and self._heap[0][0] <= now:
+                    await self._fire_due(now)
+                    continue
+                next_due = min(self._heap[0][0], self._loaded_until) if self._heap else self._loaded_until
+                await self._sleep(next_due - now)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Timer loop failed: %s", e)
+                await asyncio.sleep(self.retry_delay)
+
+    async def _sleep(self, delay: float):
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _load(self, now: float):
+        rows = await self.repo.read("timers_due", _due, now + self.horizon, now, self.batch_size)
+        self._heap = [(due_at, timer_id, kind, order_id, attempt, failures)
+                      for timer_id, kind, order_id, due_at, attempt, failures in rows]
+        heapq.heapify(self._heap)
+        # A full batch may have cut the window short; reload once its last timer is due
+        self._loaded_until = rows[-1][3] if len(rows) == self.batch_size else now + self.horizon
+
+    async def _fire_due(self, now: float):
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+            due.append(heapq.heappop(self._heap))
+        claimed = set(await self.repo.write(
+            "timers_claim", _claim, [entry[1] for entry in due], now, now + self.lease_seconds
+        ))
+        due = [entry for entry in due if entry[1] in claimed]
+        self._in_flight.update(claimed)
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def fire(entry):
+            async with slots:
+                return await self._fire(entry)
+
+        outcomes = await asyncio.gather(*(fire(entry) for entry in due))
+        await self.repo.write("timers_finish", _finish, outcomes)
+        self._in_flight.difference_update(claimed)
+        for timer_id, due_at, attempt, failures in outcomes:
+            if due_at is not None and due_at < self._loaded_until:
+                entry = next(entry for entry in due if entry[1] == timer_id)
+                heapq.heappush(self._heap, (due_at, timer_id, entry[2], entry[3], attempt, failures))
+
+    async def _fire(self, entry) -> tuple:
+        # -> (id, next due_at or None to delete, attempt, failures)
+        _, timer_id, kind, order_id, attempt, failures = entry
+        handler = self._handlers.get(kind)
+        if handler is None:
+            logger.warning("No handler for timer %s, dropping it (order %s)", kind, order_id)
+            return timer_id, None, attempt, failures
+        try:
+            delay = await handler(order_id, attempt)
+        except Exception as e:
+            self.failed += 1
+            if failures + 1 >= self.max_failures:
+                logger.error("Timer %s for order %s failed %s times, giving up: %s", kind, order_id, failures + 1, e)
+                return timer_id, None, attempt, failures + 1
+            logger.warning("Timer %s for order %s failed, retrying: %s", kind, order_id, e)
+            return timer_id, time.time() + self.retry_delay * (failures + 1), attempt, failures + 1
+        self.fired += 1
+        if delay is None:
+            return timer_id, None, attempt, failures
+        return timer_id, time.time() + delay, attempt + 1, 0
+
+    def metrics(self) -> dict:
+        return {"loaded": len(self._heap), "in_flight": len(self._in_flight), "fired": self.fired, "failed": self.failed}
+
+
+# Queries (executed on repository threads)
+def _due(conn, until: float, now: float, limit: int) -> list:
+    return conn.execute(TIMERS_DUE_SQL, (until, now, limit)).fetchall()
+
+
+def _claim(conn, timer_ids: list, now: float, lease_until: float) -> list:
+    # A timer another process leased, rescheduled or deleted meanwhile is skipped
+    return [
+        timer_id for timer_id in timer_ids
+        if conn.execute(
+            "UPDATE timers SET leased_until = ? WHERE id = ? AND due_at <= ? AND leased_until <= ?",
+            (lease_until, timer_id, now, now),
+        ).rowcount
+    ]
+
+
+def _finish(conn, outcomes: list):
+    # Timers replaced while their handler ran have a new id and are left alone
+    conn.executemany("DELETE FROM timers WHERE id = ?", [(timer_id,) for timer_id, due_at, _, _ in outcomes if due_at is None])
+    conn.executemany(
+        "UPDATE timers SET due_at = ?, attempt = ?, failures = ?, leased_until = 0 WHERE id = ?",
+        [(due_at, attempt, failures, timer_id) for timer_id, due_at, attempt, failures in outcomes if due_at is not None],
+    )
+
+
+def _release(conn, timer_ids: list):
+    conn.executemany("UPDATE timers SET leased_until = 0 WHERE id = ?", [(timer_id,) for timer_id in timer_ids])
@@ -0,0 +1,414 @@
+"""Message templates and inline keyboards.
+
+Everything here is built once at import: templates are parsed and checked,
+static keyboards are prebuilt frozen objects shared by every request, and
+keyboards that depend on an id come from an LRU cache. Each language is a
+separate entry in TEXTS/BUTTONS; adding one costs nothing per request.
+"""
+import string
+from functools import lru_cache
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from pydantic import ConfigDict
+
+from callbacks import (
+    AdminAction, AdminCallback, ComplexityCallback, OrderAction, OrderCallback, PageCallback, PageView,
+    PaymentAction, PaymentCallback, PlatformCallback, SearchCallback, ServiceCallback,
+)
+
+DEFAULT_LANG = "uz"
+
+TEXTS = {
+    "uz": {
+        "terms": (
+            "📋 *FOYDALANISH SHARTLARI*\n\n"
+            "Hurmatli mijoz! Buyurtma berishdan avval quyidagi shartlar bilan tanishib chiqing:\n\n"
+            "🔹 *To‘lov tartibi:*\n"
+            "Buyurtma tasdiqlangach, 25% oldindan to‘lov amalga oshiriladi.\n"
+            "Qolgan 75% ish yakunlangandan so‘ng, yakuniy versiyani taqdim etishdan oldin to‘lanadi.\n\n"
+            "🔹 *Dizaynni o‘zgartirish:*\n"
+            "3 martagacha bepul tahrir (kattaroq o‘zgarishlar emas, faqat kichik tuzatishlar).\n"
+            "3 martadan keyingi har bir o‘zgartirish uchun qo‘shimcha to‘lov olinadi (summasi ish murakkabligiga qarab belgilanadi).\n\n"
+            "🔹 *Muddatlar:*\n"
+            "Har bir buyurtmaning bajarilish muddati uning murakkabligi va mavjud navbatga qarab belgilanadi.\n"
+            "Muddati haqida alohida xabar beriladi.\n\n"
+            "🔹 *Buyurtmadan voz kechish:*\n"
+            "Agar buyurtma bekor qilinsa:\n"
+            "- Ish boshlanmagan bo‘lsa, to‘liq pul qaytariladi.\n"
+            "- Ish boshlangan bo‘lsa, oldindan to‘lov qaytarilmaydi.\n\n"
+            "🔹 *Promokodlar:*\n"
+            "Aksiya yoki promokodlardan faqat bir marta foydalanish mumkin.\n"
+            "Har bir promokodda alohida amal qilish muddati mavjud.\n\n"
+            "🔹 *Materiallar va ma’lumotlar:*\n"
+            "Mijoz topshirgan rasm, matn, logotip kabi materiallar sifatli bo‘lishi lozim.\n"
+            "Noto‘g‘ri yoki sifatsiz ma’lumot sababli kechikishlar uchun mas’uliyat olinmaydi.\n\n"
+            "🔹 *Bog‘lanish:*\n"
+            "Har qanday savollar, aniqlik kiritish yoki holatni kuzatib borish uchun biz bilan bog‘lanishingiz mumkin.\n"
+        ),
+        "welcome": "Xush kelibsiz! Xizmat turini tanlang:",
+        "subscribe_first": "Iltimos, avval [kanalga obuna bo‘ling]({link})!",
+        "subscribe_again": "Iltimos, avval {link} kanaliga obuna bo‘ling!",
+        "not_admin": "Sizda admin huquqlari yo‘q!",
+        "db_error": "Buyurtmalarni ko‘rishda xatolik yuz berdi. Iltimos, keyinroq qayta urinib ko‘ring.",
+        "receipt": (
+            "\U0001F9FE *Buyurtma Cheki*\n\n"
+            "🆔 Buyurtma ID: {order_id}\n"
+            "👤 ID: {user_id}\n"
+            "🔧 Xizmat: {service}\n"
+            "🎨 Ranglar: {colors}\n"
+            "📋 Talablar: {details}\n"
+            "📈 Murakkablik: {complexity}\n"
+            "🎟️ Promokod: {promo_code}\n"
+            "💸 Chegirma: {discount_percent}%\n"
+            "💰 Umumiy narx: {total_price} so‘m\n"
+            "💳 Oldindan to‘lov (25%): {upfront_price} so‘m\n\n"
+            "✅ Buyurtmani tasdiqlang va 25% oldindan to‘lovni amalga oshiring.\n"
+            "Qolgan 75% ish tugagach to‘lanadi."
+        ),
+        "no_promo": "yo‘q",
+        "promo_used": "Siz bu promokoddan allaqachon foydalangansiz. Boshqa promokod kiriting yoki bosh menyuga qayting:",
+        "promo_exhausted": "Bu promokodning muddati yoki limiti tugagan. Boshqa promokod kiriting yoki bosh menyuga qayting:",
+        "admin_awaiting_approval": "\n\nAdmin tasdiqlashi kutilmoqda:",
+        "payment_instructions": (
+            "💳 To‘lov uchun karta raqami: `{card_number}`\n\n"
+            "Yoki quyidagi havola orqali to‘lovni amalga oshiring:\n"
+            "[To‘lov qilish]({payment_url})\n\n"
+            "💰 To‘lov miqdori: {total_price} so‘m\n\n"
+            "To‘lovni amalga oshirgach, pastdagi \"To‘lov qildim\" tugmasini bosing va to‘lov chekini yuboring."
+        ),
+        "receipt_caption": "🧾 To‘lov cheki\nBuyurtma ID: {order_id}\nFoydalanuvchi: {user_id}",
+        "receipt_closed_caption": "🧾 Yopilgan buyurtma uchun chek\nBuyurtma ID: {order_id}\nFoydalanuvchi: {user_id}",
+        "receipt_order_closed": (
+            "Bu buyurtma yopilgan (to‘langan, bekor qilingan yoki muddati o‘tgan), shuning uchun chek ko‘rib chiqishga "
+            "yuborilmadi. To‘lov qilgan bo‘lsangiz, admin bilan bog‘laning."
+        ),
+        "payment_confirmed": (
+            "✅ To‘lovingiz tasdiqlandi!\n\n"
+            "Buyurtmangiz tayyorlash jarayoniga yuborildi.\n"
+            "⏳ *Taxminiy kutish vaqti*: 1-3 ish kuni (aniq muddat buyurtma murakkabligiga qarab belgilanadi).\n"
+            "Jarayon haqida savollaringiz bo‘lsa, admin bilan bog‘lanishingiz mumkin."
+        ),
+        "payment_rejected": "❌ To‘lovingiz rad etildi. Iltimos, to‘lovni qayta yuboring yoki admin bilan bog‘laning.",
+        "my_orders_title": "📋 *Sizning Buyurtmalaringiz*\n\n",
+        "my_orders_entry": (
+            "🆔 Buyurtma ID: {order_id}\n"
+            "🔧 Xizmat: {service}\n"
+            "💰 Narx: {total_price} so‘m\n"
+            "📈 Holat: {status}\n\n"
+        ),
+        "no_orders": "Sizda hali buyurtmalar yo‘q.",
+        "admin_orders_title": "🗂 *Tasdiqlanmagan buyurtmalar*\n\n",
+        "admin_orders_entry": (
+            "🆔 Buyurtma ID: {order_id}\n"
+            "👤 Foydalanuvchi ID: {user_id}\n"
+            "🔧 Xizmat: {service}\n"
+            "💰 Narx: {total_price} so‘m\n"
+            "📈 Holat: {status}\n\n"
+        ),
+        "no_pending_orders": "Hozirda tasdiqlanmagan buyurtmalar yo‘q.",
+        "admin_digest_title": "🆕 *Yangi buyurtmalar: {count}*\n\n",
+        "admin_digest_entry": (
+            "🆔 #{order_id} · 👤 {user_id}\n"
+            "🔧 {service} · 💰 {total_price} so‘m\n"
+            "📝 {details}\n\n"
+        ),
+        "payment_reminder": (
+            "⏰ Buyurtma #{order_id} to‘lovi hali amalga oshirilmagan.\n"
+            "💰 Summa: {total_price} so‘m. To‘lov qilish uchun quyidagi tugmani bosing:"
+        ),
+        "order_expired": "⌛️ Buyurtma #{order_id} to‘lov qilinmagani sababli bekor qilindi. Yangi buyurtma berishingiz mumkin.",
+        "receipt_nudge": "⏰ Buyurtma #{order_id} to‘lov cheki ({total_price} so‘m) hali ko‘rib chiqilmagan.",
+        "order_closed": "Bu buyurtma bo‘yicha amal bajarib bo‘lmaydi: u to‘langan, ko‘rib chiqilmoqda yoki bekor qilingan.",
+        "order_already_settled": "Buyurtma #{order_id} to‘lovi allaqachon ko‘rib chiqilgan.",
+        "order_approved": "✅ Buyurtma #{order_id} admin tomonidan tasdiqlandi. To‘lov tasdiqlangach, bajarilishga o‘tadi.",
+        "order_rejected": "❌ Buyurtma #{order_id} admin tomonidan rad etildi. Savollar bo‘lsa, admin bilan bog‘laning.",
+        "find_usage": "Qidiruv: /find <so‘z yoki ibora>, masalan /find Google Ads",
+        "find_title": "🔎 «{query}» — {first}–{last}:\n\n",
+        "find_entry": "#{order_id} · 👤 {user_id} · {service} · {total_price} so‘m · {status}\n{snippet}\n\n",
+        "find_empty": "🔎 «{query}» bo‘yicha hech narsa topilmadi.",
+        "find_expired": "Bu qidiruv eskirgan, /find buyrug‘ini qayta yuboring.",
+        "admin_online": "🟢 Siz onlaynsiz: yangi buyurtmalar va cheklar sizga ham taqsimlanadi.",
+        "admin_offline": "⚪️ Siz oflaynsiz: ochiq ishlaringiz boshqa adminlarga o‘tkaziladi.",
+        "work_roster_title": "👥 Adminlar va ochiq ishlar:\n\n",
+        "work_roster_entry": "{presence} {admin_id} · {load} ta ochiq ish · oxirgi faollik: {last_seen}\n",
+        "work_taken": "Buyurtma #{order_id} bilan admin {admin_id} shug‘ullanmoqda.",
+        "work_reassigned": "↪️ Admin {admin_id} javob bermadi: buyurtma #{order_id} sizga o‘tkazildi.",
+        "relay_header": "👤 {full_name} (ID: {user_id}):",
+        "flood_wait": "⏳ Juda tez! Iltimos, biroz kuting.",
+        "admin_receipts_title": "🧾 *To‘lov cheklari: {count}*\nHar bir chekni tasdiqlang yoki rad eting:",
+    },
+}
+
+BUTTONS = {
+    "uz": {
+        "design": "🎨 Grafik Dizayn",
+        "bot": "✍️ Telegram bot yaratish",
+        "web": "💻 Web Dasturlash",
+        "smm": "✍️ Ijtimoiy tarmoqlarni avtomatlashtirish",
+        "target": "🎯 Target Xizmat",
+        "my_orders": "📋 Mening Buyurtmalarim",
+        "yes": "✅ Ha",
+        "no": "❌ Yo‘q",
+        "minimalistik": "Minimalistik",
+        "orta": "O'rta",
+        "yuqori": "Yuqori",
+        "back_to_menu": "⬅️ Bosh menyuga",
+        "subscribe": "Obuna bo‘lish",
+        "check": "✅ Tekshirish",
+        "pay": "💳 To‘lov qilish",
+        "cancel": "❌ Bekor qilish",
+        "approve": "✅ Tasdiqlash",
+        "reject": "❌ Rad etish",
+        "accept_terms": "✅ Tasdiqlayman",
+        "reject_terms": "❌ Rad etaman",
+        "paid": "✅ To‘lov qildim",
+        "chat_with_admin": "✉️ Admin bilan chat",
+        "confirm_payment": "✅ To‘lovni tasdiqlash",
+        "reject_payment": "❌ To‘lovni rad etish",
+        "other": "Boshqa",
+        "prev": "⬅️ Oldingi",
+        "next": "Keyingi ➡️",
+    },
+}
+
+# Button code -> platform name stored on the order
+TARGET_PLATFORMS = {"gads": "Google Ads", "ig": "Instagram post", "fb": "Facebook Ads", "tg": "Telegram"}
+
+
+# Templates
+_CONVERSIONS = {None: None, "s": str, "r": repr, "a": ascii}
+
+
+class Template:
+    __slots__ = ("text", "parts")
+
+    def __init__(self, text: str):
+        self.text = text
+        # Split once into (literal, field, spec, conversion) so render only joins; parsing here also
+        # surfaces a malformed template at startup rather than mid-conversation
+        self.parts = []
+        for literal, name, spec, conversion in string.Formatter().parse(text):
+            if name is not None and not name.isidentifier():
+                raise ValueError(f"Template field {name!r} is not a plain name: {text!r}")
+            self.parts.append((literal, name, spec, _CONVERSIONS[conversion]))
+        self.parts = tuple(self.parts)
+
+    def render(self, fields: dict) -> str:
+        if len(self.parts) == 1 and self.parts[0][1] is None:
+            return self.parts[0][0]
+        out = []
+        for literal, name, spec, convert in self.parts:
+            out.append(literal)
+            if name is not None:
+                value = fields[name]
+                if convert is not None:
+                    value = convert(value)
+                out.append(format(value, spec) if spec else str(value))
+        return "".join(out)
+
+
+_TEMPLATES = {lang: {name: Template(text) for name, text in texts.items()} for lang, texts in TEXTS.items()}
+
+
+def render(name: str, lang: str = DEFAULT_LANG, **fields) -> str:
+    return _TEMPLATES[lang][name].render(fields)
+
+
+# Keyboards
+class FrozenKeyboard(InlineKeyboardMarkup):
+    # Shared between requests, so nobody may modify one in place
+    model_config = ConfigDict(frozen=True)
+
+
+def _keyboard(rows) -> FrozenKeyboard:
+    return FrozenKeyboard(inline_keyboard=[
+        [InlineKeyboardButton(**button) for button in row] for row in rows
+    ])
+
+
+def _static_keyboards(b: dict) -> dict:
+    return {
+        "main_menu": _keyboard([
+            [{"text": b["design"], "callback_data": ServiceCallback(service="design").pack()}],
+            [{"text": b["bot"], "callback_data": ServiceCallback(service="content").pack()}],
+            [{"text": b["web"], "callback_data": ServiceCallback(service="web").pack()}],
+            [{"text": b["smm"], "callback_data": ServiceCallback(service="content").pack()}],
+            [{"text": b["target"], "callback_data": ServiceCallback(service="target").pack()}],
+            [{"text": b["my_orders"], "callback_data": "my_orders"}],
+        ]),
+        "promo_choice": _keyboard([
+            [{"text": b["yes"], "callback_data": "promo_yes"}, {"text": b["no"], "callback_data": "promo_no"}],
+        ]),
+        "complexity": _keyboard([
+            [{"text": b[level], "callback_data": ComplexityCallback(level=level).pack()}] for level in ("minimalistik", "orta", "yuqori")
+        ]),
+        "back_to_menu": _keyboard([[{"text": b["back_to_menu"], "callback_data": "back_to_menu"}]]),
+        "terms_confirmation": _keyboard([
+            [{"text": b["accept_terms"], "callback_data": "accept_terms"}],
+            [{"text": b["reject_terms"], "callback_data": "reject_terms"}],
+        ]),
+        "user_chat": _keyboard([[{"text": b["chat_with_admin"], "callback_data": "start_chat_with_admin"}]]),
+        "target_platform": _keyboard(
+            [[{"text": name, "callback_data": PlatformCallback(code=code).pack()}] for code, name in TARGET_PLATFORMS.items()]
+            + [[{"text": b["other"], "callback_data": PlatformCallback(code="other").pack()}]]
+        ),
+    }
+
+
+_STATIC = {lang: _static_keyboards(buttons) for lang, buttons in BUTTONS.items()}
+
+
+def main_menu_kb(lang: str = DEFAULT_LANG):
+    return _STATIC[lang]["main_menu"]
+
+
+def promo_choice_kb(lang: str = DEFAULT_LANG):
+    return _STATIC[lang]["promo_choice"]
+
+
+def complexity_kb(lang: str = DEFAULT_LANG):
+    return _STATIC[lang]["complexity"]
+
+
+def back_to_menu_kb(lang: str = DEFAULT_LANG):
+    return _STATIC[lang]["back_to_menu"]
+
+
+def terms_confirmation_kb(lang: str = DEFAULT_LANG):
+    return _STATIC[lang]["terms_confirmation"]
+
+
+def user_chat_kb(lang: str = DEFAULT_LANG):
+    return _STATIC[lang]["user_chat"]
+
+
+def target_platform_kb(lang: str = DEFAULT_LANG):
+    return _STATIC[lang]["target_platform"]
+
+
+# Keyboards that carry an id: built on first use, then served from the cache
+@lru_cache(maxsize=8)
+def subscription_kb(channel_link: str, lang: str = DEFAULT_LANG):
+    b = BUTTONS[lang]
+    return _keyboard([
+        [{"text": b["subscribe"], "url": channel_link}],
+        [{"text": b["check"], "callback_data": "check_subscription"}],
+    ])
+
+
+@lru_cache(maxsize=4096)
+def payment_confirmation_kb(order_id: int, lang: str = DEFAULT_LANG):
+    b = BUTTONS[lang]
+    return _keyboard([
+        [{"text": b["pay"], "callback_data": OrderCallback(action=OrderAction.PAY, order_id=order_id).pack()}],
+        [{"text": b["cancel"], "callback_data": "cancel_order"}],
+    ])
+
+
+@lru_cache(maxsize=4096)
+def admin_order_management_kb(order_id: int, lang: str = DEFAULT_LANG):
+    b = BUTTONS[lang]
+    return _keyboard([
+        [{"text": b["approve"], "callback_data": AdminCallback(action=AdminAction.APPROVE, target_id=order_id).pack()}],
+        [{"text": b["reject"], "callback_data": AdminCallback(action=AdminAction.REJECT, target_id=order_id).pack()}],
+    ])
+
+
+@lru_cache(maxsize=1024)
+def payment_reminder_kb(order_id: int, lang: str = DEFAULT_LANG):
+    return _keyboard([[{"text": BUTTONS[lang]["pay"], "callback_data": OrderCallback(action=OrderAction.PAY, order_id=order_id).pack()}]])
+
+
+@lru_cache(maxsize=4096)
+def payment_done_kb(order_id: int, lang: str = DEFAULT_LANG):
+    b = BUTTONS[lang]
+    return _keyboard([
+        [{"text": b["paid"], "callback_data": OrderCallback(action=OrderAction.PAID, order_id=order_id).pack()}],
+        [{"text": b["back_to_menu"], "callback_data": "back_to_menu"}],
+    ])
+
+
+@lru_cache(maxsize=4096)
+def admin_payment_kb(order_id: int, lang: str = DEFAULT_LANG):
+    b = BUTTONS[lang]
+    return _keyboard([
+        [{"text": b["confirm_payment"], "callback_data": PaymentCallback(action=PaymentAction.CONFIRM, order_id=order_id).pack()}],
+        [{"text": b["reject_payment"], "callback_data": PaymentCallback(action=PaymentAction.REJECT, order_id=order_id).pack()}],
+    ])
+
+
+# Paginated views: rows start with the order id and end with its timestamp,
+# which together form the keyset cursor carried in the callback data
+def page_nav_row(view: PageView, rows, has_prev: bool, has_next: bool, lang: str = DEFAULT_LANG):
+    b = BUTTONS[lang]
+    row = []
+    if has_prev:
+        prev_page = PageCallback(view=view, backward=True, timestamp=rows[0][-1], order_id=rows[0][0])
+        row.append(InlineKeyboardButton(text=b["prev"], callback_data=prev_page.pack()))
+    if has_next:
+        next_page = PageCallback(view=view, backward=False, timestamp=rows[-1][-1], order_id=rows[-1][0])
+        row.append(InlineKeyboardButton(text=b["next"], callback_data=next_page.pack()))
+    return row
+
+
+def find_kb(digest: str, page: int, has_prev: bool, has_next: bool, lang: str = DEFAULT_LANG):
+    b = BUTTONS[lang]
+    row = []
+    if has_prev:
+        row.append(InlineKeyboardButton(text=b["prev"], callback_data=SearchCallback(digest=digest, page=page - 1).pack()))
+    if has_next:
+        row.append(InlineKeyboardButton(text=b["next"], callback_data=SearchCallback(digest=digest, page=page + 1).pack()))
+    return InlineKeyboardMarkup(inline_keyboard=[row] if row else [])
+
+
+def my_orders_kb(orders, has_prev: bool, has_next: bool, lang: str = DEFAULT_LANG):
+    keyboard = []
+    nav = page_nav_row(PageView.MY_ORDERS, orders, has_prev, has_next, lang)
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton(text=BUTTONS[lang]["back_to_menu"], callback_data="back_to_menu")])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+# Lists of several orders get one row per order whose first button is labelled "#<id>"
+def _admin_order_row(order_id: int, user_id: int):
+    return [
+        InlineKeyboardButton(text=f"✅ #{order_id}", callback_data=AdminCallback(action=AdminAction.APPROVE, target_id=order_id).pack()),
+        InlineKeyboardButton(text=f"❌ #{order_id}", callback_data=AdminCallback(action=AdminAction.REJECT, target_id=order_id).pack()),
+        InlineKeyboardButton(text=f"✉️ {user_id}", callback_data=AdminCallback(action=AdminAction.CHAT, target_id=user_id).pack()),
+    ]
+
+
+def admin_orders_kb(orders, has_prev: bool, has_next: bool, lang: str = DEFAULT_LANG):
+    keyboard = [_admin_order_row(order[0], order[1]) for order in orders]
+    nav = page_nav_row(PageView.ADMIN, orders, has_prev, has_next, lang)
+    if nav:
+        keyboard.append(nav)
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+def admin_digest_kb(orders):
+    # orders: (order_id, user_id) pairs
+    return InlineKeyboardMarkup(inline_keyboard=[_admin_order_row(order_id, user_id) for order_id, user_id in orders])
+
+
+def admin_receipts_kb(order_ids):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"✅ #{order_id}", callback_data=PaymentCallback(action=PaymentAction.CONFIRM, order_id=order_id).pack()),
+         InlineKeyboardButton(text=f"❌ #{order_id}", callback_data=PaymentCallback(action=PaymentAction.REJECT, order_id=order_id).pack())]
+        for order_id in order_ids
+    ])
+
+
+def digest_without(markup, order_id: int):
+    # -> the keyboard minus the order's row, or None if markup is not a multi-order keyboard
+    rows = getattr(markup, "inline_keyboard", None) or []
+    if not rows or _row_order(rows[0]) is None:
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=[row for row in rows if _row_order(row) != order_id])
+
+
+def _row_order(row):
+    label = row[0].text if row else ""
+    number = label.rpartition("#")[2]
+    return int(number) if "#" in label and number.isdigit() else None
@@ -0,0 +1,231 @@
+"""Webhook entry point.
+
+A front process receives Telegram POSTs and fans them out to N worker
+processes. Updates are sharded by user id on a consistent-hash ring, so each
+user's FSM flow always runs on the same worker:
+
+    python webhook.py serve --workers 4
+    python webhook.py fake --users 20     # local smoke test, no Telegram needed
+
+Telegram's send limits (SEND_GLOBAL_RATE, ~30 messages/s, and
+SEND_CHAT_RATE, ~1/s per chat) apply to the bot as a whole, so each
+worker sends at most 1/N of the global rate, and of the rate into an
+admin chat, which every worker writes to. Adding workers spreads update
+handling, not outbound throughput.
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import time
+
+from aiohttp import ClientSession, web
+from dotenv import load_dotenv
+
+from logs import setup_logging
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # public https base, e.g. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", os.cpu_count() or 1))
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class HashRing:
+    # Consistent hashing with virtual nodes; adding a worker only moves ~1/N users
+    def __init__(self, nodes: int, replicas: int = 100):
+        points = sorted(
+            (self._hash(f"worker-{node}-{replica}"), node)
+            for node in range(nodes) for replica in range(replicas)
+        )
+        self._hashes = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    @staticmethod
+    def _hash(key) -> int:
+        return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), "big")
+
+    def node_for(self, key) -> int:
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+def shard_key(update: dict) -> int:
+    # Membership updates belong to the member, not to whoever changed it, so the
+    # worker that caches that user's subscription sees the invalidation.
+    for kind in ("chat_member", "my_chat_member"):
+        if kind in update:
+            return update[kind]["new_chat_member"]["user"]["id"]
+    # Everything else, admin callbacks included (payment review, admin chat),
+    # follows the sender: admin chat sessions live in the admin's own FSM context,
+    # so all admin traffic must land on the admin's worker.
+    for event in update.values():
+        if isinstance(event, dict) and "from" in event:
+            return event["from"]["id"]
+    return update.get("update_id", 0)
+
+
+# Worker process
+def worker_main(index: int, count: int, queue):
+    # The front process owns shutdown and stops workers with a sentinel
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.environ["WORKER_INDEX"] = str(index)  # read by bot.py, e.g. for the worker's metrics port
+    os.environ["WORKER_COUNT"] = str(count)  # bot.py splits the send limits between the workers
+    # bot.py sets up logging on import and tags every record with this index
+    asyncio.run(_worker(index, queue))
+
+
+async def _worker(index: int, queue):
+    from bot import bot, dp
+
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    await dp.emit_startup(bot=bot, dispatcher=dp, bots=[bot])
+    logger.info("Worker %s ready", index)
+    try:
+        while True:
+            raw = await loop.run_in_executor(None, queue.get)
+            if raw is None:
+                break
+            task = asyncio.create_task(dp.feed_raw_update(bot, raw))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await dp.emit_shutdown(bot=bot, dispatcher=dp, bots=[bot])
+        await bot.session.close()
+        logger.info("Worker %s stopped", index)
+
+
+# Front process
+def start_workers(count: int):
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(count)]
+    processes = [ctx.Process(target=worker_main, args=(i, count, q), name=f"bot-worker-{i}") for i, q in enumerate(queues)]
+    for process in processes:
+        process.start()
+    return queues, processes
+
+
+def build_app(queues, secret: str) -> web.Application:
+    ring = HashRing(len(queues))
+    routed = [0] * len(queues)
+
+    async def handle_update(request: web.Request):
+        if secret and request.headers.get(SECRET_HEADER) != secret:
+            return web.Response(status=401)
+        update = await request.json()
+        node = ring.node_for(shard_key(update))
+        queues[node].put(update)
+        routed[node] += 1
+        return web.Response()
+
+    async def handle_stats(request: web.Request):
+        return web.json_response({"routed": routed})
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    app.router.add_get("/workers", handle_stats)
+    return app
+
+
+async def serve(workers: int, register: bool):
+    queues, processes = start_workers(workers)
+    runner = web.AppRunner(build_app(queues, WEBHOOK_SECRET))
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logger.info("Webhook listening on %s:%s%s with %s workers", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, workers)
+
+    if register:
+        from bot import bot, dp
+        if not WEBHOOK_URL:
+            raise ValueError("WEBHOOK_URL is not set. Set it in .env or run with --no-register.")
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    logger.info("Stopping webhook")
+    if register:
+        await bot.delete_webhook()
+        await bot.session.close()
+    await runner.cleanup()
+    for queue in queues:
+        queue.put(None)
+    for process in processes:
+        process.join(timeout=30)
+
+
+# Fake Telegram client for local testing
+def fake_updates(users: int, per_user: int):
+    update_id = random.randint(1, 1_000_000)
+    for step in range(per_user):
+        for user_id in range(1, users + 1):
+            update_id += 1
+            chat = {"id": user_id, "type": "private", "first_name": f"User{user_id}"}
+            sender = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+            message = {"message_id": step + 1, "date": int(time.time()), "chat": chat, "from": sender}
+            if step == 0:
+                yield {"update_id": update_id, "message": {**message, "text": "/start",
+                       "entities": [{"type": "bot_command", "offset": 0, "length": 6}]}}
+            else:
+                yield {"update_id": update_id, "callback_query": {
+                    "id": str(update_id), "from": sender, "chat_instance": str(user_id),
+                    "message": message, "data": "accept_terms" if step == 1 else "my_orders",
+                }}
+
+
+async def post_fake_updates(url: str, users: int, per_user: int):
+    headers = {SECRET_HEADER: WEBHOOK_SECRET} if WEBHOOK_SECRET else {}
+    sent = 0
+    started = time.perf_counter()
+    async with ClientSession() as session:
+        for update in fake_updates(users, per_user):
+            async with session.post(url, json=update, headers=headers) as response:
+                response.raise_for_status()
+            sent += 1
+        elapsed = time.perf_counter() - started
+        async with session.get(url.rsplit("/", 1)[0] + "/workers") as response:
+            routed = await response.json()
+    logger.info("Posted %s updates in %.2fs (%.0f/s), routed per worker: %s", sent, elapsed, sent / elapsed, routed['routed'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    serve_cmd = sub.add_parser("serve", help="run the webhook front and worker processes")
+    serve_cmd.add_argument("--workers", type=int, default=WEBHOOK_WORKERS)
+    serve_cmd.add_argument("--no-register", action="store_true", help="do not call setWebhook (local testing)")
+    fake_cmd = sub.add_parser("fake", help="POST synthetic updates to a running webhook")
+    fake_cmd.add_argument("--url", default=f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    fake_cmd.add_argument("--users", type=int, default=20)
+    fake_cmd.add_argument("--per-user", type=int, default=3)
+    args = parser.parse_args()
+
+    setup_logging(os.getenv("LOG_LEVEL", "INFO"), os.getenv("LOG_FORMAT", "json"))
+    if args.command == "serve":
+        asyncio.run(serve(args.workers, register=not args.no_register))
+    else:
+        asyncio.run(post_fake_updates(args.url, args.users, args.per_user))
+
+
+if __name__ == "__main__":
+    main()
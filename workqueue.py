@@ -0,0 +1,287 @@
+import asyncio
+import json
+import logging
+import time
+
+from aiogram import BaseMiddleware
+
+from db import WORK_EXPIRED_SQL, WORK_RECEIPT
+
+logger = logging.getLogger(__name__)
+
+
+class WorkQueue:
+    """Shares new orders and receipts between the admins on the roster.
+
+    Every notice becomes a work item in work_items, assigned to the online
+    admin with the fewest open items (the one assigned to least recently
+    on a tie), or to the owner when nobody is online. The assignee holds a
+    lease on the item that their own activity keeps renewing. An admin who
+    presses approve, reject or confirm claims the item, which is refused
+    while another admin's lease is live, so two admins never settle the
+    same order notice or receipt. A lease that runs out, because its admin went quiet or went
+    /offline, is picked up by a sweep and the item is moved to another
+    active admin, whose handler registered with on() sends the notice
+    again. Items are removed by a trigger once the order moves on.
+    """
+
+    def __init__(self, repo, owner_id: int, lease_seconds: float = 900, sweep_interval: float = 30,
+                 batch_size: int = 100):
+        self.repo = repo
+        self.owner_id = owner_id
+        self.lease_seconds = lease_seconds
+        self.sweep_interval = sweep_interval
+        self.batch_size = batch_size
+        self.admins = frozenset()
+        self._handlers = {}
+        self._renew_at = {}  # admin -> when their leases are next renewed
+        self._wakeup = None
+        self._task = None
+        self.reassigned = 0
+        self.claims_refused = 0
+
+    def on(self, kind: str):
+        # handler(order_id, admin_id, notice, previous_admin_id) sends a reassigned item to its new admin
+        def register(handler):
+            if kind in self._handlers:
+                raise ValueError(f"Work kind {kind!r} already has a handler")
+            self._handlers[kind] = handler
+            return handler
+        return register
+
+    async def sync(self, admin_ids):
+        # The roster follows configuration; items held by admins who left are swept to the others
+        self.admins = frozenset(admin_ids) | {self.owner_id}
+        await self.repo.write("work_sync", _sync, sorted(self.admins))
+
+    async def enqueue(self, order_id: int, kind: str, notice: dict):
+        # -> the admin to notify, or None if the order no longer needs this kind of attention
+        now = time.time()
+        return await self.repo.write(
+            "work_enqueue", _enqueue, order_id, kind, json.dumps(notice), now, self.lease_seconds, self.owner_id
+        )
+
+    async def claim(self, order_id: int, kind: str, admin_id: int):
+        # -> None when admin_id may settle the order's item of this kind, else the admin whose lease is live
+        now = time.time()
+        holder = await self.repo.write("work_claim", _claim, order_id, kind, admin_id, now, now + self.lease_seconds)
+        if holder is not None:
+            self.claims_refused += 1
+        return holder
+
+    async def release(self, order_id: int, kind: str):
+        # The admin never got the notice: the next sweep moves the item to another admin
+        await self.repo.write("work_release", _release_order, order_id, kind)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def assignee(self, order_id: int, kind: str):
+        return await self.repo.read("work_assignee", _assignee, order_id, kind)
+
+    async def contact_for(self, user_id: int) -> int:
+        # The admin looking after the customer's latest order, else the owner
+        return await self.repo.read("work_contact", _contact, user_id) or self.owner_id
+
+    async def seen(self, admin_id: int):
+        # Any update from an admin renews their leases; written at most every quarter lease
+        now = time.time()
+        if admin_id not in self.admins or now < self._renew_at.get(admin_id, 0):
+            return
+        self._renew_at[admin_id] = now + self.lease_seconds / 4
+        await self.repo.write("work_renew", _renew, admin_id, now, now + self.lease_seconds)
+
+    async def set_online(self, admin_id: int, online: bool):
+        # Going offline gives up every lease at once; the sweep runs straight away
+        self._renew_at.pop(admin_id, None)
+        await self.repo.write("work_presence", _set_online, admin_id, online, time.time())
+        if not online and self._wakeup is not None:
+            self._wakeup.set()
+
+    async def roster(self) -> list:
+        # Rows of (user_id, online, last_seen, open items)
+        return await self.repo.read("work_roster", _roster)
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Work queue sweep failed: %s", e)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.sweep_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def sweep(self):
+        now = time.time()
+        item_ids = await self.repo.read("work_expired", _expired, now, self.batch_size)
+        if not item_ids:
+            return
+        moved = await self.repo.write(
+            "work_reassign", _reassign, item_ids, now, self.lease_seconds, self.owner_id
+        )
+        for item_id, order_id, kind, admin_id, previous, notice in moved:
+            self.reassigned += 1
+            logger.info("Work item %s for order %s moved from admin %s to %s", kind, order_id, previous, admin_id)
+            handler = self._handlers.get(kind)
+            if handler is None:
+                continue
+            try:
+                await handler(order_id, admin_id, json.loads(notice) if notice else None, previous)
+            except Exception as e:
+                # Released, so the next sweep tries another admin
+                logger.error("Could not hand order %s to admin %s: %s", order_id, admin_id, e)
+                await self.repo.write("work_release", _release, item_id)
+
+    def metrics(self) -> dict:
+        return {"admins": len(self.admins), "reassigned": self.reassigned, "claims_refused": self.claims_refused}
+
+
+class PresenceMiddleware(BaseMiddleware):
+    """Outer update middleware that reports admin activity to the work queue."""
+
+    def __init__(self, queue: WorkQueue):
+        self.queue = queue
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None and user.id in self.queue.admins:
+            try:
+                await self.queue.seen(user.id)
+            except Exception as e:
+                logger.warning("Could not renew leases of admin %s: %s", user.id, e)
+        return await handler(event, data)
+
+
+# Queries (executed on repository threads)
+def _pick_admin(conn, now: float, lease_seconds: float, exclude=None, active_only: bool = False):
+    # Online admins who acted within a lease come first, then fewest open items, then least recently assigned
+    active_after = now - lease_seconds
+    row = conn.execute("""
+        SELECT user_id FROM admins
+        WHERE online = 1 AND user_id IS NOT ? AND last_seen >= ?
+        ORDER BY last_seen < ?, (SELECT COUNT(*) FROM work_items WHERE assignee = admins.user_id), last_assigned_at
+        LIMIT 1
+    """, (exclude, active_after if active_only else 0, active_after)).fetchone()
+    if row is None:
+        return None
+    conn.execute("UPDATE admins SET last_assigned_at = ? WHERE user_id = ?", (now, row[0]))
+    return row[0]
+
+
+def _sync(conn, admin_ids: list):
+    marks = ", ".join("?" * len(admin_ids))
+    conn.executemany("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", [(admin_id,) for admin_id in admin_ids])
+    conn.execute(f"DELETE FROM admins WHERE user_id NOT IN ({marks})", admin_ids)
+    conn.execute(f"UPDATE work_items SET leased_until = 0 WHERE assignee NOT IN ({marks})", admin_ids)
+
+
+def _enqueue(conn, order_id: int, kind: str, notice: str, now: float, lease_seconds: float, owner_id: int):
+    # Same rule as the work_items_done trigger: a receipt while it is reviewed, an order notice until then
+    live = conn.execute(
+        "SELECT 1 FROM orders WHERE id = ? AND status = 'pending' AND (? = ?) = (payment_status IS 'review')",
+        (order_id, kind, WORK_RECEIPT),
+    ).fetchone()
+    if live is None:
+        return None
+    assignee = _pick_admin(conn, now, lease_seconds) or owner_id
+    conn.execute("""
+        INSERT OR REPLACE INTO work_items (order_id, kind, assignee, leased_until, notice, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (order_id, kind, assignee, now + lease_seconds, notice, now))
+    return assignee
+
+
+def _claim(conn, order_id: int, kind: str, admin_id: int, now: float, lease_until: float):
+    row = conn.execute(
+        "SELECT id, assignee, leased_until FROM work_items WHERE order_id = ? AND kind = ?", (order_id, kind)
+    ).fetchone()
+    if row is None:
+        return None  # settled already, or sent before the queue existed; the status change decides
+    item_id, assignee, leased_until = row
+    if assignee != admin_id and leased_until > now:
+        return assignee
+    conn.execute("UPDATE work_items SET assignee = ?, leased_until = ? WHERE id = ?", (admin_id, lease_until, item_id))
+    return None
+
+
+def _assignee(conn, order_id: int, kind: str):
+    row = conn.execute("SELECT assignee FROM work_items WHERE order_id = ? AND kind = ?", (order_id, kind)).fetchone()
+    return row[0] if row else None
+
+
+def _contact(conn, user_id: int):
+    row = conn.execute("""
+        SELECT w.assignee FROM orders o JOIN work_items w ON w.order_id = o.id
+        WHERE o.user_id = ? ORDER BY w.created_at DESC LIMIT 1
+    """, (user_id,)).fetchone()
+    return row[0] if row else None
+
+
+def _renew(conn, admin_id: int, now: float, lease_until: float):
+    conn.execute("UPDATE admins SET last_seen = ? WHERE user_id = ?", (now, admin_id))
+    conn.execute("UPDATE work_items SET leased_until = ? WHERE assignee = ?", (lease_until, admin_id))
+
+
+def _set_online(conn, admin_id: int, online: bool, now: float):
+    conn.execute("UPDATE admins SET online = ?, last_seen = ? WHERE user_id = ?", (int(online), now, admin_id))
+    if not online:
+        conn.execute("UPDATE work_items SET leased_until = 0 WHERE assignee = ?", (admin_id,))
+
+
+def _roster(conn) -> list:
+    return conn.execute("""
+        SELECT user_id, online, last_seen, (SELECT COUNT(*) FROM work_items WHERE assignee = admins.user_id)
+        FROM admins ORDER BY user_id
+    """).fetchall()
+
+
+def _expired(conn, now: float, limit: int) -> list:
+    return [row[0] for row in conn.execute(WORK_EXPIRED_SQL, (now, limit))]
+
+
+def _reassign(conn, item_ids: list, now: float, lease_seconds: float, owner_id: int) -> list:
+    # -> (id, order_id, kind, new admin, previous admin, notice) for every item that moved
+    moved = []
+    for item_id in item_ids:
+        row = conn.execute(
+            "SELECT order_id, kind, assignee, notice FROM work_items WHERE id = ? AND leased_until <= ?",
+            (item_id, now),
+        ).fetchone()
+        if row is None:
+            continue  # renewed, claimed or done since the sweep read it
+        order_id, kind, previous, notice = row
+        admin_id = _pick_admin(conn, now, lease_seconds, exclude=previous, active_only=True)
+        if admin_id is None and not conn.execute("SELECT 1 FROM admins WHERE user_id = ?", (previous,)).fetchone():
+            # Its admin left the roster: anyone online will do, the owner if nobody is
+            admin_id = _pick_admin(conn, now, lease_seconds, exclude=previous) or owner_id
+        if admin_id is None:
+            # Nobody else is around; it stays where it is for another lease
+            conn.execute("UPDATE work_items SET leased_until = ? WHERE id = ?", (now + lease_seconds, item_id))
+            continue
+        conn.execute(
+            "UPDATE work_items SET assignee = ?, leased_until = ?, reassignments = reassignments + 1 WHERE id = ?",
+            (admin_id, now + lease_seconds, item_id),
+        )
+        moved.append((item_id, order_id, kind, admin_id, previous, notice))
+    return moved
+
+
+def _release(conn, item_id: int):
+    conn.execute("UPDATE work_items SET leased_until = 0 WHERE id = ?", (item_id,))
+
+
+def _release_order(conn, order_id: int, kind: str):
+    conn.execute("UPDATE work_items SET leased_until = 0 WHERE order_id = ? AND kind = ?", (order_id, kind))